@@ -0,0 +1,45 @@
+"""
+Compare encode and decode cost and bytes on the wire for the codecs in
+simple_tem.codec. Runs without a server, with simple_tem on PYTHONPATH:
+
+    python benchmarks/bench_codec.py
+"""
+import argparse
+import timeit
+from simple_tem.codec import available_codecs
+
+REPLIES = [
+    ('GetStagePosition', [12.3456, -45.678, 1.5, 23.456789, 0.0]),
+    ('GetStageStatus', [0, 0, 0, 1, 0]),
+    ('GetCL3', 0xFF00),
+    ('GetILs', [21000, 22000]),
+    ('GetMagValue', [15000, 'X', 'X15k']),
+    ('GetFunctionMode', [4, 'DIFF']),
+]
+
+
+def bench(codec, cmd, value, number):
+    frames = codec.encode_reply(cmd, 'OK', value)
+    t_enc = timeit.timeit(lambda: codec.encode_reply(cmd, 'OK', value), number=number)
+    t_dec = timeit.timeit(lambda: codec.decode_reply(cmd, frames), number=number)
+    return {
+        'encode_us': t_enc/number*1e6,
+        'decode_us': t_dec/number*1e6,
+        'bytes': sum(len(f) for f in frames),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--number', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'command':<18}{'codec':<9}{'encode us':>11}{'decode us':>11}{'bytes':>7}")
+    for cmd, value in REPLIES:
+        for name, codec in available_codecs().items():
+            r = bench(codec, cmd, value, args.number)
+            print(f"{cmd:<18}{name:<9}{r['encode_us']:>11.2f}{r['decode_us']:>11.2f}{r['bytes']:>7}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Client/server round trip benchmarks against tem-server.py -d, started
+automatically on free ports:
+
+    python benchmarks/bench_server.py -o results.json
+    python benchmarks/bench_server.py --quick --compare results.json
+
+Measures single call latency per command, sustained throughput, the cost
+of an is_rotating polling loop (with and without telemetry), scaling with
+concurrent clients and the encoding cost of the wire codecs. Results are
+written as JSON. With --compare the run is checked against an earlier
+result file and the script exits with 1 if a metric regressed by more
+than --threshold.
+"""
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+from harness import DummyServer
+from bench_codec import REPLIES, bench as bench_codec
+
+from simple_tem import TEMClient
+from simple_tem.codec import available_codecs
+from simple_tem.stats import Histogram
+
+#(name, command, args)
+COMMANDS = [
+    ('ping', 'ping', ()),
+    ('GetStagePosition', 'GetStagePosition', ()),
+    ('GetStageStatus', 'GetStageStatus', ()),
+    ('GetMagValue', 'GetMagValue', ()),
+    ('GetILs', 'GetILs', ()),
+    ('GetBeamBlank', 'GetBeamBlank', ()),
+    ('GetState', 'GetState', ()),
+    ('SetBeamBlank', 'SetBeamBlank', (0,)),
+    ('SetILs', 'SetILs', (21000, 22000)),
+]
+
+
+def bench_latency(port, n, codec):
+    c = TEMClient('localhost', port, verbose=False, codec=codec)
+    results = {}
+    for name, cmd, args in COMMANDS:
+        c._send_message(cmd, *args) #warm up
+        h = Histogram()
+        for i in range(n):
+            t0 = time.perf_counter()
+            c._send_message(cmd, *args)
+            h.add(time.perf_counter() - t0)
+        results[name] = h.summary()
+    c.close()
+    return results
+
+
+def bench_throughput(port, duration_s):
+    c = TEMClient('localhost', port, verbose=False)
+    n = 0
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < duration_s:
+        c.GetStagePosition()
+        n += 1
+    dt = time.perf_counter() - t0
+    c.close()
+    return {'calls': n, 'calls_per_s': n/dt}
+
+
+def bench_polling(port, telemetry_port, n, timeout_s = 5.0):
+    results = {}
+    for mode in ('request', 'telemetry'):
+        if mode == 'telemetry' and telemetry_port is None:
+            continue
+        c = TEMClient('localhost', port, verbose=False)
+        try:
+            if mode == 'telemetry':
+                c.subscribe(telemetry_port)
+                deadline = time.perf_counter() + timeout_s
+                while c.telemetry is None:
+                    if time.perf_counter() > deadline:
+                        raise TimeoutError(f"No telemetry received within {timeout_s} s")
+                    time.sleep(0.01)
+            c.is_rotating
+            h = Histogram()
+            for i in range(n):
+                t0 = time.perf_counter()
+                c.is_rotating
+                h.add(time.perf_counter() - t0)
+            results[mode] = h.summary()
+        finally:
+            c.close()
+    return results
+
+
+def bench_scaling(port, n_clients_list, duration_s):
+    results = {}
+    for n_clients in n_clients_list:
+        hists = [Histogram() for i in range(n_clients)]
+        start = threading.Barrier(n_clients + 1)
+
+        def worker(h):
+            c = TEMClient('localhost', port, verbose=False)
+            c.ping()
+            start.wait()
+            t_end = time.perf_counter() + duration_s
+            while time.perf_counter() < t_end:
+                t0 = time.perf_counter()
+                c.GetStagePosition()
+                h.add(time.perf_counter() - t0)
+            c.close()
+
+        threads = [threading.Thread(target=worker, args=(h,)) for h in hists]
+        for t in threads:
+            t.start()
+        start.wait()
+        t0 = time.perf_counter()
+        for t in threads:
+            t.join()
+        dt = time.perf_counter() - t0
+
+        total = Histogram()
+        for h in hists:
+            total.count += h.count
+            total.total += h.total
+            total.max = max(total.max, h.max)
+            for i, count in h._buckets.items():
+                total._buckets[i] = total._buckets.get(i, 0) + count
+        results[str(n_clients)] = dict(total.summary(), calls_per_s=total.count/dt)
+    return results
+
+
+def bench_codecs(n):
+    return {cmd: {name: bench_codec(codec, cmd, value, n) for name, codec in available_codecs().items()}
+            for cmd, value in REPLIES}
+
+
+def run(args):
+    results = {
+        'meta': {
+            'time': time.time(),
+            'python': sys.version,
+            'platform': platform.platform(),
+            'args': vars(args),
+        },
+    }
+    with DummyServer() as server:
+        results['latency'] = {codec: bench_latency(server.port, args.n, codec)
+                              for codec in available_codecs()}
+        results['throughput'] = bench_throughput(server.port, args.duration)
+        results['polling'] = bench_polling(server.port, server.telemetry_port, args.n)
+        results['scaling'] = bench_scaling(server.port, args.clients, args.duration)
+        c = TEMClient('localhost', server.port, verbose=False)
+        try:
+            results['server_stats'] = c.server_stats()
+        finally:
+            c.close()
+    results['codec'] = bench_codecs(args.n*100)
+    return results
+
+
+def _metrics(results):
+    """
+    Flatten the metrics used for regression checks, all lower is better
+    """
+    m = {}
+    for codec, commands in results.get('latency', {}).items():
+        for cmd, s in commands.items():
+            m[f'latency.{codec}.{cmd}.p50_ms'] = s['p50_ms']
+            m[f'latency.{codec}.{cmd}.p99_ms'] = s['p99_ms']
+    for mode, s in results.get('polling', {}).items():
+        m[f'polling.{mode}.p50_ms'] = s['p50_ms']
+    if 'throughput' in results:
+        m['throughput.s_per_call'] = 1/results['throughput']['calls_per_s']
+    for n, s in results.get('scaling', {}).items():
+        m[f'scaling.{n}.s_per_call'] = 1/s['calls_per_s']
+    return m
+
+
+def compare(old, new, threshold):
+    """
+    Print metrics that got worse by more than threshold, returns True if any
+    """
+    old_m, new_m = _metrics(old), _metrics(new)
+    regressed = False
+    for key in sorted(set(old_m) & set(new_m)):
+        if old_m[key] > 0:
+            ratio = new_m[key]/old_m[key]
+            if ratio > threshold:
+                regressed = True
+                print(f"REGRESSION {key}: {old_m[key]:.4g} -> {new_m[key]:.4g} ({ratio:.2f}x)")
+    return regressed
+
+
+def print_summary(results):
+    print(f"{'command':<18}" + ''.join(f"{codec + ' p50/p99 ms':>26}" for codec in results['latency']))
+    for cmd, _, _ in COMMANDS:
+        row = f"{cmd:<18}"
+        for codec, commands in results['latency'].items():
+            s = commands[cmd]
+            row += f"{s['p50_ms']:>17.3f}/{s['p99_ms']:<8.3f}"
+        print(row)
+    print(f"throughput: {results['throughput']['calls_per_s']:.0f} calls/s")
+    for mode, s in results['polling'].items():
+        print(f"is_rotating ({mode}): p50 {s['p50_ms']:.4f} ms")
+    for n, s in results['scaling'].items():
+        print(f"{n} clients: {s['calls_per_s']:.0f} calls/s p99 {s['p99_ms']:.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-o', '--output', default=None, help='Write results as JSON to this file')
+    parser.add_argument('-n', type=int, default=500, help='Calls per command for latency measurements')
+    parser.add_argument('-d', '--duration', type=float, default=2.0, help='Seconds per throughput run')
+    parser.add_argument('-c', '--clients', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--quick', action='store_true', help='Short run for smoke testing')
+    parser.add_argument('--compare', default=None, help='Earlier results to check for regressions')
+    parser.add_argument('--threshold', type=float, default=1.25, help='Ratio counted as a regression')
+    args = parser.parse_args()
+    if args.quick:
+        args.n, args.duration, args.clients = 50, 0.5, [1, 4]
+
+    results = run(args)
+    print_summary(results)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Start tem-server.py with the dummy backend on free ports for benchmarks:
+
+    with DummyServer() as server:
+        c = TEMClient('localhost', server.port)
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+from simple_tem import TEMClient
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+class DummyServer:
+    """
+    Run tem-server.py -d in a subprocess. extra_args are passed on to the
+    server.
+    """
+    def __init__(self, telemetry = True, extra_args = (), startup_timeout = 10):
+        self.port = free_port()
+        self.telemetry_port = free_port() if telemetry else None
+        self.extra_args = list(extra_args)
+        self.startup_timeout = startup_timeout
+        self._server = None
+
+    def start(self):
+        cmd = [sys.executable, str(ROOT/'tem-server.py'), '-d', '-p', str(self.port),
+               '--log-level', 'WARNING'] + self.extra_args
+        if self.telemetry_port is not None:
+            cmd += ['--telemetry-port', str(self.telemetry_port)]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(ROOT), os.environ.get('PYTHONPATH')])))
+        self._server = subprocess.Popen(cmd, env=env)
+
+        c = TEMClient('localhost', self.port, verbose=False)
+        t0 = time.perf_counter()
+        while not c.ping(timeout_ms=200):
+            if self._server.poll() is not None:
+                raise RuntimeError(f"tem-server.py exited with {self._server.returncode}")
+            if time.perf_counter() - t0 > self.startup_timeout:
+                self.stop()
+                raise RuntimeError("tem-server.py did not start")
+        c.close()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            if self._server.poll() is None:
+                c = TEMClient('localhost', self.port, verbose=False)
+                try:
+                    c.exit_server()
+                    self._server.wait(5)
+                except Exception:
+                    self._server.kill()
+                    self._server.wait()
+                finally:
+                    c.close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,489 @@
+import asyncio
+import itertools
+import threading
+import time
+import traceback
+import zmq
+import zmq.asyncio
+from rich import print
+
+from .TEMClient import TEMClient, Batch, StageOperation, TelemetrySubscriber, ServerBusyError, _default_client_name
+from .codec import JsonCodec, available_codecs, select_codec
+from .coalesce import SetpointWriter
+from .state import TEMState
+from .trajectory import Trajectory
+from .stats import LatencyStats
+from .retry import RetryPolicy, is_safe
+
+
+class AsyncBatch(Batch):
+    """
+    Batch for AsyncTEMClient, use with async with:
+
+    async with c.batch() as b:
+        b.GetStagePosition()
+        b.GetMagValue()
+    pos, mag = b.results
+    """
+    async def execute(self) -> list:
+        if self._calls:
+            reply = await self._client._send_message("batch", *self._calls, timeout_ms=self.timeout_ms)
+        else:
+            reply = []
+        self.results = [value if status == "OK" else RuntimeError(f"{status}:{value}")
+                        for status, value in reply]
+        self._calls = []
+        return self.results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.execute()
+
+
+class AsyncStageOperation(StageOperation):
+    """
+    StageOperation for AsyncTEMClient, the methods are coroutines:
+
+    op = await c.StartTiltXAngle(30)
+    await op.wait(60)
+    pos = await op.position
+    """
+    async def refresh(self) -> dict:
+        if not self._finished():
+            self.status = await self._client._send_message("GetOperation", self.id)
+        return self.status
+
+    async def done(self) -> bool:
+        return (await self.refresh())['state'] != 'running'
+
+    async def wait(self, timeout = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._finished():
+            chunk = self._wait_chunk_s if deadline is None else min(self._wait_chunk_s, deadline - time.monotonic())
+            if chunk <= 0:
+                break
+            self.status = await self._client._send_message("WaitOperation", self.id, chunk,
+                                                           timeout_ms = self._client._wait_timeout_ms(chunk))
+        return self._finished()
+
+    async def cancel(self) -> bool:
+        cancelled = await self._client._send_message("CancelOperation", self.id)
+        await self.refresh()
+        return cancelled
+
+    @property
+    def position(self):
+        return self._position()
+
+    async def _position(self):
+        await self.wait()
+        return self.status['position']
+
+
+class AsyncSetpointWriter:
+    """
+    SetpointWriter for AsyncTEMClient, the values are sent by a task on the
+    running event loop. set() never blocks, flush() and close() are
+    coroutines:
+
+    async with c.setpoint_writer() as w:
+        w.set('SetILFocus', value)
+        await w.flush()
+    """
+    commands = SetpointWriter.commands
+
+    def __init__(self, client, on_applied = None):
+        self._client = client
+        self.on_applied = on_applied
+        self.applied = {}
+        self.errors = {}
+        self._pending = {}
+        self._closed = False
+        self._wake = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
+        self._stats = {'set': 0, 'sent': 0, 'replaced': 0}
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def set(self, cmd, *args) -> None:
+        if cmd not in AsyncSetpointWriter.commands:
+            raise ValueError(f"{cmd} is not an absolute setpoint, use one of {AsyncSetpointWriter.commands}")
+        if self._closed:
+            raise RuntimeError("AsyncSetpointWriter is closed")
+        self._stats['set'] += 1
+        if cmd in self._pending:
+            self._stats['replaced'] += 1
+        self._pending[cmd] = args
+        self._idle.clear()
+        self._wake.set()
+
+    async def _run(self):
+        while True:
+            while not self._pending and not self._closed:
+                self._wake.clear()
+                await self._wake.wait()
+            if not self._pending:
+                return
+            cmd = next(iter(self._pending))
+            args = self._pending.pop(cmd)
+            value, error = None, None
+            try:
+                with self._client.coalesce_setpoints():
+                    value = await self._client._send_message(cmd, *args)
+            except Exception as e:
+                error = e
+            if error is None:
+                self.applied[cmd] = value
+                self.errors.pop(cmd, None)
+            else:
+                self.errors[cmd] = error
+            self._stats['sent'] += 1
+            if not self._pending:
+                self._idle.set()
+            if self.on_applied is not None:
+                try:
+                    self.on_applied(cmd, value, error)
+                except Exception:
+                    traceback.print_exc()
+
+    async def flush(self, timeout = None) -> bool:
+        """
+        Wait until all values set so far were written, False on timeout
+        """
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    @property
+    def stats(self) -> dict:
+        return dict(self._stats)
+
+    async def close(self) -> None:
+        """
+        Write the values still pending and stop the writer task
+        """
+        self._closed = True
+        self._wake.set()
+        await self._task
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+class AsyncTEMClient(TEMClient):
+    """
+    asyncio version of TEMClient with the same commands, every command
+    returns a coroutine:
+
+    c = AsyncTEMClient("temserver", 3535)
+    pos = await c.GetStagePosition()
+
+    Requests are sent on a single DEALER socket tagged with a request id,
+    so any number of commands can be in flight at the same time and each
+    reply is matched to the coroutine waiting for it. Cancelling the
+    awaiting task or hitting the per call timeout only drops the pending
+    request, a late reply is discarded.
+    """
+
+    def __init__(self, host, port = 3535, verbose = True, codec = 'auto', client_name = None,
+                 retry_policy : RetryPolicy = None):
+        self.host = host
+        self.port = port
+        self.verbose = verbose
+        self.client_name = client_name or _default_client_name()
+        self.retry_policy = retry_policy
+        self._retry_stats = {'retries': 0, 'busy_retries': 0, 'lane_busy_retries': 0}
+        self._single_flight = None
+        self._lock = threading.Lock()
+        self._codec = None if codec == 'auto' else available_codecs()[codec]
+        self._negotiated = False
+        self._legacy_server = False
+        self._latency = LatencyStats()
+        self._stats_dumper = None
+        self._telemetry = None
+        self._tracer = None
+        self._recorder = None
+        self._heartbeat = None
+        self._sync_context = None
+        self._context = zmq.asyncio.Context()
+        self._socket = self._context.socket(zmq.DEALER)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.connect(f"tcp://{self.host}:{self.port}")
+        self._ids = itertools.count()
+        self._pending = {}
+        self._receiver = None
+        self._stats = {
+            'requests': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'late_replies': 0,
+            'max_in_flight': 0,
+            'hedged': 0,
+            'hedge_wins': 0,
+        }
+        if self.verbose:
+            print(f"AsyncTEMClient:endpoint: {self.host}:{self.port}")
+
+    def close(self) -> None:
+        """
+        Close the socket and fail all pending requests
+        """
+        self.unsubscribe()
+        self.stop_heartbeat()
+        self.stop_stats_dump()
+        self.stop_recording()
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        for fut in self._pending.values():
+            if not fut.done():
+                fut.cancel()
+        self._pending.clear()
+        self._socket.close(linger=0)
+        self._context.term()
+        if self._sync_context is not None:
+            self._sync_context.term()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def subscribe(self, port = 3536, max_age_s = None) -> None:
+        """
+        Subscribe to the telemetry stream, see TEMClient.subscribe. The
+        subscriber runs in its own thread with a separate context.
+        """
+        self.unsubscribe()
+        if self._sync_context is None:
+            self._sync_context = zmq.Context()
+        self._telemetry = TelemetrySubscriber(self._sync_context, f"tcp://{self.host}:{port}", max_age_s)
+
+    @property
+    def connection_stats(self) -> dict:
+        s = dict(self._stats)
+        s['in_flight'] = len(self._pending)
+        return s
+
+    async def _receive_loop(self):
+        while True:
+            req_id, _, *reply = await self._socket.recv_multipart()
+            fut = self._pending.pop(req_id, None)
+            if fut is None or fut.done():
+                self._stats['late_replies'] += 1
+                continue
+            fut.set_result(reply)
+
+    async def _send_message(self, cmd, *args, timeout_ms = 5000):
+        if not self._negotiated:
+            codec = await self._negotiate(timeout_ms)
+            if self._codec is None:
+                self._codec = codec
+            self._negotiated = True
+        if self.retry_policy is None:
+            return await self._request(self._codec, cmd, args, timeout_ms)
+        policy = self.retry_policy
+        safe = is_safe(cmd)
+        attempt = 0
+        lane_busy = False
+        while True:
+            attempt_timeout, hedge_after = timeout_ms, None
+            if safe and not lane_busy:
+                attempt_timeout = policy.timeout_ms(self._latency, cmd, timeout_ms, attempt)
+                hedge_after = policy.hedge_after_ms(self._latency, cmd, attempt_timeout)
+            try:
+                return await self._request(self._codec, cmd, args, attempt_timeout, hedge_after)
+            except ServerBusyError:
+                if attempt >= policy.retries:
+                    raise
+                self._retry_stats['busy_retries'] += 1
+            except TimeoutError:
+                if not safe or lane_busy or attempt >= policy.retries:
+                    raise
+                lane_busy = cmd != 'ping' and await self._server_alive(policy, timeout_ms)
+                self._retry_stats['lane_busy_retries' if lane_busy else 'retries'] += 1
+            await asyncio.sleep(policy.backoff(attempt))
+            attempt += 1
+
+    async def _server_alive(self, policy, timeout_ms):
+        """
+        Ping the server after a timeout, see TEMClient._server_alive
+        """
+        try:
+            return await self._request(self._codec, "ping", (), policy.timeout_ms(self._latency, "ping", timeout_ms)) == "pong"
+        except (TimeoutError, RuntimeError):
+            return False
+
+    async def _negotiate(self, timeout_ms):
+        try:
+            caps = await self._request(JsonCodec(), "capabilities", (), timeout_ms)
+        except RuntimeError as e:
+            #Only a server that does not know the command is legacy, BUSY or
+            #any other error is raised and the handshake tried again
+            if isinstance(e, ServerBusyError) or "not implemented" not in str(e):
+                raise
+            caps = None
+            self._legacy_server = True
+        if self._legacy_server and self._codec is not None and self._codec.name != 'json':
+            #Binary codecs need the header frame
+            raise RuntimeError(f"{self.host}:{self.port} has no codec handshake and only "
+                               f"understands json, not {self._codec.name}")
+        return select_codec(caps and caps['codecs'])
+
+    async def _request(self, codec, cmd, args, timeout_ms, hedge_after_ms = None):
+        if self._receiver is None or self._receiver.done():
+            self._receiver = asyncio.ensure_future(self._receive_loop())
+
+        t0 = time.perf_counter()
+        trace = self._new_trace()
+        frames = self._encode_request(codec, cmd, args, trace)
+        req_id = next(self._ids).to_bytes(8, 'little')
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = fut
+        self._stats['requests'] += 1
+        self._stats['max_in_flight'] = max(self._stats['max_in_flight'], len(self._pending))
+        try:
+            #The empty frame delimits the envelope, the server returns the
+            #request id in front of the reply
+            await self._socket.send_multipart([req_id, b''] + frames)
+            if hedge_after_ms is None:
+                reply = await asyncio.wait_for(fut, timeout_ms/1000)
+            else:
+                reply = await self._hedged_reply(fut, frames, timeout_ms, hedge_after_ms)
+        except asyncio.TimeoutError:
+            self._stats['timeouts'] += 1
+            self._latency.record(cmd, {'total': time.perf_counter() - t0}, error = True)
+            if trace is not None:
+                self._tracer.record(trace, cmd, time.time(), error = True)
+            self._record(cmd, args, timeout_ms, t0, 'TIMEOUT')
+            raise TimeoutError(f"Timeout while waiting for reply from {self.host}:{self.port}")
+        except asyncio.CancelledError:
+            self._stats['cancelled'] += 1
+            raise
+        finally:
+            self._pending.pop(req_id, None)
+        try:
+            message = self._handle_reply(codec, cmd, reply, trace)
+        except RuntimeError as e:
+            self._latency.record(cmd, {'total': time.perf_counter() - t0}, error = True)
+            self._record(cmd, args, timeout_ms, t0, 'BUSY' if isinstance(e, ServerBusyError) else 'ERROR', str(e))
+            raise
+        self._latency.record(cmd, {'total': time.perf_counter() - t0})
+        self._record(cmd, args, timeout_ms, t0, 'OK', message)
+        return message
+
+    def _stream_id(self):
+        return id(asyncio.current_task())
+
+    async def _hedged_reply(self, fut, frames, timeout_ms, hedge_after_ms):
+        """
+        Wait for fut and, if there is no reply after hedge_after_ms, send
+        the same request again with a new id. The first reply is returned,
+        the other one is discarded as a late reply.
+        """
+        t_end = time.perf_counter() + timeout_ms/1000
+        try:
+            return await asyncio.wait_for(asyncio.shield(fut), hedge_after_ms/1000)
+        except asyncio.TimeoutError:
+            pass
+        self._stats['hedged'] += 1
+        req_id = next(self._ids).to_bytes(8, 'little')
+        hedge = asyncio.get_running_loop().create_future()
+        self._pending[req_id] = hedge
+        try:
+            await self._socket.send_multipart([req_id, b''] + frames)
+            done, _ = await asyncio.wait([fut, hedge], timeout = max(0.0, t_end - time.perf_counter()),
+                                         return_when = asyncio.FIRST_COMPLETED)
+        finally:
+            self._pending.pop(req_id, None)
+        if not done:
+            raise asyncio.TimeoutError()
+        if fut in done:
+            return fut.result()
+        self._stats['hedge_wins'] += 1
+        return hedge.result()
+
+    # Commands that post process the reply need their own coroutine,
+    # everything else returns the coroutine from _send_message directly
+
+    async def ping(self, timeout_ms = None) -> bool:
+        if timeout_ms is None:
+            timeout_ms = TEMClient._ping_timeout
+        try:
+            rep = await self._send_message("ping", timeout_ms=timeout_ms)
+            return rep == "pong"
+        except TimeoutError:
+            return False
+
+    @property
+    def is_alive(self):
+        return self._is_alive()
+
+    async def _is_alive(self):
+        if self._heartbeat is not None:
+            health = self._heartbeat.health
+            if health.checked is not None:
+                return health.alive
+        return await self.ping()
+
+    async def check_version(self):
+        return await self.server_version == self.client_version
+
+    def batch(self, timeout_ms = 5000) -> AsyncBatch:
+        return AsyncBatch(self, timeout_ms = timeout_ms)
+
+    def setpoint_writer(self, on_applied = None) -> AsyncSetpointWriter:
+        """
+        Setpoint writer running as a task on the current event loop, see
+        AsyncSetpointWriter
+        """
+        return AsyncSetpointWriter(self, on_applied)
+
+    async def wait_until_rotate_starts(self, max_time_s = 2):
+        if self._telemetry is not None:
+            started = await asyncio.get_running_loop().run_in_executor(
+                None, self._telemetry.wait_for, lambda state: state['status'][3] == 1, max_time_s)
+        else:
+            started = await self.WaitForRotationStart(max_time_s)
+        if not started:
+            raise TimeoutError(f"Rotation did not start after {max_time_s:2f} seconds")
+
+    @property
+    def is_rotating(self):
+        return self._is_rotating()
+
+    async def _is_rotating(self):
+        state = self.telemetry
+        if state is not None:
+            return state['status'][3] == 1
+        n_retries = 3
+        for i in range(n_retries):
+            try:
+                return (await self._send_message('GetStageStatus'))[3] == 1
+            except Exception:
+                await asyncio.sleep(0.1)
+        raise TimeoutError(f"Could not get stage status after {n_retries} retries")
+
+    async def _start(self, cmd, *args) -> AsyncStageOperation:
+        return AsyncStageOperation(self, await self._send_message(cmd, *args))
+
+    async def state(self, fields = None) -> TEMState:
+        return TEMState.from_dict(await self.GetState(fields))
+
+    async def trajectory(self, since = 0.0) -> Trajectory:
+        return Trajectory.from_reply(await self.GetTrajectory(since))
+
+    async def GetTiltXAngle(self) -> float:
+        state = self.telemetry
+        if state is not None:
+            return state['position'][3]
+        return (await self._send_message('GetStagePosition'))[3]
@@ -1,57 +1,854 @@
 import zmq
 import json
+import contextlib
+import contextvars
 from rich import print
+from .codec import JsonCodec, available_codecs, select_codec
+from .state import TEMState
+from .trajectory import Trajectory
+from .stats import LatencyStats, StatsDumper
+from .tracing import Tracer
+from .heartbeat import Heartbeat, Health
+from .retry import RetryPolicy, is_safe
+from .coalesce import SingleFlight, SetpointWriter
+from .recorder import SessionRecorder
 from datetime import datetime
+import os
+import socket
+import threading
 import time
+import traceback
+
+
+#Set by TEMClient.fresh_reads(), priority() and coalesce_setpoints(), per
+#thread and asyncio task
+_fresh_reads = contextvars.ContextVar('fresh_reads', default = False)
+_priority = contextvars.ContextVar('priority', default = None)
+_coalesce = contextvars.ContextVar('coalesce', default = False)
+
+
+class ServerBusyError(RuntimeError):
+    """
+    The server rejected the request because too many requests are queued
+    for the same subsystem, retry later
+    """
+
+
+def _default_client_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class _Connection:
+    """
+    Long lived REQ socket to the server. A REQ socket that timed out waiting
+    for its reply is stuck in the receive state, so after a timeout only the
+    socket is closed and a fresh one is opened on the next request.
+    """
+    def __init__(self, context, endpoint):
+        self.context = context
+        self.endpoint = endpoint
+        self.socket = None
+        self.n_requests = 0 #requests sent on the current socket
+
+    def _open(self):
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.endpoint)
+        self.n_requests = 0
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close(linger=0)
+            self.socket = None
+
+    def send(self, frames, timeout_ms):
+        if self.socket is None:
+            self._open()
+        self.socket.setsockopt(zmq.SNDTIMEO, timeout_ms)
+        self.socket.setsockopt(zmq.RCVTIMEO, timeout_ms)
+        try:
+            self.socket.send_multipart(frames)
+        except zmq.error.Again:
+            self.close()
+            raise
+
+    def request(self, frames, timeout_ms):
+        self.send(frames, timeout_ms)
+        try:
+            reply = self.socket.recv_multipart()
+        except zmq.error.Again:
+            self.close()
+            raise
+        self.n_requests += 1
+        return reply
+
+
+class ConnectionPool:
+    """
+    Pool of persistent connections to one server endpoint. Connections are
+    opened on demand and kept for the lifetime of the pool instead of setting
+    up and tearing down a socket for every command.
+    """
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.context = zmq.Context()
+        self._idle = []
+        self._lock = threading.Lock()
+        self._stats = {
+            'requests': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'timeouts': 0,
+            'first_rtt_s': 0.0,
+            'reused_rtt_s': 0.0,
+            'hedged': 0,
+            'hedge_wins': 0,
+        }
+
+    def _acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        return _Connection(self.context, self.endpoint)
+
+    def _release(self, conn):
+        with self._lock:
+            self._idle.append(conn)
+
+    def request(self, frames, timeout_ms):
+        conn = self._acquire()
+        try:
+            fresh = conn.socket is None
+            t0 = time.perf_counter()
+            try:
+                reply = conn.request(frames, timeout_ms)
+            except zmq.error.Again:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                    if not fresh:
+                        self._stats['reconnects'] += 1
+                raise
+            rtt = time.perf_counter() - t0
+            with self._lock:
+                self._stats['requests'] += 1
+                if fresh:
+                    self._stats['connects'] += 1
+                    self._stats['first_rtt_s'] += rtt
+                else:
+                    self._stats['reused_rtt_s'] += rtt
+            return reply
+        finally:
+            self._release(conn)
+
+    def hedged_request(self, frames, timeout_ms, hedge_after_ms):
+        """
+        Send on one connection and, if there is no reply after
+        hedge_after_ms, send the same frames on a second one. The first
+        reply is returned. The connection still waiting is closed since a
+        REQ socket can not drop an outstanding request.
+        """
+        t_end = time.perf_counter() + timeout_ms/1000
+        conns = [self._acquire()]
+        fresh = [conns[0].socket is None]
+        poller = zmq.Poller()
+        winner = None
+        try:
+            conns[0].send(frames, timeout_ms)
+            poller.register(conns[0].socket, zmq.POLLIN)
+            ready = dict(poller.poll(hedge_after_ms))
+            if not ready:
+                conns.append(self._acquire())
+                fresh.append(conns[1].socket is None)
+                conns[1].send(frames, timeout_ms)
+                poller.register(conns[1].socket, zmq.POLLIN)
+                with self._lock:
+                    self._stats['hedged'] += 1
+                ready = dict(poller.poll(max(0, int((t_end - time.perf_counter())*1000))))
+            for conn in conns:
+                if conn.socket in ready:
+                    winner = conn
+                    break
+            if winner is None:
+                with self._lock:
+                    self._stats['timeouts'] += 1
+                raise zmq.error.Again()
+            reply = winner.socket.recv_multipart()
+            winner.n_requests += 1
+            with self._lock:
+                self._stats['requests'] += 1
+                if fresh[conns.index(winner)]:
+                    self._stats['connects'] += 1
+                if winner is not conns[0]:
+                    self._stats['hedge_wins'] += 1
+            return reply
+        finally:
+            for conn in conns:
+                if conn is not winner:
+                    conn.close()
+                self._release(conn)
+
+    @property
+    def stats(self) -> dict:
+        """
+        Connection reuse statistics. saved_s is an estimate of the time saved
+        by reusing sockets: number of reused requests times the difference in
+        mean round trip between requests on fresh and on reused sockets.
+        """
+        with self._lock:
+            s = dict(self._stats)
+            s['open_connections'] = sum(c.socket is not None for c in self._idle)
+        s['reused'] = s['requests'] - s['connects']
+        mean_first = s['first_rtt_s'] / s['connects'] if s['connects'] else 0.0
+        mean_reused = s['reused_rtt_s'] / s['reused'] if s['reused'] else 0.0
+        s['saved_s'] = max(0.0, mean_first - mean_reused) * s['reused']
+        return s
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+        self.context.term()
+
+
+class TelemetrySubscriber:
+    """
+    Background subscriber to the server telemetry stream. Keeps the latest
+    published state (position, status, beam_blank, t) so that it can be
+    read without a request to the server.
+    """
+    def __init__(self, context, endpoint, max_age_s = None):
+        self.endpoint = endpoint
+        self.max_age_s = max_age_s
+        self.n_received = 0
+        self._state = None
+        self._received = 0.0
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._socket = context.socket(zmq.SUB)
+        self._socket.setsockopt(zmq.LINGER, 0)
+        self._socket.setsockopt(zmq.SUBSCRIBE, b'stage')
+        self._socket.connect(endpoint)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        poller = zmq.Poller()
+        poller.register(self._socket, zmq.POLLIN)
+        while not self._stop.is_set():
+            if poller.poll(100):
+                _, msg = self._socket.recv_multipart()
+                state = json.loads(msg)
+                with self._cond:
+                    self._state = state
+                    self._received = time.monotonic()
+                    self.n_received += 1
+                    self._cond.notify_all()
+        self._socket.close()
+
+    def _max_age(self, state):
+        if self.max_age_s is not None:
+            return self.max_age_s
+        #The server publishes at least every keepalive_s even if nothing changes
+        return 2*state['keepalive_s'] + state['period_s']
+
+    @property
+    def state(self):
+        """
+        Latest state or None if nothing fresh has been received
+        """
+        with self._cond:
+            state = self._state
+            if state is None or time.monotonic() - self._received > self._max_age(state):
+                return None
+            return state
+
+    def invalidate(self, received_before = None):
+        """
+        Forget the cached state, called after commands that change the stage
+        so that only samples taken after the command are used. With
+        received_before a sample that arrived after that time (monotonic)
+        is kept, the server publishes right after replying to such commands.
+        """
+        with self._cond:
+            if received_before is None or self._received < received_before:
+                self._state = None
+
+    def wait_for(self, predicate, timeout):
+        """
+        Wait until predicate(state) is true for a received state.
+        Returns False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while self._state is None or not predicate(self._state):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+
+
+class Batch:
+    """
+    Collects commands and sends them to the server in a single request.
+    Commands are recorded using the server side names and the arguments
+    are passed on unchanged. Use through TEMClient.batch():
+
+    with c.batch() as b:
+        b.GetStagePosition()
+        b.GetMagValue()
+    pos, mag = b.results
+
+    Each entry in results is either the returned value or a RuntimeError
+    if that command failed on the server.
+    """
+    def __init__(self, client, timeout_ms = 5000):
+        self._client = client
+        self._calls = []
+        self.timeout_ms = timeout_ms
+        self.results = None
+
+    def __getattr__(self, cmd):
+        if cmd.startswith('_'):
+            raise AttributeError(cmd)
+        def add(*args):
+            self._calls.append([cmd, list(args)])
+            return len(self._calls) - 1
+        return add
+
+    def __len__(self):
+        return len(self._calls)
+
+    def execute(self) -> list:
+        """
+        Send all collected commands and return the list of results
+        """
+        if self._calls:
+            reply = self._client._send_message("batch", *self._calls, timeout_ms=self.timeout_ms)
+        else:
+            reply = []
+        self.results = [value if status == "OK" else RuntimeError(f"{status}:{value}")
+                        for status, value in reply]
+        self._calls = []
+        return self.results
+
+    @property
+    def errors(self) -> list:
+        """
+        (index, exception) for the commands that failed
+        """
+        return [(i, r) for i, r in enumerate(self.results or []) if isinstance(r, Exception)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.execute()
+
+
+class StageOperation:
+    """
+    Handle for a stage move started with one of the TEMClient.Start*
+    commands. The server follows the stage until it stopped:
+
+    op = c.StartTiltXAngle(30)
+    ... # do something else
+    op.wait(60)
+    op.state     # 'done', 'stopped', 'cancelled', 'replaced', 'error' or 'timeout'
+    op.position  # stage position when the move finished
+    """
+    _wait_chunk_s = 60.0
+
+    def __init__(self, client, op_id):
+        self._client = client
+        self.id = op_id
+        self.status = {'id': op_id, 'state': 'running'}
+
+    def __repr__(self):
+        return f"StageOperation(id={self.id}, state={self.state})"
+
+    @property
+    def state(self) -> str:
+        return self.status['state']
+
+    def _finished(self):
+        return self.status['state'] != 'running'
+
+    def refresh(self) -> dict:
+        if not self._finished():
+            self.status = self._client._send_message("GetOperation", self.id)
+        return self.status
+
+    def done(self) -> bool:
+        return self.refresh()['state'] != 'running'
+
+    def wait(self, timeout = None) -> bool:
+        """
+        Block until the move finished, returns False if it was still
+        running after timeout seconds (None waits forever)
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._finished():
+            chunk = self._wait_chunk_s if deadline is None else min(self._wait_chunk_s, deadline - time.monotonic())
+            if chunk <= 0:
+                break
+            self.status = self._client._send_message("WaitOperation", self.id, chunk,
+                                                     timeout_ms = self._client._wait_timeout_ms(chunk))
+        return self._finished()
+
+    def cancel(self) -> bool:
+        """
+        Stop the stage if the move is still running, returns True if it was
+        """
+        cancelled = self._client._send_message("CancelOperation", self.id)
+        self.refresh()
+        return cancelled
+
+    @property
+    def position(self) -> list:
+        """
+        Stage position when the move finished, waits for it
+        """
+        self.wait()
+        return self.status['position']
+
 
 class TEMClient:
     _ping_timeout = 1000 #1s
     encoding = 'ascii'
     _version_str = '2024.8.30' #TODO! Auto update
 
-    def __init__(self, host, port = 3535, verbose = True):
+    #Commands that change what the telemetry stream reports
+    _telemetry_invalidated_by = ('SetZRel', 'SetXRel', 'SetYRel', 'SetTXRel', 'SetTiltXAngle',
+                                 'Setf1OverRateTxNum', 'StopStage', 'SetBeamBlank', 'batch',
+                                 'StartZRel', 'StartXRel', 'StartYRel', 'StartTXRel',
+                                 'StartTiltXAngle', 'CancelOperation')
+
+    def __init__(self, host, port = 3535, verbose = True, codec = 'auto', client_name = None,
+                 retry_policy : RetryPolicy = None, coalesce_window_s : float = None):
+        """
+        A TEMClient can be shared between threads, each request uses its
+        own pooled connection.
+
+        codec: 'auto' to negotiate the most compact wire format supported
+        by both sides on the first request, or one of 'json', 'struct',
+        'msgpack' to force it
+        client_name: shown in the per client statistics of the server,
+        default hostname:pid
+        retry_policy: retries, adaptive timeouts and hedging for commands
+        that are safe to repeat, see RetryPolicy. Default off.
+        coalesce_window_s: None (default) sends every request. 0 lets
+        concurrent identical reads from several threads share one request
+        and its result, with > 0 a result is also reused for reads started
+        up to that many seconds after its request. Any other command
+        through this client discards the kept results.
+        """
         self.host = host
         self.port = port
         self.verbose = verbose
+        self.client_name = client_name or _default_client_name()
+        self.retry_policy = retry_policy
+        self._retry_stats = {'retries': 0, 'busy_retries': 0, 'lane_busy_retries': 0}
+        self._single_flight = None if coalesce_window_s is None else SingleFlight(coalesce_window_s)
+        self._lock = threading.Lock()
+        self._codec = None if codec == 'auto' else available_codecs()[codec]
+        self._negotiated = False
+        self._legacy_server = False
+        self._latency = LatencyStats()
+        self._stats_dumper = None
+        self._pool = ConnectionPool(f"tcp://{self.host}:{self.port}")
+        self._telemetry = None
+        self._tracer = None
+        self._recorder = None
+        self._heartbeat = None
         if self.verbose:
             print(f"TEMClient:endpoint: {self.host}:{self.port}")
 
+    def close(self) -> None:
+        """
+        Close all connections to the server
+        """
+        self.unsubscribe()
+        self.stop_heartbeat()
+        self.stop_stats_dump()
+        self.stop_recording()
+        self._pool.close()
+
+    def server_stats(self) -> dict:
+        """
+        Latency histograms per command and phase (recv, decode, queue, call,
+        encode, send) measured on the server, the read cache counters,
+        requests/rejections/queue waits per client name, the number of
+        requests queued per lane and the coalesced setpoint counters
+        """
+        return self._send_message("stats")
+
+    def client_stats(self) -> dict:
+        """
+        End-to-end latency per command as seen by this client
+        """
+        return self._latency.summary()
+
+    def start_trace(self) -> Tracer:
+        """
+        Trace every following request: the header carries a trace id and
+        the send time, the server logs the id and returns its receive,
+        start and end times. Export with stop_trace(path).
+        """
+        self._tracer = Tracer()
+        return self._tracer
+
+    def stop_trace(self, path = None) -> Tracer:
+        """
+        Stop tracing and write the spans as a Chrome trace (JSON) to path,
+        open it in chrome://tracing or https://ui.perfetto.dev
+        """
+        tracer, self._tracer = self._tracer, None
+        if tracer is not None and path is not None:
+            tracer.export(path)
+        return tracer
+
+    def start_recording(self, path) -> SessionRecorder:
+        """
+        Append every following request with its reply, send time and
+        latency to the binary session log at path. Play it back with:
+
+        python -m simple_tem.replay path --speed 1
+        """
+        self.stop_recording()
+        self._recorder = SessionRecorder(path)
+        return self._recorder
+
+    def stop_recording(self) -> None:
+        recorder, self._recorder = self._recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def start_stats_dump(self, path, interval_s = 60.0) -> None:
+        """
+        Append client_stats() as a JSON line to path every interval_s seconds
+        """
+        self.stop_stats_dump()
+        self._stats_dumper = StatsDumper(self.client_stats, path, interval_s)
+
+    def stop_stats_dump(self) -> None:
+        if self._stats_dumper is not None:
+            self._stats_dumper.stop()
+            self._stats_dumper = None
+
+    def subscribe(self, port = 3536, max_age_s = None) -> None:
+        """
+        Subscribe to the server telemetry stream (tem-server.py --telemetry-port).
+        While subscribed is_rotating, GetTiltXAngle and wait_until_rotate_starts
+        are answered from the latest received state. If no state newer than
+        max_age_s is available they fall back to a request.
+        """
+        self.unsubscribe()
+        self._telemetry = TelemetrySubscriber(self._pool.context, f"tcp://{self.host}:{port}", max_age_s)
+
+    def unsubscribe(self) -> None:
+        if self._telemetry is not None:
+            self._telemetry.close()
+            self._telemetry = None
+
+    @property
+    def telemetry(self):
+        """
+        Latest telemetry state as a dict with t, position, status and
+        beam_blank, None if not subscribed or no fresh state
+        """
+        if self._telemetry is None:
+            return None
+        return self._telemetry.state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def connection_stats(self) -> dict:
+        """
+        Statistics on connection reuse, see ConnectionPool.stats
+        """
+        return self._pool.stats
+
+    @property
+    def retry_stats(self) -> dict:
+        """
+        Retries after timeouts (safe commands only), after BUSY replies and
+        lane_busy_retries: timeouts on a server that still answered a ping
+        """
+        with self._lock:
+            return dict(self._retry_stats)
+
+    @property
+    def coalesce_stats(self) -> dict:
+        """
+        Reads sent, shared with a request in flight (coalesced) and answered
+        inside the freshness window, None if coalescing is off
+        """
+        return None if self._single_flight is None else self._single_flight.stats
+
+    @property
+    def codec(self):
+        """
+        Name of the wire codec in use, None until negotiated
+        """
+        return None if self._codec is None else self._codec.name
 
     def _send_message(self, cmd, *args, timeout_ms = 5000):
-        
-        cmd = cmd.encode(TEMClient.encoding)
-        args = json.dumps(args).encode(TEMClient.encoding)
-        if self.verbose:
-            print(f'[spring_green4]{self._now()} - REQ: {cmd}, {args}[/spring_green4]')
+        if not self._negotiated:
+            with self._lock:
+                if not self._negotiated:
+                    codec = self._negotiate(timeout_ms)
+                    if self._codec is None:
+                        self._codec = codec
+                    self._negotiated = True
+        flights = self._single_flight
+        if flights is None:
+            return self._send(cmd, args, timeout_ms)
+        if not is_safe(cmd):
+            try:
+                return self._send(cmd, args, timeout_ms)
+            finally:
+                #Reads from before the command may be outdated
+                flights.clear()
+        if _fresh_reads.get():
+            return self._send(cmd, args, timeout_ms)
+        return flights.call((cmd, repr(args), _priority.get()), lambda: self._send(cmd, args, timeout_ms))
 
-        context = zmq.Context()
-        socket = context.socket(zmq.REQ)
-        socket.setsockopt(zmq.SNDTIMEO, timeout_ms)
-        socket.setsockopt(zmq.RCVTIMEO, timeout_ms)
-        socket.setsockopt(zmq.LINGER, 0)
-        socket.connect(f"tcp://{self.host}:{self.port}")
+    def _send(self, cmd, args, timeout_ms):
+        """
+        Send one command, retried according to the retry policy
+        """
+        if self.retry_policy is None:
+            return self._request(self._codec, cmd, args, timeout_ms)
+        policy = self.retry_policy
+        safe = is_safe(cmd)
+        attempt = 0
+        lane_busy = False
+        while True:
+            attempt_timeout, hedge_after = timeout_ms, None
+            if safe and not lane_busy:
+                attempt_timeout = policy.timeout_ms(self._latency, cmd, timeout_ms, attempt)
+                hedge_after = policy.hedge_after_ms(self._latency, cmd, attempt_timeout)
+            try:
+                return self._request(self._codec, cmd, args, attempt_timeout, hedge_after)
+            except ServerBusyError:
+                if attempt >= policy.retries:
+                    raise
+                with self._lock:
+                    self._retry_stats['busy_retries'] += 1
+            except TimeoutError:
+                if not safe or lane_busy or attempt >= policy.retries:
+                    raise
+                lane_busy = cmd != 'ping' and self._server_alive(policy, timeout_ms)
+                with self._lock:
+                    self._retry_stats['lane_busy_retries' if lane_busy else 'retries'] += 1
+            time.sleep(policy.backoff(attempt))
+            attempt += 1
 
+    def _server_alive(self, policy, timeout_ms):
+        """
+        True if the server answers a ping after a safe command timed out.
+        The command is then queued behind a slow one on its lane (e.g. a
+        blocking stage move) and resending it with the short adaptive
+        timeout would only queue more copies, so it is sent once more with
+        the full timeout of the call instead.
+        """
         try:
-            socket.send_multipart([cmd, args])
-            reply = socket.recv_multipart()
-            status, message = self._decode_reply(reply)
-            if self.verbose:
-                print(f'[dark_orange3]{self._now()} - REP: {status}:{message}[/dark_orange3]')
-            self._check_error(status, message)
-        
+            return self._request(self._codec, "ping", (), policy.timeout_ms(self._latency, "ping", timeout_ms)) == "pong"
+        except (TimeoutError, RuntimeError):
+            return False
+
+    def _negotiate(self, timeout_ms):
+        #Sent as a plain two frame request, a server without the handshake
+        #exits on anything else
+        try:
+            caps = self._request(JsonCodec(), "capabilities", (), timeout_ms)
+        except RuntimeError as e:
+            #Only a server that does not know the command is legacy, BUSY or
+            #any other error is raised and the handshake tried again
+            if isinstance(e, ServerBusyError) or "not implemented" not in str(e):
+                raise
+            #Server without the handshake, stay with JSON and never
+            #send a header frame since it would not understand it
+            caps = None
+            self._legacy_server = True
+        if self._legacy_server and self._codec is not None and self._codec.name != 'json':
+            #Binary codecs need the header frame
+            raise RuntimeError(f"{self.host}:{self.port} has no codec handshake and only "
+                               f"understands json, not {self._codec.name}")
+        return select_codec(caps and caps['codecs'])
+
+    def _request_header(self):
+        """
+        Per request options sent in the header frame, None until the server
+        answered the handshake and for servers without it
+        """
+        if self._legacy_server or not self._negotiated:
+            return None
+        header = {'client': self.client_name}
+        if _fresh_reads.get():
+            header['fresh'] = True
+        priority = _priority.get()
+        if priority is not None:
+            header['priority'] = priority
+        if _coalesce.get():
+            header['coalesce'] = True
+        return header
+
+    @contextlib.contextmanager
+    def fresh_reads(self):
+        """
+        Bypass the server side read cache for requests made inside the block:
+
+        with c.fresh_reads():
+            mag = c.GetMagValue()
+        """
+        token = _fresh_reads.set(True)
+        try:
+            yield
+        finally:
+            _fresh_reads.reset(token)
+
+    @contextlib.contextmanager
+    def priority(self, level):
+        """
+        Queue priority on the server for requests made inside the block,
+        'high', 'normal' (default) or 'low'. StopStage and SetBeamBlank(1)
+        always go first.
+
+        with c.priority('low'):
+            c.GetState()
+        """
+        if level not in ('high', 'normal', 'low'):
+            raise ValueError(f"Unknown priority: {level}")
+        token = _priority.set(level)
+        try:
+            yield
+        finally:
+            _priority.reset(token)
+
+    @contextlib.contextmanager
+    def coalesce_setpoints(self):
+        """
+        Let the server coalesce SetILFocus, SetILs and Setf1OverRateTxNum
+        made inside the block: of the values still waiting for the hardware
+        only the newest is applied, a value equal to the last applied one
+        is skipped and every call returns the value that was applied.
+
+        with c.coalesce_setpoints():
+            applied = c.SetILFocus(value)
+        """
+        token = _coalesce.set(True)
+        try:
+            yield
+        finally:
+            _coalesce.reset(token)
+
+    def setpoint_writer(self, on_applied = None) -> SetpointWriter:
+        """
+        Background writer for setpoints sent faster than the microscope
+        applies them (e.g. from a slider), see SetpointWriter:
+
+        w = c.setpoint_writer()
+        w.set('SetILFocus', value)  # never blocks, only the newest value is sent
+        """
+        return SetpointWriter(self, on_applied)
+
+    def cache_stats(self) -> dict:
+        """
+        Hit/miss counters of the server side read cache, None if disabled
+        """
+        return self._send_message("cache_stats")
+
+    def _request(self, codec, cmd, args, timeout_ms, hedge_after_ms = None):
+        t0 = time.perf_counter()
+        trace = self._new_trace()
+        frames = self._encode_request(codec, cmd, args, trace)
+        try:
+            if hedge_after_ms is None:
+                reply = self._pool.request(frames, timeout_ms)
+            else:
+                reply = self._pool.hedged_request(frames, timeout_ms, hedge_after_ms)
         except zmq.error.Again:
+            self._latency.record(cmd, {'total': time.perf_counter() - t0}, error = True)
+            if trace is not None:
+                self._tracer.record(trace, cmd, time.time(), error = True)
+            self._record(cmd, args, timeout_ms, t0, 'TIMEOUT')
             raise TimeoutError(f"Timeout while waiting for reply from {self.host}:{self.port}")
-        
-        finally:
-            socket.disconnect(f"tcp://{self.host}:{self.port}")
-            context.destroy()
-        
+        try:
+            message = self._handle_reply(codec, cmd, reply, trace)
+        except RuntimeError as e:
+            self._latency.record(cmd, {'total': time.perf_counter() - t0}, error = True)
+            self._record(cmd, args, timeout_ms, t0, 'BUSY' if isinstance(e, ServerBusyError) else 'ERROR', str(e))
+            raise
+        self._latency.record(cmd, {'total': time.perf_counter() - t0})
+        self._record(cmd, args, timeout_ms, t0, 'OK', message)
+        return message
+
+    def _record(self, cmd, args, timeout_ms, t0, status, reply = None):
+        recorder = self._recorder
+        if recorder is None:
+            return
+        try:
+            recorder.record(cmd, args, timeout_ms, t0, time.perf_counter(), status, reply, self._stream_id())
+        except Exception:
+            #The command already ran on the microscope, a broken session
+            #log only stops the recording
+            if self._recorder is recorder:
+                self._recorder = None
+            traceback.print_exc()
+            print(f"Warning: session recording stopped, could not record {cmd}")
+            with contextlib.suppress(Exception):
+                recorder.close()
+
+    def _stream_id(self):
+        return threading.get_ident()
+
+    def _new_trace(self):
+        if self._tracer is None or self._legacy_server or not self._negotiated:
+            return None
+        return self._tracer.new_trace()
+
+    def _encode_request(self, codec, cmd, args, trace = None):
+        header = self._request_header()
+        if trace is not None:
+            header['trace'] = trace
+        if self.verbose:
+            trace_id = '' if trace is None else f" trace={trace['id']}"
+            print(f'[spring_green4]{self._now()} - REQ: {cmd}, {list(args)}{trace_id}[/spring_green4]')
+        return codec.encode_request(cmd, args, header)
+
+    def _handle_reply(self, codec, cmd, reply, trace = None):
+        t_reply = time.monotonic()
+        server = None
+        if len(reply) == 3:
+            #Server timestamps of a traced request
+            server = json.loads(reply[2])
+            reply = reply[:2]
+        status, message = codec.decode_reply(cmd, reply)
+        if trace is not None:
+            self._tracer.record(trace, cmd, time.time(), server, error = status != "OK")
+        if self.verbose:
+            print(f'[dark_orange3]{self._now()} - REP: {status}:{message}[/dark_orange3]')
+        self._check_error(status, message)
+        if self._telemetry is not None and cmd in TEMClient._telemetry_invalidated_by:
+            self._telemetry.invalidate(received_before = t_reply)
         return message
 
-    def _decode_reply(self, reply):
-        return (json.loads(r) for r in reply)
-  
     def _check_error(self, status, message):
+        if status == "BUSY":
+            raise ServerBusyError(f"{status}:{message}")
         if status != "OK":
             raise RuntimeError(f"{status}:{message}")
         
@@ -77,29 +874,71 @@ class TEMClient:
 
     @property
     def is_alive(self):
+        """
+        With a heartbeat running the cached state, otherwise (or before its
+        first ping finished) a ping
+        """
+        if self._heartbeat is not None:
+            health = self._heartbeat.health
+            if health.checked is not None:
+                return health.alive
         return self.ping()
 
+    def start_heartbeat(self, interval_s = 1.0, on_change = None, max_interval_s = 30.0) -> Heartbeat:
+        """
+        Ping the server in the background on a separate connection, so that
+        is_alive and health answer without a request. While the server is
+        down the interval backs off up to max_interval_s. on_change(health)
+        is called from the heartbeat thread with the first result and then
+        when the server goes up or down. The pings carry the same header as
+        the requests of this client, none for servers without the handshake.
+        """
+        self.stop_heartbeat()
+        self._heartbeat = Heartbeat(f"tcp://{self.host}:{self.port}", interval_s,
+                                    self._ping_timeout/1000, max_interval_s, on_change,
+                                    self._request_header)
+        return self._heartbeat
+
+    def stop_heartbeat(self) -> None:
+        if self._heartbeat is not None:
+            self._heartbeat.close()
+            self._heartbeat = None
+
+    @property
+    def health(self) -> Health:
+        """
+        Latest server health from the heartbeat (alive, rtt_s, last_seen,
+        checked, failures), None without a heartbeat
+        """
+        return None if self._heartbeat is None else self._heartbeat.health
+
     def sleep(self) -> None:
-        self._send_message("sleep")
+        return self._send_message("sleep")
 
     def wait_until_rotate_starts(self, max_time_s = 2):
-        t0 = time.perf_counter()
-        while True:
-            try:
-                if self.is_rotating:
-                    break
-            except Exception: #Catch all exceptions
-                pass
-            if time.perf_counter() - t0 > max_time_s:
-                raise TimeoutError(f"Rotation did not start after {max_time_s:2f} seconds")
-        
+        """
+        Wait until the rotation started. Answered from the telemetry stream
+        if subscribed otherwise by the server (WaitForRotationStart)
+        """
+        if self._telemetry is not None:
+            started = self._telemetry.wait_for(lambda state: state['status'][3] == 1, max_time_s)
+        else:
+            started = self.WaitForRotationStart(max_time_s)
+        if not started:
+            raise TimeoutError(f"Rotation did not start after {max_time_s:2f} seconds")
 
+    def batch(self, timeout_ms = 5000) -> Batch:
+        """
+        Collect several commands and execute them in one round trip,
+        see Batch for details
+        """
+        return Batch(self, timeout_ms = timeout_ms)
 
     def exit_server(self) -> None:
         """
         Exit the server
         """
-        self._send_message("exit_server")
+        return self._send_message("exit_server")
 
     @property
     def server_version(self) -> str:
@@ -118,6 +957,47 @@ class TEMClient:
         """
         return self._send_message("UnknownFunction")
 
+    # --------------------- STATE ---------------------
+
+    def GetState(self, fields = None) -> dict:
+        """
+        Read the microscope state in one request, see state()
+        """
+        if fields is None:
+            return self._send_message("GetState")
+        return self._send_message("GetState", list(fields))
+
+    def state(self, fields = None) -> TEMState:
+        """
+        Full microscope state in one round trip: stage position and status,
+        function mode, mag, spot size, alpha, lens values, ILs, PLA,
+        beam blank and aperture sizes.
+
+        fields: optional list of field names (see TEMState.field_names())
+        to only read what is needed:
+
+        c.state(['stage_position', 'beam_blank'])
+        """
+        return TEMState.from_dict(self.GetState(fields))
+
+    def GetTrajectory(self, since : float = 0.0) -> dict:
+        """
+        Tilt angle samples recorded by the server after since, see trajectory()
+        """
+        return self._send_message("GetTrajectory", since)
+
+    def trajectory(self, since : float = 0.0) -> Trajectory:
+        """
+        Tilt angle samples the server recorded while the stage moved,
+        sampled at --trajectory-rate. Fetch only new samples by passing
+        next from the previous call:
+
+        traj = c.trajectory()
+        ...
+        traj.extend(c.trajectory(traj.next))
+        """
+        return Trajectory.from_reply(self.GetTrajectory(since))
+
     # --------------------- STAGE ---------------------
         
     def GetStagePosition(self):
@@ -147,6 +1027,9 @@ class TEMClient:
     
     @property
     def is_rotating(self):
+        state = self.telemetry
+        if state is not None:
+            return state['status'][3] == 1
         n_retries = 3
         for i in range(n_retries):
             try:
@@ -161,39 +1044,42 @@ class TEMClient:
         Relative move along Z axis.
         Range:+-100000.0(nm)
         """
-        self._send_message("SetZRel", val)
+        return self._send_message("SetZRel", val)
     
     def SetXRel(self, val : float) -> None:
         """
         Relative move along Z axis.
         Range:+-100000.0(nm)
         """
-        self._send_message("SetXRel", val)
+        return self._send_message("SetXRel", val)
 
     def SetYRel(self, val : float) -> None:
         """
         Relative move along Z axis.
         Range:+-100000.0(nm)
         """
-        self._send_message("SetYRel", val)
+        return self._send_message("SetYRel", val)
 
     def SetTXRel(self, val : float) -> None:
         """
         Relative tilt around X axis.
         tilt-x relative value. range is +-90.00.0(degree)
         """
-        self._send_message("SetTXRel", val)
+        return self._send_message("SetTXRel", val)
 
     def SetTiltXAngle(self, val) -> None:
         """
         Set TiltX axis absolute value. range is +-90.00(degree)
         """
-        self._send_message("SetTiltXAngle", val)
+        return self._send_message("SetTiltXAngle", val)
 
     def GetTiltXAngle(self) -> float:
         """
         Get the  Tilt angle, alias for StagePos[3]
         """
+        state = self.telemetry
+        if state is not None:
+            return state['position'][3]
         return self._send_message('GetStagePosition')[3]
 
     def Getf1OverRateTxNum(self):
@@ -207,7 +1093,7 @@ class TEMClient:
         """
         Set drive frequency f1 of TiltX.
         """
-        self._send_message("Setf1OverRateTxNum", val)
+        return self._send_message("Setf1OverRateTxNum", val)
         
     def GetMovementValueMeasurementMethod(self):
         """
@@ -218,7 +1104,87 @@ class TEMClient:
 
     def StopStage(self) -> None:
         """Stop all the drives."""
-        self._send_message("StopStage")
+        return self._send_message("StopStage")
+
+    # Non blocking moves, each returns a StageOperation right away. The
+    # Set* commands above are unchanged.
+
+    def _start(self, cmd, *args) -> StageOperation:
+        return StageOperation(self, self._send_message(cmd, *args))
+
+    def StartZRel(self, val : float) -> StageOperation:
+        return self._start("StartZRel", val)
+
+    def StartXRel(self, val : float) -> StageOperation:
+        return self._start("StartXRel", val)
+
+    def StartYRel(self, val : float) -> StageOperation:
+        return self._start("StartYRel", val)
+
+    def StartTXRel(self, val : float) -> StageOperation:
+        return self._start("StartTXRel", val)
+
+    def StartTiltXAngle(self, val : float) -> StageOperation:
+        return self._start("StartTiltXAngle", val)
+
+    def _wait_timeout_ms(self, timeout):
+        #Give the server time to reply after its own timeout expired
+        return int(timeout*1000) + 1000
+
+    def WaitForRotationStart(self, timeout = 2.0) -> bool:
+        """
+        Block until the TiltX rotation started, polled on the server.
+        Returns False if it did not start within timeout seconds
+        """
+        return self._send_message("WaitForRotationStart", timeout,
+                                  timeout_ms = self._wait_timeout_ms(timeout))
+
+    def WaitForStageIdle(self, timeout = 60.0) -> bool:
+        """
+        Block until no drive is moving, polled on the server.
+        Returns False if the stage was still moving after timeout seconds
+        """
+        return self._send_message("WaitForStageIdle", timeout,
+                                  timeout_ms = self._wait_timeout_ms(timeout))
+
+    def WaitForAngle(self, target, tol = 0.1, timeout = 60.0) -> bool:
+        """
+        Block until the TiltX angle is within tol degrees of target,
+        polled on the server. Returns False on timeout
+        """
+        return self._send_message("WaitForAngle", target, tol, timeout,
+                                  timeout_ms = self._wait_timeout_ms(timeout))
+
+    def RunSequence(self, steps) -> int:
+        """
+        Upload a list of steps that the server executes on its own, each
+        step is [command, arg, ...] with the commands SetTiltXAngle, SetTXRel,
+        Setf1OverRateTxNum, SetBeamBlank, SetZRel, SetXRel, SetYRel,
+        WaitForRotationStart, WaitForStageIdle, WaitForAngle and
+        Dwell (seconds). Returns the sequence id, StopStage aborts it.
+
+        c.RunSequence([['SetBeamBlank', 1], ['SetTiltXAngle', 10],
+                       ['WaitForStageIdle', 60], ['SetBeamBlank', 0], ['Dwell', 0.5]])
+        status = c.WaitForSequence(120)
+        """
+        return self._send_message("RunSequence", [list(step) for step in steps])
+
+    def GetSequenceStatus(self) -> dict:
+        """
+        Progress of the last sequence: id, state (running, done, aborted,
+        error, timeout), step, n_steps, started, finished, error (message
+        of an unexpected failure) and log with [start, end, command, args,
+        status, result] per executed step
+        """
+        return self._send_message("GetSequenceStatus")
+
+    def WaitForSequence(self, timeout = 60.0) -> dict:
+        """
+        Block until the last sequence finished or timeout seconds passed,
+        returns the sequence status
+        """
+        return self._send_message("WaitForSequence", timeout,
+                                  timeout_ms = self._wait_timeout_ms(timeout))
 
 
 
@@ -247,14 +1213,14 @@ class TEMClient:
         [On TEM Observation] 0=MAG, 1=MAG2, 2= LowMAG, 3= SAMAG, 4= DIFF
         [On STEM Observation] 0= Align, 1= SM-LMAG, 2= SM-MAG, 3= AMAG, 4= uuDIFF, 5= Rocking
         """
-        self._send_message("SelectFunctionMode", mode)
+        return self._send_message("SelectFunctionMode", mode)
 
         
     def SetSelector(self, value : int) -> None:
         """
          (int) mag or camera length or rocking angle number value.
         """
-        self._send_message("SetSelector", value)
+        return self._send_message("SetSelector", value)
 
     def GetSpotSize(self) -> int:
         """
@@ -276,7 +1242,7 @@ class TEMClient:
         Set IL-focus value(without MAG link).
         IL-focus value.(0-65535)
         """
-        self._send_message("SetILFocus", value)
+        return self._send_message("SetILFocus", value)
 
 
     def GetCL3(self) -> int:
@@ -329,7 +1295,7 @@ class TEMClient:
         Set ILStig value. The variable corresponds to I/O output value.
         (x_axis : int, y_axis : int) 0-65535
         """
-        self._send_message("SetILs", stig_x, stig_y)
+        return self._send_message("SetILs", stig_x, stig_y)
         
         
         
@@ -350,7 +1316,7 @@ class TEMClient:
         """
         blanking status. 0=OFF, 1=ON
         """
-        self._send_message("SetBeamBlank", val)
+        return self._send_message("SetBeamBlank", val)
     
 
     # END DEF
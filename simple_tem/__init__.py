@@ -1 +1,6 @@
-from .TEMClient import TEMClient
\ No newline at end of file
+from .TEMClient import TEMClient, Batch, StageOperation, TelemetrySubscriber, ServerBusyError
+from .AsyncTEMClient import AsyncTEMClient, AsyncBatch, AsyncStageOperation
+from .heartbeat import Health
+from .retry import RetryPolicy
+from .state import TEMState
+from .trajectory import Trajectory
\ No newline at end of file
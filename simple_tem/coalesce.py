@@ -0,0 +1,205 @@
+"""
+Request coalescing in TEMClient: single-flight sharing of identical reads
+made by several threads and a latest-wins writer for setpoints.
+"""
+import copy
+import threading
+import time
+import traceback
+
+
+class _Flight:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Concurrent calls with the same key share one call of fn: the first
+    caller runs it, the others wait for its result or exception. With
+    window_s > 0 a result is also returned to calls made up to window_s
+    after the call that produced it was started. Every caller gets its own
+    copy of the result so that they can not change each other's.
+    """
+    def __init__(self, window_s = 0.0):
+        self.window_s = window_s
+        self._lock = threading.Lock()
+        self._flights = {}
+        self._recent = {} #key -> (monotonic start time, value)
+        self._generation = 0 #incremented by clear()
+        self._stats = {
+            'requests': 0,
+            'coalesced': 0,
+            'window_hits': 0,
+        }
+
+    def call(self, key, fn):
+        with self._lock:
+            if self.window_s > 0:
+                recent = self._recent.get(key)
+                if recent is not None and time.monotonic() - recent[0] <= self.window_s:
+                    self._stats['window_hits'] += 1
+                    return copy.deepcopy(recent[1])
+            flight = self._flights.get(key)
+            if flight is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                flight = self._flights[key] = _Flight()
+                self._stats['requests'] += 1
+                leader = True
+            generation = self._generation
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return copy.deepcopy(flight.value)
+
+        t0 = time.monotonic()
+        try:
+            flight.value = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight.error is None and self.window_s > 0 and generation == self._generation:
+                    self._prune(time.monotonic())
+                    self._recent[key] = (t0, flight.value)
+            flight.done.set()
+        return copy.deepcopy(flight.value)
+
+    def _prune(self, now):
+        #Called with _lock held, keeps _recent to the keys read within the window
+        expired = [key for key, (t0, _) in self._recent.items() if now - t0 > self.window_s]
+        for key in expired:
+            del self._recent[key]
+
+    def clear(self) -> None:
+        """
+        Forget the results kept for the freshness window
+        """
+        with self._lock:
+            self._recent.clear()
+            self._generation += 1
+
+    @property
+    def stats(self) -> dict:
+        """
+        requests: calls that went to the server, coalesced: calls that
+        shared a request in flight, window_hits: calls answered with a
+        result inside the freshness window
+        """
+        with self._lock:
+            return dict(self._stats)
+
+
+class SetpointWriter:
+    """
+    Latest-wins writer for absolute setpoints, for values that are set
+    faster than the microscope applies them. set() only stores the value,
+    a background thread sends the newest value per command with the
+    coalesce_setpoints() header, so values set while a write is in flight
+    replace each other. on_applied(cmd, value, error) is called from the
+    writer thread after each write.
+
+    w = c.setpoint_writer()
+    for value in slider_values:
+        w.set('SetILFocus', value)
+    w.flush()
+    w.applied['SetILFocus']
+    """
+    commands = ('SetILFocus', 'SetILs', 'Setf1OverRateTxNum')
+
+    def __init__(self, client, on_applied = None):
+        self._client = client
+        self.on_applied = on_applied
+        self.applied = {} #cmd -> value applied by the server
+        self.errors = {} #cmd -> exception of the last failed write
+        self._pending = {}
+        self._sending = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._stats = {'set': 0, 'sent': 0, 'replaced': 0}
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def set(self, cmd, *args) -> None:
+        if cmd not in SetpointWriter.commands:
+            raise ValueError(f"{cmd} is not an absolute setpoint, use one of {SetpointWriter.commands}")
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("SetpointWriter is closed")
+            self._stats['set'] += 1
+            if cmd in self._pending:
+                self._stats['replaced'] += 1
+            self._pending[cmd] = args
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                cmd = next(iter(self._pending))
+                args = self._pending.pop(cmd)
+                self._sending = True
+            value, error = None, None
+            try:
+                with self._client.coalesce_setpoints():
+                    value = self._client._send_message(cmd, *args)
+            except Exception as e:
+                error = e
+            with self._cond:
+                if error is None:
+                    self.applied[cmd] = value
+                    self.errors.pop(cmd, None)
+                else:
+                    self.errors[cmd] = error
+                self._stats['sent'] += 1
+                self._sending = False
+                self._cond.notify_all()
+            if self.on_applied is not None:
+                try:
+                    self.on_applied(cmd, value, error)
+                except Exception:
+                    traceback.print_exc()
+
+    def flush(self, timeout = None) -> bool:
+        """
+        Wait until all values set so far were written, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._pending and not self._sending, timeout)
+
+    @property
+    def stats(self) -> dict:
+        """
+        set: calls to set(), sent: writes sent to the server, replaced:
+        values replaced by a newer one before they were sent
+        """
+        with self._cond:
+            return dict(self._stats)
+
+    def close(self) -> None:
+        """
+        Write the values still pending and stop the writer thread
+        """
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,154 @@
+"""
+Wire codecs negotiated between TEMClient and TEMServer.
+
+json     the original format, used with servers that don't support the
+         capabilities handshake. A header frame is only added to the
+         request if there are options like fresh to send
+struct   fixed layout struct packing for the common numeric replies and
+         JSON for everything else, no extra dependencies
+msgpack  fixed layout struct packing for the common numeric replies and
+         msgpack for everything else, requires msgpack on both sides
+
+With the binary codecs the status is sent as plain ascii and the payload
+is prefixed with a one byte tag telling how it was packed. The server
+keeps its own copy of this in tem-server.py since it is standalone.
+"""
+import json
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+encoding = 'ascii'
+
+#Replies with a fixed layout, packed with struct when the codec allows it
+FIXED_LAYOUTS = {
+    'GetStagePosition': struct.Struct('<5d'),
+    'GetStageStatus': struct.Struct('<5b'),
+    'Getf1OverRateTxNum': struct.Struct('<i'),
+    'GetSpotSize': struct.Struct('<i'),
+    'GetAlpha': struct.Struct('<i'),
+    'GetCL3': struct.Struct('<i'),
+    'GetIL1': struct.Struct('<i'),
+    'GetIL3': struct.Struct('<i'),
+    'GetOLf': struct.Struct('<i'),
+    'GetOLc': struct.Struct('<i'),
+    'GetILs': struct.Struct('<2i'),
+    'GetPLA': struct.Struct('<2i'),
+    'GetBeamBlank': struct.Struct('<i'),
+}
+
+TAG_STRUCT = b's'
+TAG_JSON = b'j'
+TAG_MSGPACK = b'm'
+
+
+class JsonCodec:
+    name = 'json'
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj).encode(encoding)
+
+    def decode(self, data : bytes):
+        return json.loads(data)
+
+    def encode_request(self, cmd, args, header = None):
+        frames = [cmd.encode(encoding), self.encode(args)]
+        if header:
+            frames.append(json.dumps(header).encode(encoding))
+        return frames
+
+    def encode_reply(self, cmd, status, value):
+        return [self.encode(status), self.encode(value)]
+
+    def decode_reply(self, cmd, reply):
+        status, value = reply
+        return self.decode(status), self.decode(value)
+
+
+class _BinaryCodec:
+    name = None
+    tag = None
+
+    def encode_request(self, cmd, args, header = None):
+        #Always three frames, the server needs the codec name. The client
+        #refuses binary codecs for servers without the handshake.
+        if header:
+            header = json.dumps(dict(header, codec=self.name)).encode(encoding)
+        else:
+            header = self.header
+        return [cmd.encode(encoding), self.encode(args), header]
+
+    def encode_reply(self, cmd, status, value):
+        if status == 'OK' and cmd in FIXED_LAYOUTS:
+            values = value if isinstance(value, (list, tuple)) else (value,)
+            try:
+                return [b'OK', TAG_STRUCT + FIXED_LAYOUTS[cmd].pack(*values)]
+            except struct.error:
+                #Unexpected reply from PyJEM, send it with the generic codec
+                pass
+        return [status.encode(encoding), self.tag + self.encode(value)]
+
+    def decode_reply(self, cmd, reply):
+        status, payload = reply
+        status = status.decode(encoding)
+        tag, data = payload[:1], payload[1:]
+        if tag == TAG_STRUCT:
+            value = FIXED_LAYOUTS[cmd].unpack(data)
+            value = value[0] if len(value) == 1 else list(value)
+        elif tag == TAG_JSON:
+            value = json.loads(data)
+        else:
+            value = msgpack.unpackb(data, raw=False)
+        return status, value
+
+
+class StructCodec(_BinaryCodec):
+    name = 'struct'
+    tag = TAG_JSON
+    header = b'{"codec": "struct"}'
+
+    def encode(self, obj) -> bytes:
+        return json.dumps(obj).encode(encoding)
+
+    def decode(self, data : bytes):
+        return json.loads(data)
+
+
+class MsgpackCodec(_BinaryCodec):
+    name = 'msgpack'
+    tag = TAG_MSGPACK
+    header = b'{"codec": "msgpack"}'
+
+    def encode(self, obj) -> bytes:
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data : bytes):
+        return msgpack.unpackb(data, raw=False)
+
+
+def available_codecs() -> dict:
+    """
+    Codecs usable in this environment, in order of preference
+    """
+    codecs = {}
+    if msgpack is not None:
+        codecs['msgpack'] = MsgpackCodec()
+    codecs['struct'] = StructCodec()
+    codecs['json'] = JsonCodec()
+    return codecs
+
+
+def select_codec(server_codecs) -> object:
+    """
+    Pick the preferred codec supported by both sides, server_codecs is
+    None if the server does not support the handshake
+    """
+    codecs = available_codecs()
+    if server_codecs:
+        for name, codec in codecs.items():
+            if name in server_codecs:
+                return codec
+    return codecs['json']
@@ -1,60 +1,250 @@
-
+import math
+import threading
 import time
-from threading import Thread
 
-#Needed to synchronize values between processes
-import redis
+
+class RealClock:
+    """
+    Wall clock time, comparable between processes sharing a redis store
+    """
+    def now(self):
+        return time.time()
+
+    def sleep(self, dt):
+        time.sleep(dt)
+
+
+class ScaledClock(RealClock):
+    """
+    Wall clock running scale times faster, to run the dummy stage faster
+    than the real microscope
+    """
+    def __init__(self, scale):
+        self.scale = scale
+        self._t0 = time.time()
+
+    def now(self):
+        return self._t0 + (time.time() - self._t0)*self.scale
+
+    def sleep(self, dt):
+        time.sleep(dt/self.scale)
+
+
+class VirtualClock:
+    """
+    Time only moves when advance() or sleep() is called, a full tilt
+    series runs without waiting
+    """
+    def __init__(self, t = 0.0):
+        self._lock = threading.Lock()
+        self._t = t
+
+    def now(self):
+        return self._t
+
+    def advance(self, dt):
+        with self._lock:
+            self._t += dt
+
+    def sleep(self, dt):
+        self.advance(dt)
+
 
 class PyJEM_DummyConf:
+    """
+    Where the dummy keeps the values that we pretend to send to the
+    microscope. 'memory' keeps them in this process, 'redis' in a redis
+    server on redis_port so that several processes see the same state.
+    clock drives the stage motion. Change before the first TEM3 object
+    is created.
+    """
+    store = 'memory'
+    redis_host = 'localhost'
     redis_port = 5454
+    clock = RealClock()
+
+
+#The tilt is stored as a move: from x_start_angle at x_start_t towards
+#x_target at x_speed degrees per second, the current angle is computed
+_defaults = {
+    'x_start_t': 0.0,
+    'x_start_angle': 0.0,
+    'x_target': 0.0,
+    'x_speed': 10.0,
+    'x_move_id': 0,
+    'f1OverRateTxNum': 0,
+    'beam_blank': 0,
+}
+
+
+class MemoryStore:
+    """
+    Thread-safe values for a single server process
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def get(self, key):
+        return self._values[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
 
-def redis_init():
-    r = redis.Redis(port = PyJEM_DummyConf.redis_port)
-    if r.get("x_angle") is None:
-        r.set("x_angle", 0)
-    if r.get("f1OverRateTxNum") is None:
-        r.set("f1OverRateTxNum", 0)
-    if r.get("x_is_rotating") is None:
-        r.set("x_is_rotating", 0)
-    if r.get("beam_blank") is None:
-        r.set("beam_blank", 0)
-    if r.get("stop_stage") is None:
-        r.set("stop_stage", 0)
-redis_init()
+    def setdefault(self, key, value):
+        with self._lock:
+            self._values.setdefault(key, value)
+
+    def incr(self, key, delta):
+        with self._lock:
+            self._values[key] += delta
+            return self._values[key]
+
+    def get_many(self, keys):
+        with self._lock:
+            return [self._values[key] for key in keys]
+
+    def set_many(self, values):
+        with self._lock:
+            self._values.update(values)
+
+
+class RedisStore:
+    """
+    Values shared between processes through redis, redis is only imported
+    and connected when the store is created
+    """
+    def __init__(self, host = 'localhost', port = 5454):
+        import redis
+        self.store = redis.Redis(host = host, port = port)
+
+    def get(self, key):
+        return float(self.store.get(key))
+
+    def set(self, key, value):
+        self.store.set(key, value)
+
+    def setdefault(self, key, value):
+        self.store.setnx(key, value)
+
+    def incr(self, key, delta):
+        #INCRBY only takes integers and fails on a value stored as a float
+        if isinstance(delta, int):
+            return self.store.incr(key, delta)
+        return self.store.incrbyfloat(key, delta)
+
+    def get_many(self, keys):
+        return [float(value) for value in self.store.mget(keys)]
+
+    def set_many(self, values):
+        #MSET sets all keys in one round trip and atomically
+        self.store.mset(values)
+
+def new_store(kind = 'memory'):
+    """
+    Create a store and fill in the values that are not set yet
+    """
+    if kind == 'memory':
+        store = MemoryStore()
+    elif kind == 'redis':
+        store = RedisStore(PyJEM_DummyConf.redis_host, PyJEM_DummyConf.redis_port)
+    else:
+        raise ValueError("Unknown dummy store: {}".format(kind))
+    for key, value in _defaults.items():
+        store.setdefault(key, value)
+    return store
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    """
+    The store selected in PyJEM_DummyConf, created on first use
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = new_store(PyJEM_DummyConf.store)
+        return _store
 
 
 class Stage3:
     _degrees_per_second = [10, 2, 1, 0.5, 0.25, 0.1]
+    _move_keys = ('x_start_t', 'x_start_angle', 'x_target', 'x_speed')
+    #Read-compute-write of the move, only guards this process
+    _move_lock = threading.RLock()
 
-    def __init__(self):
-        self.redis = redis.Redis(port = PyJEM_DummyConf.redis_port)
+    def __init__(self, clock = None, store = None):
+        self.store = store if store is not None else get_store()
+        self.clock = clock if clock is not None else PyJEM_DummyConf.clock
 
-    def _rotate(self, target_angle):
-        current_angle = float(self.redis.get("x_angle"))
-        if current_angle == target_angle:
-            return
-        else:
-            n_steps = 50
-            step = (target_angle-current_angle) / n_steps
-            self.redis.set("stop_stage", 0) #potential race condition
-            self.redis.set("x_is_rotating", 1)
-            for i in range(n_steps):
-                self.redis.incrbyfloat("x_angle", step)
-                print("rotate: incremented x_angle by ", step)
-                #Read speed each time to account for changes
-                t = abs(step/self._degrees_per_second[self.Getf1OverRateTxNum()])
-                time.sleep(t)
-                if int(self.redis.get("stop_stage")):
-                    self.redis.set("stop_stage", 0)
-                    print("rotate: stage stopped")
-                    break
-            self.redis.set("x_is_rotating", 0)
+    def _position(self, now = None):
+        """
+        Current tilt angle and whether the stage is still moving
+        """
+        if now is None:
+            now = self.clock.now()
+        start_t, start_angle, target, speed = self.store.get_many(self._move_keys)
+        distance = target - start_angle
+        travelled = speed*(now - start_t)
+        if abs(distance) <= travelled:
+            return target, False
+        return start_angle + math.copysign(travelled, distance), True
+
+    def _move(self, target = None, speed = None):
+        """
+        Replace the current move with one starting from the current angle,
+        target None stops where the stage is. Returns the move id.
+        """
+        with Stage3._move_lock:
+            now = self.clock.now()
+            angle, _ = self._position(now)
+            if speed is None:
+                speed = self.store.get('x_speed')
+            self.store.set_many({
+                'x_start_t': now,
+                'x_start_angle': angle,
+                'x_target': angle if target is None else target,
+                'x_speed': speed,
+            })
+            return self.store.incr('x_move_id', 1)
+
+    def _set_speed(self, speed):
+        """
+        Continue the current move, if any, from where it is with the new
+        speed. The move keeps its id so a blocking move waiting on it is
+        not cancelled.
+        """
+        with Stage3._move_lock:
+            now = self.clock.now()
+            angle, _ = self._position(now)
+            self.store.set_many({
+                'x_start_t': now,
+                'x_start_angle': angle,
+                'x_speed': speed,
+            })
+
+    def _wait_for_move(self, move_id, poll_s = 0.01):
+        """
+        Block until the move is done or replaced by another one
+        """
+        while True:
+            now = self.clock.now()
+            start_t, start_angle, target, speed = self.store.get_many(self._move_keys)
+            if self.store.get('x_move_id') != move_id:
+                return
+            remaining = abs(target - start_angle)/speed - (now - start_t)
+            if remaining <= 0:
+                return
+            self.clock.sleep(min(remaining, poll_s))
 
     def GetPos(self):
-        return [1.1, 1.2, 1.3, float(self.redis.get('x_angle')), 1.5]
+        return [1.1, 1.2, 1.3, self._position()[0], 1.5]
     
     def GetStatus(self):
-        return [0,0,0,int(self.redis.get("x_is_rotating")),0]
+        return [0,0,0,int(self._position()[1]),0]
     
     def SetZRel(self, value):
         if not isinstance(value, (float, int)):
@@ -74,29 +264,28 @@ class Stage3:
     def SetTXRel(self, value):
         if not isinstance(value, (float, int)):
             raise ValueError("SetTXReal needs a float or int")
-        current_angle = float(self.redis.get("x_angle"))
-        self._rotate(current_angle + value)
+        self._wait_for_move(self._move(self._position()[0] + value))
     
     def SetTiltXAngle(self, val):
-        #TODO! deal with concurrent access
-        t = Thread(target=self._rotate, args=(val,))
-        t.start()
-        # self._rotate(val)
+        self._move(val)
     
     def Getf1OverRateTxNum(self) -> int:
         #0= 10(/sec), 1= 2(/sec), 2= 1(/sec), 3= 0.5(/sec), 4= 0.25(/sec), 5= 0.1(/sec)
-        return int(self.redis.get("f1OverRateTxNum"))
+        return int(self.store.get("f1OverRateTxNum"))
 
     def Setf1OverRateTxNum(self, val):
         #0= 10(/sec), 1= 2(/sec), 2= 1(/sec), 3= 0.5(/sec), 4= 0.25(/sec), 5= 0.1(/sec)
-        self.redis.set("f1OverRateTxNum", val)
+        if not isinstance(val, int) or not 0 <= val < len(self._degrees_per_second):
+            raise ValueError("Setf1OverRateTxNum needs an int from 0 to {}".format(len(self._degrees_per_second) - 1))
+        with Stage3._move_lock:
+            self.store.set("f1OverRateTxNum", val)
+            self._set_speed(self._degrees_per_second[val])
 
     def GetMovementValueMeasurementMethod(self):
         return 0
     
     def Stop(self):
-        if int(self.redis.get("x_is_rotating")):
-            self.redis.set("stop_stage", 1)
+        self._move()
     
     
     
@@ -153,7 +342,7 @@ class Lens3:
 
 class Def3:
     def __init__(self):
-        self.redis = redis.Redis(port = PyJEM_DummyConf.redis_port)
+        self.store = get_store()
 
     def SetILs(self, stig_x, stig_y):
         if not isinstance(stig_x, int):
@@ -172,10 +361,10 @@ class Def3:
     def SetBeamBlank(self, val):
         if not isinstance(val, int):
             raise ValueError
-        self.redis.set("beam_blank", val)
+        self.store.set("beam_blank", val)
     
     def GetBeamBlank(self):
-        return int(self.redis.get("beam_blank"))
+        return int(self.store.get("beam_blank"))
     
 class Apt3:
     def __init__(self):
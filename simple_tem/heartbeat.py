@@ -0,0 +1,119 @@
+"""
+Background heartbeat keeping a cached view of the server health, so that
+checking if the server is alive never blocks.
+"""
+import threading
+import time
+import traceback
+from dataclasses import dataclass, replace
+from typing import Callable, Optional
+
+import zmq
+
+from .codec import JsonCodec
+
+
+@dataclass(frozen=True)
+class Health:
+    """
+    Server health as seen by the heartbeat. last_seen and checked are
+    time.time() of the last reply and the last ping, failures counts the
+    pings without reply since the last one that got one. checked is None
+    until the first ping finished, alive is not known before that.
+    """
+    alive: bool = False
+    rtt_s: Optional[float] = None
+    last_seen: Optional[float] = None
+    checked: Optional[float] = None
+    failures: int = 0
+
+
+class Heartbeat:
+    """
+    Ping the server every interval_s on a separate connection. While the
+    server is down the interval doubles after each failed ping up to
+    max_interval_s. on_change(health) is called from the heartbeat thread
+    with the first result and then when alive changes. header() returns
+    the header frame of each ping, None (or no header) to send two frames.
+    """
+    def __init__(self, endpoint, interval_s = 1.0, timeout_s = 1.0, max_interval_s = 30.0,
+                 on_change : Callable[[Health], None] = None,
+                 header : Callable[[], Optional[dict]] = None):
+        self.endpoint = endpoint
+        self.interval_s = interval_s
+        self.timeout_s = timeout_s
+        self.max_interval_s = max_interval_s
+        self.on_change = on_change
+        self._header = header
+        self._codec = JsonCodec()
+        self._health = Health()
+        self._cond = threading.Condition()
+        self._stop = threading.Event()
+        self._context = zmq.Context()
+        self._socket = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def health(self) -> Health:
+        return self._health
+
+    def _ping(self):
+        """
+        Round trip time in seconds or None on timeout. A REQ socket is
+        unusable after a timeout so it is replaced.
+        """
+        if self._socket is None:
+            self._socket = self._context.socket(zmq.REQ)
+            self._socket.setsockopt(zmq.LINGER, 0)
+            self._socket.setsockopt(zmq.SNDTIMEO, int(self.timeout_s*1000))
+            self._socket.setsockopt(zmq.RCVTIMEO, int(self.timeout_s*1000))
+            self._socket.connect(self.endpoint)
+        frames = self._codec.encode_request('ping', [], None if self._header is None else self._header())
+        t0 = time.perf_counter()
+        try:
+            self._socket.send_multipart(frames)
+            self._socket.recv_multipart()
+        except zmq.error.Again:
+            self._socket.close(linger=0)
+            self._socket = None
+            return None
+        return time.perf_counter() - t0
+
+    def _run(self):
+        while not self._stop.is_set():
+            rtt = self._ping()
+            now = time.time()
+            previous = self._health
+            if rtt is None:
+                health = replace(previous, alive=False, checked=now, failures=previous.failures + 1)
+                delay = min(self.interval_s * 2**(health.failures - 1), self.max_interval_s)
+            else:
+                health = Health(alive=True, rtt_s=rtt, last_seen=now, checked=now, failures=0)
+                delay = self.interval_s
+            with self._cond:
+                self._health = health
+                self._cond.notify_all()
+            changed = previous.checked is None or health.alive != previous.alive
+            if changed and self.on_change is not None:
+                try:
+                    self.on_change(health)
+                except Exception:
+                    traceback.print_exc()
+            self._stop.wait(delay)
+        if self._socket is not None:
+            self._socket.close(linger=0)
+
+    def wait_for(self, alive = True, timeout = None) -> bool:
+        """
+        Block until the server is (alive=True) or is not (alive=False)
+        responding, False on timeout
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._health.alive == alive and self._health.checked is not None,
+                                       timeout)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        self._context.term()
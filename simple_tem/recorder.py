@@ -0,0 +1,113 @@
+"""
+Session recorder: every request of a TEMClient with its reply, send time
+and latency in a compact append-only binary log, read back with
+read_session() and played back with python -m simple_tem.replay.
+
+File layout: the MAGIC line followed by records of a fixed little endian
+header (_RECORD) and the command name, the arguments and the reply as
+compact JSON.
+"""
+import json
+import struct
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Iterator
+
+MAGIC = b'SIMPLETEM-SESSION 1\n'
+
+#t_send, latency_s, timeout_ms, status, stream, len(cmd), len(args), len(reply)
+_RECORD = struct.Struct('<ddIBIHII')
+
+STATUS = ('OK', 'ERROR', 'TIMEOUT', 'BUSY')
+
+
+def _dumps(value):
+    #Replies can hold raw bytes (GetTrajectory with msgpack), those are
+    #only kept as their repr
+    return json.dumps(value, separators=(',', ':'), default=repr).encode('utf-8')
+
+
+@dataclass
+class Record:
+    """
+    One request: t_send is the client time.time() when it was sent,
+    stream numbers the sending threads (or asyncio tasks) in order of
+    appearance, status is one of STATUS and reply the returned value or
+    the error message
+    """
+    t_send: float
+    latency_s: float
+    timeout_ms: int
+    status: str
+    stream: int
+    cmd: str
+    args: list
+    reply: Any
+
+
+class SessionRecorder:
+    """
+    Appends records to path through a write buffer of buffer_size bytes.
+    Thread safe, close() flushes the buffer.
+    """
+    def __init__(self, path, buffer_size = 1 << 16):
+        self.path = path
+        self.n_records = 0
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._file = open(path, 'ab', buffering=buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+        #Send times are measured with perf_counter and mapped to time.time()
+        self._t0 = time.time() - time.perf_counter()
+
+    def record(self, cmd, args, timeout_ms, t_start, t_end, status, reply, stream) -> None:
+        """
+        t_start and t_end are time.perf_counter() values, stream is any
+        hashable identifying the sender (thread id)
+        """
+        cmd_b = cmd.encode('utf-8')
+        args_b = _dumps(list(args))
+        reply_b = _dumps(reply)
+        with self._lock:
+            if self._file is None:
+                return
+            n = self._streams.setdefault(stream, len(self._streams))
+            self._file.write(_RECORD.pack(self._t0 + t_start, t_end - t_start, timeout_ms,
+                                          STATUS.index(status), n, len(cmd_b), len(args_b), len(reply_b)))
+            self._file.write(cmd_b + args_b + reply_b)
+            self.n_records += 1
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_session(path) -> Iterator[Record]:
+    """
+    Records of a session log in the order they were written. A record cut
+    short at the end of the file (recorder not closed) is skipped.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a session log")
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t_send, latency_s, timeout_ms, status, stream, n_cmd, n_args, n_reply = _RECORD.unpack(header)
+            body = f.read(n_cmd + n_args + n_reply)
+            if len(body) < n_cmd + n_args + n_reply:
+                return
+            yield Record(t_send, latency_s, timeout_ms, STATUS[status], stream,
+                         body[:n_cmd].decode('utf-8'),
+                         json.loads(body[n_cmd:n_cmd + n_args]),
+                         json.loads(body[n_cmd + n_args:]))
@@ -0,0 +1,145 @@
+"""
+Play a session log written by TEMClient.start_recording() back against a
+server, normally tem-server.py -d, and compare the latencies with the
+recorded ones:
+
+    python -m simple_tem.replay session.log --port 3535
+    python -m simple_tem.replay session.log --speed 10
+    python -m simple_tem.replay session.log --max-speed --concurrency 4 -o replay.json
+
+At original or scaled speed every request is sent at its recorded time
+(divided by speed) whether or not earlier requests were answered, so a
+slower server sees the same load as in the recording. With --max-speed
+requests are sent in recorded order as fast as the server answers, with
+at most --concurrency in flight.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from .AsyncTEMClient import AsyncTEMClient
+from .TEMClient import ServerBusyError
+from .recorder import read_session
+from .stats import Histogram
+
+#Negotiated by the replaying client itself or would end the replay
+_skipped = ('capabilities', 'exit_server')
+
+
+async def replay(records, host = 'localhost', port = 3535, speed = 1.0, concurrency = 1):
+    """
+    Send records to the server, speed None for maximum speed. Returns a
+    list of (record, latency_s, status) in the order the replies arrived
+    and the duration of the replay in seconds.
+    """
+    records = [r for r in records if r.cmd not in _skipped]
+    results = []
+    if not records:
+        return results, 0.0
+    async with AsyncTEMClient(host, port, verbose = False) as c:
+        await c.ping()
+
+        async def send(record):
+            t0 = time.perf_counter()
+            try:
+                await c._send_message(record.cmd, *record.args, timeout_ms = record.timeout_ms)
+                status = 'OK'
+            except ServerBusyError:
+                status = 'BUSY'
+            except TimeoutError:
+                status = 'TIMEOUT'
+            except RuntimeError:
+                status = 'ERROR'
+            results.append((record, time.perf_counter() - t0, status))
+
+        slots = asyncio.Semaphore(concurrency)
+        async def send_in_slot(record):
+            try:
+                await send(record)
+            finally:
+                slots.release()
+
+        tasks = []
+        t_start = time.perf_counter()
+        for record in records:
+            if speed is None:
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(send_in_slot(record)))
+            else:
+                delay = (record.t_send - records[0].t_send)/speed - (time.perf_counter() - t_start)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.ensure_future(send(record)))
+        await asyncio.gather(*tasks)
+        duration = time.perf_counter() - t_start
+    return results, duration
+
+
+def _summary(latencies):
+    h = Histogram()
+    for dt in latencies:
+        h.add(dt)
+    return h.summary()
+
+
+def compare(results) -> dict:
+    """
+    Recorded and replayed latency summary per command and for all
+    commands, the ratio replay/recorded of p50 and p99 and how many
+    requests ended with a different status than in the recording
+    """
+    by_cmd = {'all': results}
+    for r in results:
+        by_cmd.setdefault(r[0].cmd, []).append(r)
+    report = {}
+    for cmd, rs in by_cmd.items():
+        recorded = _summary(record.latency_s for record, _, _ in rs)
+        replayed = _summary(dt for _, dt, _ in rs)
+        report[cmd] = {
+            'recorded': recorded,
+            'replay': replayed,
+            'p50_ratio': replayed['p50_ms']/recorded['p50_ms'] if recorded['p50_ms'] else None,
+            'p99_ratio': replayed['p99_ms']/recorded['p99_ms'] if recorded['p99_ms'] else None,
+            'status_changed': sum(record.status != status for record, _, status in rs),
+        }
+    return report
+
+
+def print_report(report, duration):
+    print(f"{'command':<28}{'n':>7}{'recorded p50/p99 ms':>24}{'replay p50/p99 ms':>24}{'p50 x':>8}{'p99 x':>8}{'status':>8}")
+    for cmd, r in sorted(report.items(), key = lambda item: item[0] != 'all'):
+        rec, rep = r['recorded'], r['replay']
+        ratios = ''.join(f"{x:>8.2f}" if x is not None else f"{'-':>8}" for x in (r['p50_ratio'], r['p99_ratio']))
+        print(f"{cmd:<28}{rec['count']:>7}{rec['p50_ms']:>15.3f}/{rec['p99_ms']:<8.3f}"
+              f"{rep['p50_ms']:>15.3f}/{rep['p99_ms']:<8.3f}{ratios}{r['status_changed']:>8}")
+    print(f"replay took {duration:.2f} s")
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m simple_tem.replay', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='Session log from TEMClient.start_recording()')
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('-p', '--port', type=int, default=3535)
+    parser.add_argument('--speed', type=float, default=1.0, help='Replay speed, 1 is the recorded timing')
+    parser.add_argument('--max-speed', action='store_true', help='Send requests as fast as they are answered')
+    parser.add_argument('--concurrency', type=int, default=1, help='Requests in flight with --max-speed')
+    parser.add_argument('-o', '--output', default=None, help='Write the comparison as JSON to this file')
+    args = parser.parse_args()
+
+    records = list(read_session(args.log))
+    if not records:
+        sys.exit(f"No records in {args.log}")
+    results, duration = asyncio.run(replay(records, args.host, args.port,
+                                           None if args.max_speed else args.speed, args.concurrency))
+    report = compare(results)
+    print_report(report, duration)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'duration_s': duration, 'commands': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
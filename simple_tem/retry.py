@@ -0,0 +1,75 @@
+"""
+Retry policy for TEMClient: which commands may be sent again, the backoff
+between attempts and per command timeouts derived from observed latency.
+"""
+from dataclasses import dataclass
+from typing import Optional
+
+#Besides all Get* commands. Everything else may move the stage or change
+#the microscope and is never repeated after a timeout.
+_safe_commands = ('ping', 'version')
+
+
+def is_safe(cmd : str) -> bool:
+    """
+    True if sending cmd twice has the same effect as sending it once
+    """
+    return cmd.startswith('Get') or cmd in _safe_commands
+
+
+@dataclass
+class RetryPolicy:
+    """
+    retries: extra attempts after the first one. Safe commands (is_safe)
+    are retried on timeouts, every command is retried on ServerBusyError
+    since the server rejects those before running them.
+    backoff_s: sleep before the first retry, doubled for each further one
+    up to max_backoff_s.
+    timeout_factor: once min_samples calls of a safe command have been
+    seen, its timeout is timeout_factor times the p99 latency (at least
+    min_timeout_ms, doubled per attempt and never longer than the timeout
+    of the call). A safe command that times out while the server still
+    answers a ping is queued behind a slow command on its lane, e.g. a
+    blocking stage move. It is then sent only once more, with the full
+    timeout of the call, so a busy lane gets at most one extra copy of
+    each call.
+    hedge_percentile: if set, a safe command still without reply after
+    this latency percentile is sent a second time on another connection
+    and the first reply is used.
+    """
+    retries: int = 2
+    backoff_s: float = 0.005
+    max_backoff_s: float = 0.5
+    adaptive_timeouts: bool = True
+    timeout_factor: float = 4.0
+    min_timeout_ms: int = 50
+    min_samples: int = 20
+    hedge_percentile: Optional[float] = None
+
+    def backoff(self, attempt : int) -> float:
+        return min(self.backoff_s * 2**attempt, self.max_backoff_s)
+
+    def timeout_ms(self, latency, cmd, timeout_ms, attempt = 0) -> int:
+        """
+        Timeout for attempt (0 for the first) of cmd given the LatencyStats
+        of the client and the timeout of the call
+        """
+        if not self.adaptive_timeouts:
+            return timeout_ms
+        p99 = latency.percentile(cmd, 'total', 99, self.min_samples)
+        if p99 is None:
+            return timeout_ms
+        adaptive = max(self.timeout_factor*p99*1e3, self.min_timeout_ms) * 2**attempt
+        return int(min(adaptive, timeout_ms))
+
+    def hedge_after_ms(self, latency, cmd, timeout_ms) -> Optional[int]:
+        """
+        Time after which a second request is sent, None to not hedge
+        """
+        if self.hedge_percentile is None:
+            return None
+        t = latency.percentile(cmd, 'total', self.hedge_percentile, self.min_samples)
+        if t is None:
+            return None
+        hedge_after = max(1, int(t*1e3))
+        return hedge_after if hedge_after < timeout_ms else None
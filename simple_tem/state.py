@@ -0,0 +1,46 @@
+from dataclasses import dataclass, field, fields
+from typing import Dict, List, Optional
+
+
+@dataclass
+class TEMState:
+    """
+    Snapshot of the microscope state returned by TEMClient.state().
+    Fields that were not requested or could not be read are None,
+    the error message for a failed field is found in errors.
+    timestamp is the server time (time.time()) when the read started.
+    """
+    timestamp: float
+    stage_position: Optional[List[float]] = None
+    stage_status: Optional[List[int]] = None
+    function_mode: Optional[list] = None
+    mag: Optional[list] = None
+    spot_size: Optional[int] = None
+    alpha: Optional[int] = None
+    cl3: Optional[int] = None
+    il1: Optional[int] = None
+    il3: Optional[int] = None
+    olf: Optional[int] = None
+    olc: Optional[int] = None
+    ils: Optional[List[int]] = None
+    pla: Optional[List[int]] = None
+    beam_blank: Optional[int] = None
+    aperture_sizes: Optional[Dict[str, int]] = None
+    errors: Dict[str, str] = field(default_factory=dict)
+
+    @classmethod
+    def field_names(cls) -> List[str]:
+        """
+        Names that can be passed as fields to TEMClient.state()
+        """
+        return [f.name for f in fields(cls) if f.name not in ('timestamp', 'errors')]
+
+    @classmethod
+    def from_dict(cls, d : dict) -> 'TEMState':
+        #Ignore fields added by newer servers
+        known = {f.name for f in fields(cls)}
+        return cls(**{k: v for k, v in d.items() if k in known})
+
+    @property
+    def tilt_x(self) -> Optional[float]:
+        return None if self.stage_position is None else self.stage_position[3]
@@ -0,0 +1,145 @@
+"""
+Low overhead latency histograms. TEMServer keeps a copy of these in
+tem-server.py since it is standalone.
+"""
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class Histogram:
+    """
+    Latency histogram with log spaced buckets, about 5% resolution
+    between 1 us and 100 s. Adding a sample is one log and a dict update.
+    """
+    _min = 1e-6
+    _log_growth = math.log(1.05)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, dt : float) -> None:
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        i = 0 if dt <= Histogram._min else int(math.log(dt/Histogram._min)/Histogram._log_growth) + 1
+        self._buckets[i] = self._buckets.get(i, 0) + 1
+
+    def percentile(self, q : float) -> float:
+        """
+        Upper edge of the bucket holding the q:th percentile (0-100)
+        """
+        if not self.count:
+            return 0.0
+        rank = q/100*self.count
+        n = 0
+        for i in sorted(self._buckets):
+            n += self._buckets[i]
+            if n >= rank:
+                return min(Histogram._min*math.exp(i*Histogram._log_growth), self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        """
+        count and mean/p50/p95/p99/max in ms
+        """
+        return {
+            'count': self.count,
+            'mean_ms': self.total/self.count*1e3 if self.count else 0.0,
+            'p50_ms': self.percentile(50)*1e3,
+            'p95_ms': self.percentile(95)*1e3,
+            'p99_ms': self.percentile(99)*1e3,
+            'max_ms': self.max*1e3,
+        }
+
+
+class LatencyStats:
+    """
+    Histogram per command and phase plus count and error count per command
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self.started = time.time()
+
+    def _entry(self, cmd):
+        entry = self._commands.get(cmd)
+        if entry is None:
+            entry = self._commands[cmd] = {'count': 0, 'errors': 0, 'phases': OrderedDict()}
+        return entry
+
+    def record(self, cmd : str, timing : dict, error : bool = False) -> None:
+        with self._lock:
+            entry = self._entry(cmd)
+            entry['count'] += 1
+            if error:
+                entry['errors'] += 1
+            for phase, dt in timing.items():
+                h = entry['phases'].get(phase)
+                if h is None:
+                    h = entry['phases'][phase] = Histogram()
+                h.add(dt)
+
+    def histogram(self, cmd : str, phase : str):
+        """
+        Histogram for one command and phase, None if nothing recorded
+        """
+        with self._lock:
+            entry = self._commands.get(cmd)
+            return None if entry is None else entry['phases'].get(phase)
+
+    def percentile(self, cmd : str, phase : str, q : float, min_count : int = 1):
+        """
+        q:th percentile in seconds for one command and phase, None if fewer
+        than min_count samples were recorded
+        """
+        with self._lock:
+            entry = self._commands.get(cmd)
+            h = None if entry is None else entry['phases'].get(phase)
+            if h is None or h.count < min_count:
+                return None
+            return h.percentile(q)
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                'started': self.started,
+                'commands': {cmd: {
+                    'count': e['count'],
+                    'errors': e['errors'],
+                    'phases': {p: h.summary() for p, h in e['phases'].items()},
+                } for cmd, e in self._commands.items()},
+            }
+
+
+class StatsDumper:
+    """
+    Append the result of a callable as a JSON line to a file every
+    interval_s seconds from a background thread, and once more on stop()
+    """
+    def __init__(self, source, path, interval_s = 60.0):
+        self.source = source
+        self.path = path
+        self.interval_s = interval_s
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.interval_s):
+            self.dump()
+
+    def dump(self) -> None:
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(dict(self.source(), t=time.time())) + '\n')
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        self.dump()
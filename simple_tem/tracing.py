@@ -0,0 +1,85 @@
+"""
+Request tracing between TEMClient and TEMServer. A traced request carries
+a trace id and the client send time in its header, the server returns
+when it received, started and finished the command. Spans are exported as
+Chrome trace events that can be opened in chrome://tracing or Perfetto.
+"""
+import json
+import os
+import threading
+import time
+
+
+class Tracer:
+    """
+    Collects the spans of traced requests. The server clock is mapped to
+    the client clock with the offset measured on the request with the
+    shortest round trip, assuming the network delay is symmetric.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._prefix = os.urandom(4).hex()
+        self._n = 0
+        self._spans = []
+        self.clock_offset = None #server - client in seconds
+        self.rtt = None #round trip of the request used for clock_offset
+
+    def new_trace(self) -> dict:
+        """
+        Header entry for a new request: {'id': ..., 't': client send time}
+        """
+        with self._lock:
+            self._n += 1
+            n = self._n
+        return {'id': f"{self._prefix}-{n}", 't': time.time()}
+
+    def record(self, trace : dict, cmd : str, t_reply : float, server : dict = None, error : bool = False) -> None:
+        """
+        Store the span of a request, server is the trace frame of the reply
+        or None if the server did not answer
+        """
+        with self._lock:
+            self._spans.append((trace['id'], cmd, trace['t'], t_reply, threading.get_ident(), server, error))
+            if server is not None:
+                rtt = (t_reply - trace['t']) - (server['end'] - server['recv'])
+                if self.rtt is None or rtt < self.rtt:
+                    self.rtt = rtt
+                    self.clock_offset = ((server['recv'] - trace['t']) + (server['end'] - t_reply)) / 2
+
+    def __len__(self):
+        return len(self._spans)
+
+    def events(self) -> list:
+        """
+        Spans as Chrome trace events, timestamps in us on the client clock
+        """
+        with self._lock:
+            spans = list(self._spans)
+            offset = self.clock_offset or 0.0
+        events = [
+            {'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'TEMClient'}},
+            {'name': 'process_name', 'ph': 'M', 'pid': 2, 'args': {'name': 'TEMServer'}},
+        ]
+        lanes = {}
+        for trace_id, cmd, t_send, t_reply, tid, server, error in spans:
+            args = {'trace_id': trace_id, 'error': error}
+            events.append({'name': cmd, 'cat': 'client', 'ph': 'X', 'pid': 1, 'tid': tid,
+                           'ts': t_send*1e6, 'dur': (t_reply - t_send)*1e6, 'args': args})
+            if server is not None:
+                recv, start, end = (server[k] - offset for k in ('recv', 'start', 'end'))
+                lane = lanes.setdefault(server['lane'], len(lanes) + 1)
+                events.append({'name': f"{cmd} queue", 'cat': 'server', 'ph': 'X', 'pid': 2, 'tid': lane,
+                               'ts': recv*1e6, 'dur': (start - recv)*1e6, 'args': args})
+                events.append({'name': cmd, 'cat': 'server', 'ph': 'X', 'pid': 2, 'tid': lane,
+                               'ts': start*1e6, 'dur': (end - start)*1e6, 'args': args})
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': 2, 'tid': tid, 'args': {'name': f"lane-{lane}"}}
+                   for lane, tid in lanes.items()]
+        return events
+
+    def export(self, path) -> None:
+        """
+        Write the spans as a Chrome trace JSON file
+        """
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': self.events(), 'displayTimeUnit': 'ms',
+                       'otherData': {'clock_offset_s': self.clock_offset, 'rtt_s': self.rtt}}, f)
@@ -0,0 +1,99 @@
+import array
+import base64
+import sys
+from dataclasses import dataclass, field
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+@dataclass
+class Trajectory:
+    """
+    Tilt angle samples recorded by the server while the stage moves,
+    returned by TEMClient.trajectory(). t is the server time (time.time()),
+    moving is 1.0 while the stage moves and 0.0 for the samples taken just
+    before a move started and after it stopped. next is passed as since to
+    only fetch newer samples, overrun is True if samples were overwritten
+    on the server before they were fetched.
+    """
+    t: array.array = field(default_factory=lambda: array.array('d'))
+    angle: array.array = field(default_factory=lambda: array.array('d'))
+    moving: array.array = field(default_factory=lambda: array.array('d'))
+    next: float = 0.0
+    overrun: bool = False
+
+    @classmethod
+    def from_reply(cls, reply : dict) -> 'Trajectory':
+        data = reply['data']
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        values = array.array('d')
+        values.frombytes(data)
+        if sys.byteorder == 'big':
+            values.byteswap()
+        n_columns = len(reply['columns'])
+        columns = {name: values[i::n_columns] for i, name in enumerate(reply['columns'])}
+        return cls(columns['t'], columns['angle'], columns['moving'], reply['next'], reply['overrun'])
+
+    def extend(self, other : 'Trajectory') -> None:
+        """
+        Append samples fetched later
+        """
+        self.t.extend(other.t)
+        self.angle.extend(other.angle)
+        self.moving.extend(other.moving)
+        self.next = other.next
+        self.overrun = self.overrun or other.overrun
+
+    def __len__(self):
+        return len(self.t)
+
+
+@dataclass
+class FrameAngles:
+    """
+    Result of interpolate_angles(), one entry per timestamp. speed is the
+    angular speed in degrees per second between the surrounding samples.
+    extrapolated marks timestamps outside the recorded samples, their angle
+    is the first or last recorded one. stalled marks timestamps where the
+    stage moved slower than stall_speed.
+    """
+    angle: 'np.ndarray'
+    speed: 'np.ndarray'
+    extrapolated: 'np.ndarray'
+    stalled: 'np.ndarray'
+
+
+def interpolate_angles(timestamps, trajectory : Trajectory, stall_speed : float = 1e-3) -> FrameAngles:
+    """
+    Tilt angle for each timestamp (time.time() on the server) by linear
+    interpolation between the recorded samples, in one vectorized pass.
+    Requires numpy.
+
+    frames = interpolate_angles(frame_timestamps, c.trajectory(since))
+    frames.angle[~frames.extrapolated]
+    """
+    if np is None:
+        raise ImportError("interpolate_angles requires numpy")
+    if len(trajectory) == 0:
+        raise ValueError("Trajectory without samples")
+    ts = np.asarray(timestamps, dtype=np.float64)
+    t = np.asarray(trajectory.t, dtype=np.float64)
+    a = np.asarray(trajectory.angle, dtype=np.float64)
+
+    extrapolated = (ts < t[0]) | (ts > t[-1])
+    if len(t) == 1:
+        return FrameAngles(np.full(ts.shape, a[0]), np.zeros(ts.shape), extrapolated,
+                           np.ones(ts.shape, dtype=bool))
+
+    #Interval [i, i+1] holding each timestamp, timestamps outside are clamped
+    i = np.clip(np.searchsorted(t, ts, side='right') - 1, 0, len(t) - 2)
+    dt = t[i+1] - t[i]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed = np.where(dt > 0, (a[i+1] - a[i]) / dt, 0.0)
+    angle = a[i] + speed * (np.clip(ts, t[0], t[-1]) - t[i])
+    speed[extrapolated] = 0.0
+    return FrameAngles(angle, speed, extrapolated, np.abs(speed) < stall_speed)
@@ -2,43 +2,643 @@
 # executes them on a TEM3 object. The server is meant to be 
 # standalone and can be run on the same machine as PyJEM
 import argparse
-from datetime import datetime
+import array
+import base64
+from collections import OrderedDict
 import json
+import logging
+import logging.handlers
+import itertools
+import math
+import queue
+import struct
 import sys
+import threading
+import time
 import zmq
 
-def now() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+log = logging.getLogger('TEMServer')
+
+# --------------------- LOGGING ---------------------
+# Records are queued as they are and formatted and written by a background
+# thread, so the command loop never waits on the console or the log file.
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread and drops
+    records when the queue is full instead of blocking
+    """
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+class _SampleFilter(logging.Filter):
+    """
+    Let through at most one record per sample_key every interval_s seconds,
+    used for high rate polling commands. The next record that passes
+    reports how many were suppressed.
+    """
+    def __init__(self, interval_s):
+        super().__init__()
+        self.interval_s = interval_s
+        self._last = {}
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None or self.interval_s <= 0:
+            return True
+        t = record.created
+        with self._lock:
+            if t - self._last.get(key, 0) < self.interval_s:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return False
+            self._last[key] = t
+            n = self._suppressed.pop(key, 0)
+        if n:
+            record.msg += ' suppressed=%d'
+            record.args = record.args + (n,)
+        return True
+
+def _setup_logging(level = 'INFO', log_file = None, sample_s = 1.0, queue_size = 10000):
+    """
+    Log through a bounded queue to the console and optionally a rotating
+    file. Returns the listener, call stop() on it to flush at exit.
+    """
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(threadName)s %(message)s')
+    handlers = [logging.StreamHandler()]
+    if log_file is not None:
+        handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=10*1024*1024, backupCount=5))
+    for h in handlers:
+        h.setFormatter(formatter)
+
+    q = queue.Queue(queue_size)
+    qh = _DroppingQueueHandler(q)
+    qh.addFilter(_SampleFilter(sample_s))
+    log.addHandler(qh)
+    log.setLevel(level)
+    log.propagate = False
+    listener = logging.handlers.QueueListener(q, *handlers)
+    listener.start()
+    return listener
+
+# END LOGGING______________________________________
+
+# --------------------- CODECS ---------------------
+# Same wire codecs as simple_tem/codec.py, copied since the server is standalone.
+# With the binary codecs the status is plain ascii and the payload has a one
+# byte tag: s=fixed struct layout, j=json, m=msgpack
+
+_FIXED_LAYOUTS = {
+    'GetStagePosition': struct.Struct('<5d'),
+    'GetStageStatus': struct.Struct('<5b'),
+    'Getf1OverRateTxNum': struct.Struct('<i'),
+    'GetSpotSize': struct.Struct('<i'),
+    'GetAlpha': struct.Struct('<i'),
+    'GetCL3': struct.Struct('<i'),
+    'GetIL1': struct.Struct('<i'),
+    'GetIL3': struct.Struct('<i'),
+    'GetOLf': struct.Struct('<i'),
+    'GetOLc': struct.Struct('<i'),
+    'GetILs': struct.Struct('<2i'),
+    'GetPLA': struct.Struct('<2i'),
+    'GetBeamBlank': struct.Struct('<i'),
+}
+
+class _JsonCodec:
+    name = 'json'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('ascii')
+
+    def decode(self, data):
+        return json.loads(data.decode('ascii'))
+
+    def encode_reply(self, cmd, status, value):
+        return [self.encode(status), self.encode(value)]
+
+class _BinaryCodec:
+    tag = None
+
+    def encode_reply(self, cmd, status, value):
+        if status == 'OK' and cmd in _FIXED_LAYOUTS:
+            values = value if isinstance(value, (list, tuple)) else (value,)
+            try:
+                return [b'OK', b's' + _FIXED_LAYOUTS[cmd].pack(*values)]
+            except struct.error:
+                #Unexpected reply from PyJEM, send it with the generic codec
+                pass
+        return [status.encode('ascii'), self.tag + self.encode(value)]
+
+class _StructCodec(_BinaryCodec, _JsonCodec):
+    name = 'struct'
+    tag = b'j'
+
+class _MsgpackCodec(_BinaryCodec):
+    name = 'msgpack'
+    tag = b'm'
+
+    def encode(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+def _available_codecs():
+    codecs = OrderedDict()
+    if msgpack is not None:
+        codecs['msgpack'] = _MsgpackCodec()
+    codecs['struct'] = _StructCodec()
+    codecs['json'] = _JsonCodec()
+    return codecs
+
+# END CODECS_______________________________________
+
+
+# ---------------------- STATS ----------------------
+# Same histograms as simple_tem/stats.py, copied since the server is standalone
+
+class _Histogram:
+    """
+    Latency histogram with log spaced buckets, about 5% resolution
+    between 1 us and 100 s. Adding a sample is one log and a dict update.
+    """
+    _min = 1e-6
+    _log_growth = math.log(1.05)
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._buckets = {}
+
+    def add(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+        i = 0 if dt <= _Histogram._min else int(math.log(dt/_Histogram._min)/_Histogram._log_growth) + 1
+        self._buckets[i] = self._buckets.get(i, 0) + 1
+
+    def percentile(self, q):
+        """
+        Upper edge of the bucket holding the q:th percentile (0-100)
+        """
+        if not self.count:
+            return 0.0
+        rank = q/100*self.count
+        n = 0
+        for i in sorted(self._buckets):
+            n += self._buckets[i]
+            if n >= rank:
+                return min(_Histogram._min*math.exp(i*_Histogram._log_growth), self.max)
+        return self.max
+
+    def summary(self):
+        """
+        count and mean/p50/p95/p99/max in ms
+        """
+        return {
+            'count': self.count,
+            'mean_ms': self.total/self.count*1e3 if self.count else 0.0,
+            'p50_ms': self.percentile(50)*1e3,
+            'p95_ms': self.percentile(95)*1e3,
+            'p99_ms': self.percentile(99)*1e3,
+            'max_ms': self.max*1e3,
+        }
+
+class _LatencyStats:
+    """
+    Histogram per command and phase plus count and error count per command
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._commands = {}
+        self.started = time.time()
+
+    def _entry(self, cmd):
+        entry = self._commands.get(cmd)
+        if entry is None:
+            entry = self._commands[cmd] = {'count': 0, 'errors': 0, 'phases': OrderedDict()}
+        return entry
+
+    def record(self, cmd, timing, error = False):
+        with self._lock:
+            entry = self._entry(cmd)
+            entry['count'] += 1
+            if error:
+                entry['errors'] += 1
+            for phase, dt in timing.items():
+                h = entry['phases'].get(phase)
+                if h is None:
+                    h = entry['phases'][phase] = _Histogram()
+                h.add(dt)
+
+    def record_phase(self, cmd, phase, dt):
+        with self._lock:
+            phases = self._entry(cmd)['phases']
+            h = phases.get(phase)
+            if h is None:
+                h = phases[phase] = _Histogram()
+            h.add(dt)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self.started,
+                'commands': {cmd: {
+                    'count': e['count'],
+                    'errors': e['errors'],
+                    'phases': OrderedDict((p, h.summary()) for p, h in e['phases'].items()),
+                } for cmd, e in self._commands.items()},
+            }
+
+
+class _ClientStats:
+    """
+    Requests, rejections and queue occupancy per client name
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def _entry(self, client):
+        entry = self._clients.get(client)
+        if entry is None:
+            entry = self._clients[client] = {'requests': 0, 'rejected': 0, 'queued': 0,
+                                             'max_queued': 0, 'queue': _Histogram()}
+        return entry
+
+    def queued(self, client):
+        with self._lock:
+            entry = self._entry(client)
+            entry['requests'] += 1
+            entry['queued'] += 1
+            entry['max_queued'] = max(entry['max_queued'], entry['queued'])
+
+    def dequeued(self, client, wait_s):
+        with self._lock:
+            entry = self._entry(client)
+            entry['queued'] -= 1
+            entry['queue'].add(wait_s)
+
+    def rejected(self, client):
+        with self._lock:
+            entry = self._entry(client)
+            entry['requests'] += 1
+            entry['rejected'] += 1
+
+    def summary(self):
+        with self._lock:
+            return {client: dict(e, queue=e['queue'].summary()) for client, e in self._clients.items()}
+
+# END STATS________________________________________
+
+
+class _Request:
+    """
+    A request on its way through the server. timing collects the time
+    spent in each phase, t_mark is when the current phase started.
+    """
+    __slots__ = ('envelope', 'cmd', 'args', 'codec', 'header', 'timing', 't_mark', 'client', 'trace',
+                 'waiters')
+
+    def __init__(self, envelope, cmd, args, codec, header, timing):
+        self.envelope = envelope
+        self.cmd = cmd
+        self.args = args
+        self.codec = codec
+        self.header = header
+        self.timing = timing
+        self.t_mark = time.perf_counter()
+        self.client = header.get('client', 'unknown')
+        #Server timestamps (time.time()) returned to a tracing client
+        self.trace = None
+        #Coalesced setpoint: requests folded into this one, answered with it
+        self.waiters = None
+
+    def lap(self, phase):
+        t = time.perf_counter()
+        self.timing[phase] = t - self.t_mark
+        self.t_mark = t
+
+
+class _ReadCache:
+    """
+    TTL cache for readouts that rarely change. Entries are keyed on
+    (cmd, args) and the oldest entry is evicted when max_size is reached.
+    Every invalidation bumps a generation counter and a value read before
+    the latest invalidation is not stored, so a read racing with a write
+    in another lane can't put a stale value back in the cache.
+    """
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'bypassed': 0, 'invalidated': 0, 'evicted': 0}
+
+    def get(self, key):
+        """
+        Returns (True, value) on a hit and (False, None) otherwise
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._stats['hits'] += 1
+                return True, entry[1]
+            self._stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[key] = (time.monotonic() + self.ttl[key[0]], value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evicted'] += 1
+
+    def bypass(self):
+        with self._lock:
+            self._stats['bypassed'] += 1
+
+    def invalidate(self, cmds):
+        with self._lock:
+            self.generation += 1
+            for key in [k for k in self._entries if k[0] in cmds]:
+                del self._entries[key]
+                self._stats['invalidated'] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s['entries'] = len(self._entries)
+        return s
+
+
+class _TrajectoryRecorder:
+    """
+    Preallocated ring buffer of (t, tilt angle, moving) samples stored as
+    consecutive doubles. When full the oldest samples are overwritten so
+    memory stays bounded on long sessions.
+    """
+    columns = ('t', 'angle', 'moving')
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.count = 0 #samples ever added, the ring holds the last capacity
+        self._data = array.array('d', [0.0]) * (capacity * len(self.columns))
+        self._lock = threading.Lock()
+
+    def add(self, t, angle, moving):
+        with self._lock:
+            i = (self.count % self.capacity) * 3
+            self._data[i] = t
+            self._data[i+1] = angle
+            self._data[i+2] = moving
+            self.count += 1
+
+    def _t(self, k):
+        return self._data[(k % self.capacity) * 3]
+
+    def since(self, t):
+        """
+        Samples with a timestamp after t as bytes of little endian doubles,
+        the number of samples, the timestamp of the last one (t if there
+        are none) and whether samples after t were overwritten
+        """
+        with self._lock:
+            first = max(0, self.count - self.capacity)
+            #Binary search for the first retained sample newer than t
+            lo, hi = first, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._t(mid) <= t:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            overrun = lo == first and first > 0 and t < self._t(first)
+            n = self.count - lo
+            last = self._t(self.count - 1) if n else t
+            a, b = (lo % self.capacity) * 3, (self.count % self.capacity) * 3
+            if n == 0:
+                samples = array.array('d')
+            elif a < b:
+                samples = self._data[a:b]
+            else:
+                samples = self._data[a:] + self._data[:b]
+        if sys.byteorder == 'big':
+            samples.byteswap()
+        return samples.tobytes(), n, last, overrun
+
 
 class TEMServer:
     _IL1_DEFAULT = 21902
     STATUS_OK = 'OK'
     STATUS_ERROR = 'ERROR'
+    STATUS_BUSY = 'BUSY'
     encoding = 'ascii'
     _version_str = '2024.8.30' #TODO! Auto update
+    _not_batchable = ('batch', 'exit_server')
+    #Queries besides Get* that are logged at DEBUG
+    _quiet = ('ping', 'version', 'capabilities', 'stats', 'cache_stats', 'WaitForRotationStart',
+              'WaitForStageIdle', 'WaitForAngle', 'WaitForSequence', 'WaitOperation')
+
+    #Commands after which a telemetry update is published right away
+    _telemetry_triggers = ('SetZRel', 'SetXRel', 'SetYRel', 'SetTXRel', 'SetTiltXAngle',
+                           'Setf1OverRateTxNum', 'StopStage', 'SetBeamBlank', 'batch',
+                           'StartZRel', 'StartXRel', 'StartYRel', 'StartTXRel', 'StartTiltXAngle',
+                           'CancelOperation')
+    _telemetry_keepalive_s = 1.0
+
+    #Queue priority, lower runs first. Safety commands go first and are
+    #never rejected when a lane is full, clients can pick the others
+    PRIORITY_SAFETY = 0
+    _priorities = {'high': 1, 'normal': 2, 'low': 3}
+    _safety = ('StopStage',)
+
+    #Commands that manage the hardware locks themselves
+    _lock_free = ('batch', 'GetState', 'WaitForRotationStart', 'WaitForStageIdle', 'WaitForAngle',
+                  'GetTrajectory', 'RunSequence', 'GetSequenceStatus', 'WaitForSequence',
+                  'StartZRel', 'StartXRel', 'StartYRel', 'StartTXRel', 'StartTiltXAngle',
+                  'GetOperation', 'WaitOperation', 'CancelOperation')
+    _wait_poll_s = 0.002
 
-    def __init__(self, port):
+    #Worker lane for each command. Commands within a lane are executed in
+    #order and each lane has its own lock on the hardware, so independent
+    #subsystems run in parallel. StopStage gets its own lane to never wait
+    #behind a blocking stage move. ping, version, capabilities and stats get
+    #the 'control' lane so that liveness checks and the handshake of new
+    #clients are answered during a move. batch and GetState call into the
+    #other lanes and can wait for their locks, they run in 'compound'.
+    #Anything not listed runs in 'general'.
+    _lanes = {
+        'ping': 'control', 'version': 'control', 'capabilities': 'control',
+        'stats': 'control', 'cache_stats': 'control',
+        'batch': 'compound', 'GetState': 'compound',
+        'GetStagePosition': 'stage', 'GetStageStatus': 'stage',
+        'SetZRel': 'stage', 'SetXRel': 'stage', 'SetYRel': 'stage',
+        'SetTXRel': 'stage', 'SetTiltXAngle': 'stage',
+        'Getf1OverRateTxNum': 'stage', 'Setf1OverRateTxNum': 'stage',
+        'GetMovementValueMeasurementMethod': 'stage',
+        'StopStage': 'stop',
+        'GetMagValue': 'eos', 'GetFunctionMode': 'eos', 'SelectFunctionMode': 'eos',
+        'SetSelector': 'eos', 'GetSpotSize': 'eos', 'GetAlpha': 'eos',
+        'GetAperatureSize': 'apt',
+        'SetILFocus': 'lens', 'GetCL3': 'lens', 'GetIL1': 'lens', 'GetIL3': 'lens',
+        'GetOLf': 'lens', 'GetOLc': 'lens',
+        'GetILs': 'def', 'SetILs': 'def', 'GetPLA': 'def',
+        'GetBeamBlank': 'def', 'SetBeamBlank': 'def',
+        'WaitForRotationStart': 'wait', 'WaitForStageIdle': 'wait', 'WaitForAngle': 'wait',
+        'WaitForSequence': 'wait',
+        'WaitOperation': 'wait', 'CancelOperation': 'stop',
+    }
+    #Waits only read the stage so several run at the same time, each on its
+    #own worker. A wait arriving when all workers are taken is answered with
+    #BUSY instead of queueing behind waits that can last up to their timeout.
+    _worker_pool_lanes = ('wait',)
+
+    #Absolute setpoints that a client can ask to coalesce (header 'coalesce'):
+    #only the newest pending value is applied. Relative moves never are.
+    _coalescable = ('SetILFocus', 'SetILs', 'Setf1OverRateTxNum')
+
+    #Readouts served from the read cache and their default TTL in seconds
+    _cache_ttl_s = {
+        'GetMagValue': 0.5, 'GetFunctionMode': 0.5, 'GetSpotSize': 0.5, 'GetAlpha': 0.5,
+        'GetCL3': 0.5, 'GetIL1': 0.5, 'GetIL3': 0.5, 'GetOLf': 0.5, 'GetOLc': 0.5,
+        'GetILs': 0.5, 'GetPLA': 0.5, 'GetAperatureSize': 0.5,
+    }
+    _lens_readouts = ('GetCL3', 'GetIL1', 'GetIL3', 'GetOLf', 'GetOLc', 'GetILs', 'GetPLA')
+    #Cached readouts that are invalidated by each write
+    _cache_invalidates = {
+        'SelectFunctionMode': ('GetFunctionMode', 'GetMagValue') + _lens_readouts,
+        'SetSelector': ('GetMagValue',) + _lens_readouts,
+        'SetILFocus': ('GetIL1', 'GetIL3'),
+        'SetILs': ('GetILs',),
+    }
+
+    def __init__(self, port, telemetry_port = None, telemetry_rate = 20.0,
+                 cache_ttl = None, cache_size = 64, stats_file = None, stats_interval = 60.0,
+                 trajectory_rate = 50.0, trajectory_capacity = 100000, max_queue = 64,
+                 wait_workers = 16):
+        """
+        cache_ttl: None for the default TTL per command, a number to use the
+        same TTL for all cached readouts, 0 to disable the read cache
+        stats_file: append the output of stats() as a JSON line to this
+        file every stats_interval seconds
+        trajectory_rate: Hz at which the tilt angle is recorded while the
+        stage moves, 0 disables the recorder
+        max_queue: requests waiting per lane before new ones are rejected
+        with BUSY, 0 for no limit
+        wait_workers: Wait* commands that can run at the same time, more
+        are rejected with BUSY
+        """
         self.stage = TEM3.Stage3()
         self.lens = TEM3.Lens3()
         self.defl = TEM3.Def3()
         self.eos = TEM3.EOS3()
         self.apt = TEM3.Apt3()
 
+        #Serializes access to each subsystem between the lanes and the telemetry thread
+        lanes = set(TEMServer._lanes.values()) | {'general'}
+        self._locks = {lane: threading.RLock() for lane in lanes}
+        #Stage position and status reads by the sampling threads (telemetry,
+        #trajectory, waits), held only for the read. A blocking move holds
+        #the stage lane for its whole duration, the stage is still sampled.
+        self._sample_lock = threading.Lock()
+
         self.context = zmq.Context()
-        self.socket = self.context.socket(zmq.REP)
+        self.socket = self.context.socket(zmq.ROUTER)
         endpoint = "tcp://*:{}".format(port)
-        print("{} - TEMServer binding to {} ".format(self._now(), endpoint))
+        log.info("bind endpoint=%s", endpoint)
         self.socket.bind(endpoint)
 
+        #Lane workers push their replies here and the main loop sends them
+        self._replies = self.context.socket(zmq.PULL)
+        self._replies.bind("inproc://replies")
+        self._queues = {lane: queue.PriorityQueue() for lane in lanes}
+        #Tie breaker keeping requests of the same priority in order
+        self._queue_seq = itertools.count()
+        self._max_queue = max_queue
+        self._clients = _ClientStats()
+        self._workers = []
+        self._lane_workers = {'wait': wait_workers}
+        #Requests queued or running per worker pool lane
+        self._workers_in_use = {lane: 0 for lane in TEMServer._worker_pool_lanes}
+        self._workers_lock = threading.Lock()
+        self._codecs = _available_codecs()
+        self._local = threading.local()
+        self._stats = _LatencyStats()
+        self._stats_file = stats_file
+        self._stats_interval = stats_interval
+        self._stats_thread = None
+
+        self._cache = None
+        if cache_ttl != 0:
+            ttl = dict(TEMServer._cache_ttl_s)
+            if cache_ttl is not None:
+                ttl = {cmd: cache_ttl for cmd in ttl}
+            self._cache = _ReadCache(ttl, cache_size)
+
+        self._telemetry_socket = None
+        self._telemetry_thread = None
+        self._telemetry_period = 1.0 / telemetry_rate
+        self._telemetry_trigger = threading.Event()
+        self._stop = threading.Event()
+        if telemetry_port is not None:
+            self._telemetry_socket = self.context.socket(zmq.PUB)
+            self._telemetry_socket.setsockopt(zmq.LINGER, 0)
+            endpoint = "tcp://*:{}".format(telemetry_port)
+            log.info("telemetry endpoint=%s rate_hz=%s", endpoint, telemetry_rate)
+            self._telemetry_socket.bind(endpoint)
+
+        self._trajectory = None
+        self._trajectory_thread = None
+        if trajectory_rate:
+            self._trajectory = _TrajectoryRecorder(trajectory_capacity)
+            self._trajectory_period = 1.0 / trajectory_rate
+            log.info("trajectory rate_hz=%s capacity=%d", trajectory_rate, trajectory_capacity)
+
+        self._operations = OrderedDict()
+        self._operation_ids = 0
+        self._operation_cond = threading.Condition()
+        self._stage_operation = None #the operation that began last
+        self._next_operation = None #started but still waiting for the stage
+
+        self._setpoints = {} #cmd -> pending coalesced request
+        self._applied = {} #cmd -> last applied setpoint arguments
+        self._setpoint_lock = threading.Lock()
+        self._setpoint_stats = {'applied': 0, 'coalesced': 0, 'skipped': 0}
+
+        self._sequence = None
+        self._sequence_ids = 0
+        self._sequence_cond = threading.Condition()
+        self._sequence_abort = threading.Event()
+
         #Find all commands
         self._commands = [it for it in dir(self) if callable(getattr(self, it)) and not it.startswith('_')]
     
     def _has_function(self, cmd):
         return cmd in self._commands
 
-    def _now(self):
-        return now()
-    
     def ping(self):
         return "pong"
 
@@ -47,6 +647,36 @@ class TEMServer:
     
     def version(self):
         return TEMServer._version_str
+
+    def stats(self):
+        """
+        Latency histograms per command and phase (recv, decode, queue,
+        call, encode, send), the read cache counters, per client request
+        counts and queue waits, the current queue depth per lane and the
+        workers taken in the wait lane
+        """
+        s = self._stats.summary()
+        s['cache'] = self.cache_stats()
+        s['clients'] = self._clients.summary()
+        s['queued'] = {lane: q.qsize() for lane, q in self._queues.items()}
+        with self._workers_lock:
+            s['workers'] = {lane: {'busy': n, 'size': self._lane_workers[lane]}
+                            for lane, n in self._workers_in_use.items()}
+        with self._setpoint_lock:
+            s['setpoints'] = dict(self._setpoint_stats)
+        return s
+
+    def cache_stats(self):
+        """
+        Hit/miss counters of the read cache, None if disabled
+        """
+        return None if self._cache is None else self._cache.stats()
+
+    def capabilities(self):
+        """
+        Handshake used by the client to pick a wire codec
+        """
+        return {'version': TEMServer._version_str, 'codecs': list(self._codecs)}
         
     # --------------------- STAGE ---------------------
     def GetStagePosition(self):
@@ -80,9 +710,220 @@ class TEMServer:
         return self.stage.GetMovementValueMeasurementMethod()
 
     def StopStage(self):
+        self._sequence_abort.set()
         self.stage.Stop()
 
+    def _wait_for(self, condition, timeout):
+        """
+        Poll condition close to the hardware until it is true or timeout
+        seconds passed. Reads do not wait for the stage lane so that a
+        running blocking move is seen. In a sequence an abort ends the wait.
+        """
+        deadline = time.monotonic() + timeout
+        abort = getattr(self._local, 'abort', None)
+        while True:
+            with self._sample_lock:
+                if condition():
+                    return True
+            if time.monotonic() >= deadline or (abort is not None and abort.is_set()):
+                return False
+            time.sleep(TEMServer._wait_poll_s)
+
+    def WaitForRotationStart(self, timeout : float = 2.0):
+        return self._wait_for(lambda: self.stage.GetStatus()[3] == 1, timeout)
+
+    def WaitForStageIdle(self, timeout : float = 60.0):
+        return self._wait_for(lambda: 1 not in self.stage.GetStatus(), timeout)
+
+    def WaitForAngle(self, target : float, tol : float = 0.1, timeout : float = 60.0):
+        return self._wait_for(lambda: abs(self.stage.GetPos()[3] - target) <= tol, timeout)
+
     # END STAGE _______________________________________
+    # -------------------- OPERATIONS --------------------
+
+    #A move that never starts counts as done after _operation_settle_s
+    _operation_settle_s = 0.5
+    _operation_timeout_s = 600.0
+    _operation_history = 100
+    _operation_tol = 0.05
+
+    def StartZRel(self, val : float):
+        return self._start_operation('SetZRel', (val,))
+
+    def StartXRel(self, val : float):
+        return self._start_operation('SetXRel', (val,))
+
+    def StartYRel(self, val : float):
+        return self._start_operation('SetYRel', (val,))
+
+    def StartTXRel(self, val : float):
+        #The target is known once the move begins
+        return self._start_operation('SetTXRel', (val,), relative = True)
+
+    def StartTiltXAngle(self, tilt : float):
+        return self._start_operation('SetTiltXAngle', (tilt,), tilt)
+
+    def _start_operation(self, cmd, args, target = None, relative = False):
+        """
+        Run a stage command in the background and follow the stage until
+        it stopped. Returns the operation id without waiting for the stage.
+        The stage only does one move: an operation that has begun is
+        replaced when the next one begins, one still waiting for the stage
+        (behind a blocking move) is replaced right away and never moves.
+        """
+        with self._operation_cond:
+            previous = self._next_operation
+            if previous is not None and previous['state'] == 'running':
+                self._finish_operation(previous, 'replaced')
+            self._operation_ids += 1
+            op = {
+                'id': self._operation_ids,
+                'cmd': cmd,
+                'args': list(args),
+                'target': target,
+                'state': 'running',
+                'started': time.time(),
+                'finished': None,
+                'position': None,
+                'error': None,
+                'relative': relative,
+            }
+            self._operations[op['id']] = op
+            while len(self._operations) > TEMServer._operation_history:
+                self._operations.popitem(last=False)
+            self._next_operation = op
+        threading.Thread(target=self._operation_loop, args=(op,), daemon=True, name="operation").start()
+        return op['id']
+
+    def _finish_operation(self, op, state, position = None, error = None):
+        #Called with _operation_cond held
+        op['state'] = state
+        op['finished'] = time.time()
+        op['position'] = position
+        op['error'] = error
+        self._operation_cond.notify_all()
+
+    def _begin_operation(self, op):
+        """
+        Called with the stage lane lock held right before the command of op
+        runs, False if op was replaced or cancelled while it waited
+        """
+        with self._operation_cond:
+            if op['state'] != 'running':
+                return False
+            if self._next_operation is op:
+                self._next_operation = None
+            previous = self._stage_operation
+            if previous is not None and previous['state'] == 'running':
+                self._finish_operation(previous, 'replaced')
+            self._stage_operation = op
+            if op['relative']:
+                op['target'] = self.stage.GetPos()[3] + op['args'][0]
+            op['begun'] = True
+            return True
+
+    def _operation_loop(self, op):
+        with self._locks['stage']:
+            if not self._begin_operation(op):
+                return
+            rc, res = self._call(op['cmd'], op['args'])
+            with self._operation_cond:
+                if op['state'] != 'running':
+                    return
+                if rc != TEMServer.STATUS_OK:
+                    self._finish_operation(op, 'error', error=res)
+                    return
+                #A blocking move is over when the command returns, finish
+                #before the next operation can begin and replace this one
+                if op['target'] is not None:
+                    with self._sample_lock:
+                        position = self.stage.GetPos()
+                        moving = any(s == 1 for s in self.stage.GetStatus())
+                    if not moving and abs(position[3] - op['target']) <= TEMServer._operation_tol:
+                        self._finish_operation(op, 'done', position)
+                        return
+
+        t0 = time.monotonic()
+        seen_moving = False
+        while True:
+            with self._sample_lock:
+                position = self.stage.GetPos()
+                moving = any(s == 1 for s in self.stage.GetStatus())
+            at_target = op['target'] is not None and abs(position[3] - op['target']) <= TEMServer._operation_tol
+            with self._operation_cond:
+                if op['state'] != 'running':
+                    if op['position'] is None:
+                        op['position'] = position
+                    return
+                if moving:
+                    seen_moving = True
+                elif (seen_moving or at_target or op.get('cancel')
+                      or time.monotonic() - t0 > TEMServer._operation_settle_s):
+                    if op.get('cancel'):
+                        state = 'cancelled'
+                    elif op['target'] is not None and not at_target:
+                        state = 'stopped'
+                    else:
+                        state = 'done'
+                    self._finish_operation(op, state, position)
+                    return
+                if time.monotonic() - t0 > TEMServer._operation_timeout_s:
+                    self._finish_operation(op, 'timeout', position)
+                    return
+            time.sleep(TEMServer._wait_poll_s)
+
+    def _operation(self, op_id):
+        op = self._operations.get(op_id)
+        if op is None:
+            raise KeyError("Unknown operation: {}".format(op_id))
+        return op
+
+    def GetOperation(self, op_id):
+        """
+        State of an operation: id, cmd, args, target, state (running, done,
+        stopped, cancelled, replaced, error, timeout), started, finished,
+        position (stage position when it finished) and error
+        """
+        with self._operation_cond:
+            op = dict(self._operation(op_id))
+        for key in ('cancel', 'begun', 'relative'):
+            op.pop(key, None)
+        return op
+
+    def WaitOperation(self, op_id, timeout : float = 60.0):
+        """
+        Block until the operation finished or timeout seconds passed,
+        returns GetOperation()
+        """
+        deadline = time.monotonic() + timeout
+        with self._operation_cond:
+            op = self._operation(op_id)
+            while op['state'] == 'running':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._operation_cond.wait(remaining)
+        return self.GetOperation(op_id)
+
+    def CancelOperation(self, op_id):
+        """
+        Stop the stage if the operation is still running, returns True if
+        it was running
+        """
+        with self._operation_cond:
+            op = self._operation(op_id)
+            if op['state'] != 'running':
+                return False
+            if not op.get('begun'):
+                #Still waiting for the stage, it will not move at all
+                self._finish_operation(op, 'cancelled')
+                return True
+            op['cancel'] = True
+        with self._locks['stop']:
+            self.stage.Stop()
+        return True
+
+    # END OPERATIONS____________________________________
     # ---------------------- EOS ----------------------
     def GetMagValue(self):
         return self.eos.GetMagValue()
@@ -149,43 +990,671 @@ class TEMServer:
 
     # END DEF_________________________________________
     
-    def _run(self):
-        while True:
-            msgs = self.socket.recv_multipart()
-            
-            #If we didn't get two messages something is really wrong so lets 
-            #just exit and debug the caller
-            if len(msgs) != 2:
-                print("TEMServer got: {} messages. Should always be 2 -> EXIT".format(len(msgs)))
-                sys.exit(1)
+    # -------------------- TELEMETRY --------------------
+    def _read_telemetry(self):
+        return {
+            'position': self.stage.GetPos(),
+            'status': self.stage.GetStatus(),
+            'beam_blank': self.defl.GetBeamBlank(),
+        }
 
-            cmd = msgs[0].decode(TEMServer.encoding)
-            args = json.loads(msgs[1].decode(TEMServer.encoding))
-            print("{} - REQ: {}, {}".format(self._now(), cmd, args))
+    def _telemetry_loop(self):
+        """
+        Publish timestamped stage position, stage status and beam blank.
+        While the stage is moving every sample is published, when idle only
+        changes and a keepalive every _telemetry_keepalive_s.
+        """
+        last_state = None
+        last_sent = 0
+        seq = 0
+        kicked = False
+        while not self._stop.is_set():
+            try:
+                with self._sample_lock, self._locks['def']:
+                    t = time.time()
+                    state = self._read_telemetry()
+                    moving = any(s == 1 for s in state['status'])
+                    #After a command always publish, the client dropped the
+                    #samples it received before the reply
+                    if (kicked or moving or state != last_state
+                            or t - last_sent > TEMServer._telemetry_keepalive_s):
+                        msg = dict(state, t=t, seq=seq, moving=moving,
+                                   period_s=self._telemetry_period,
+                                   keepalive_s=TEMServer._telemetry_keepalive_s)
+                        #Publish while holding the locks so that a sample never
+                        #overtakes a command that changed the state
+                        self._telemetry_socket.send_multipart([b'stage', json.dumps(msg).encode(TEMServer.encoding)])
+                        seq += 1
+                        last_sent = t
+                        last_state = state
+            except Exception as e:
+                log.warning("telemetry error=%s", e, extra={'sample_key': 'telemetry'})
+            kicked = self._telemetry_trigger.wait(self._telemetry_period)
+            self._telemetry_trigger.clear()
 
-            if self._has_function(cmd):
-                # if the function in found we try to call it
-                try:
-                    res = getattr(self, cmd)(*args)
-                    rc = TEMServer.STATUS_OK
-                except Exception as e:
-                    rc = TEMServer.STATUS_ERROR
-                    res = "Exception occurred when calling: {}. Error message: {}".format(cmd, e)
+    def _start_telemetry(self):
+        if self._telemetry_socket is not None:
+            self._telemetry_thread = threading.Thread(target=self._telemetry_loop, daemon=True,
+                                                      name="telemetry")
+            self._telemetry_thread.start()
+
+    def _stop_telemetry(self):
+        self._stop.set()
+        self._telemetry_trigger.set()
+        if self._telemetry_thread is not None:
+            self._telemetry_thread.join()
+            self._telemetry_socket.close()
+
+    # END TELEMETRY____________________________________
+    # -------------------- TRAJECTORY --------------------
+    def _trajectory_loop(self):
+        """
+        Record the tilt angle while the stage moves. The last sample before
+        a move starts and the first one after it stopped are kept as well.
+        """
+        previous = None
+        next_t = time.monotonic()
+        while not self._stop.is_set():
+            try:
+                with self._sample_lock:
+                    t = time.time()
+                    angle = self.stage.GetPos()[3]
+                    moving = any(s == 1 for s in self.stage.GetStatus())
+                if moving and previous is not None and not previous[2]:
+                    self._trajectory.add(*previous)
+                if moving or (previous is not None and previous[2]):
+                    self._trajectory.add(t, angle, moving)
+                previous = (t, angle, moving)
+            except Exception as e:
+                log.warning("trajectory error=%s", e, extra={'sample_key': 'trajectory'})
+            #Keep the sample rate steady, skip ticks if a read was slow
+            next_t += self._trajectory_period
+            now = time.monotonic()
+            if next_t < now:
+                next_t = now
+            self._stop.wait(next_t - now)
+
+    def _start_trajectory(self):
+        if self._trajectory is not None:
+            self._trajectory_thread = threading.Thread(target=self._trajectory_loop, daemon=True,
+                                                       name="trajectory")
+            self._trajectory_thread.start()
+
+    def _stop_trajectory(self):
+        if self._trajectory_thread is not None:
+            self._trajectory_thread.join()
+
+    def GetTrajectory(self, since : float = 0.0):
+        """
+        Tilt angle samples recorded after the time since (time.time() on
+        the server). data holds n rows of little endian doubles with the
+        columns t, angle and moving, raw bytes with msgpack and base64 with
+        the other codecs. Pass next as since to only get newer samples.
+        overrun is true if samples after since were already overwritten.
+        """
+        if self._trajectory is None:
+            raise RuntimeError("Trajectory recorder disabled, start the server with --trajectory-rate")
+        data, n, last, overrun = self._trajectory.since(since)
+        if self._header().get('codec') != 'msgpack':
+            data = base64.b64encode(data).decode(TEMServer.encoding)
+        return {
+            'columns': list(_TrajectoryRecorder.columns),
+            'n': n,
+            'data': data,
+            'next': last,
+            'overrun': overrun,
+        }
+
+    # END TRAJECTORY____________________________________
+    # --------------------- SEQUENCE ---------------------
+
+    #Steps allowed in a sequence and the (min, max) number of numeric
+    #arguments they take, Dwell waits the given seconds
+    _sequence_steps = {
+        'SetTiltXAngle': (1, 1), 'SetTXRel': (1, 1), 'Setf1OverRateTxNum': (1, 1),
+        'SetBeamBlank': (1, 1), 'SetZRel': (1, 1), 'SetXRel': (1, 1), 'SetYRel': (1, 1),
+        'WaitForRotationStart': (0, 1), 'WaitForStageIdle': (0, 1), 'WaitForAngle': (1, 3),
+        'Dwell': (1, 1),
+    }
+
+    def RunSequence(self, steps):
+        """
+        Start executing a list of [cmd, arg, ...] steps on the server, e.g.
+        [['SetBeamBlank', 1], ['SetTiltXAngle', 10], ['WaitForStageIdle', 60],
+        ['SetBeamBlank', 0], ['Dwell', 0.5]]. Returns the sequence id. A
+        Wait step that times out stops the sequence, StopStage aborts it.
+        All steps are checked before the sequence starts.
+        """
+        steps = [list(step) for step in steps]
+        for step in steps:
+            if not step or not isinstance(step[0], str) or step[0] not in TEMServer._sequence_steps:
+                raise ValueError("Step not allowed in a sequence: {}".format(step))
+            n_min, n_max = TEMServer._sequence_steps[step[0]]
+            args = step[1:]
+            if (not n_min <= len(args) <= n_max
+                    or not all(isinstance(a, (int, float)) and not isinstance(a, bool) for a in args)):
+                raise ValueError("Step {} takes {} to {} numbers, got: {}".format(step[0], n_min, n_max, args))
+        with self._sequence_cond:
+            if self._sequence is not None and self._sequence['state'] == 'running':
+                raise RuntimeError("Sequence {} is still running".format(self._sequence['id']))
+            self._sequence_ids += 1
+            self._sequence = {
+                'id': self._sequence_ids,
+                'state': 'running',
+                'step': 0,
+                'n_steps': len(steps),
+                'started': time.time(),
+                'finished': None,
+                'error': None,
+                'log': [],
+            }
+            self._sequence_abort.clear()
+        threading.Thread(target=self._sequence_loop, args=(self._sequence, steps), daemon=True,
+                         name="sequence").start()
+        return self._sequence_ids
+
+    def _sequence_loop(self, seq, steps):
+        self._local.abort = self._sequence_abort
+        state, error, i = 'error', None, 0
+        try:
+            state, i = self._run_steps(seq, steps)
+        except Exception as e:
+            #Never leave the sequence running, that would block every later one
+            i = seq['step']
+            log.error("SEQ id=%d step=%d error=%s", seq['id'], i, e)
+            error = "Exception in step {}: {}".format(i, e)
+        finally:
+            with self._sequence_cond:
+                seq['step'] = i
+                seq['state'] = state
+                seq['error'] = error
+                seq['finished'] = time.time()
+                self._sequence_cond.notify_all()
+
+    def _run_steps(self, seq, steps):
+        """
+        Execute the steps, returns the final state and the index of the
+        step the sequence ended at
+        """
+        state = 'done'
+        for i, step in enumerate(steps):
+            with self._sequence_cond:
+                seq['step'] = i
+            if self._sequence_abort.is_set():
+                state = 'aborted'
+                break
+            cmd, args = step[0], step[1:]
+            t0 = time.time()
+            if cmd == 'Dwell':
+                rc, res = TEMServer.STATUS_OK, None
+                if self._sequence_abort.wait(args[0]):
+                    rc, res = TEMServer.STATUS_ERROR, "aborted"
             else:
-                #Otherwise we return an error
+                rc, res = self._call(cmd, args)
+                if cmd in TEMServer._telemetry_triggers:
+                    self._telemetry_trigger.set()
+            with self._sequence_cond:
+                seq['log'].append([t0, time.time(), cmd, args, rc, res])
+            log.info("SEQ id=%d step=%d cmd=%s args=%s status=%s result=%s", seq['id'], i, cmd, args, rc, res)
+            if self._sequence_abort.is_set():
+                state = 'aborted'
+                break
+            if rc != TEMServer.STATUS_OK or res is False:
+                state = 'error' if rc != TEMServer.STATUS_OK else 'timeout'
+                break
+        else:
+            i = len(steps)
+        return state, i
+
+    def GetSequenceStatus(self):
+        """
+        State of the last sequence: id, state (running, done, aborted,
+        error, timeout), current step, n_steps, started, finished, error
+        (message of an unexpected failure) and the log with [start, end,
+        cmd, args, status, result] for every executed step. None if no
+        sequence was run.
+        """
+        with self._sequence_cond:
+            if self._sequence is None:
+                return None
+            return dict(self._sequence, log=list(self._sequence['log']))
+
+    def WaitForSequence(self, timeout : float = 60.0):
+        """
+        Block until the last sequence finished, returns GetSequenceStatus().
+        """
+        deadline = time.monotonic() + timeout
+        with self._sequence_cond:
+            while self._sequence is not None and self._sequence['state'] == 'running':
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._sequence_cond.wait(remaining)
+        return self.GetSequenceStatus()
+
+    # END SEQUENCE______________________________________
+
+    def _stats_dump_loop(self):
+        while not self._stop.wait(self._stats_interval):
+            self._dump_stats()
+
+    def _dump_stats(self):
+        try:
+            with open(self._stats_file, 'a') as f:
+                f.write(json.dumps(dict(self.stats(), t=time.time())) + '\n')
+        except Exception as e:
+            log.warning("stats dump error=%s", e)
+
+    def _start_stats_dump(self):
+        if self._stats_file is not None:
+            self._stats_thread = threading.Thread(target=self._stats_dump_loop, daemon=True, name="stats")
+            self._stats_thread.start()
+
+    def _stop_stats_dump(self):
+        if self._stats_thread is not None:
+            self._stats_thread.join()
+            self._dump_stats()
+
+    # ---------------------- BATCH ----------------------
+    def batch(self, *calls):
+        """
+        Execute several commands in one request. Each call is a [cmd, args]
+        pair and the reply is a list of [status, result] in the same order.
+        """
+        results = []
+        for cmd, args in calls:
+            if cmd in TEMServer._not_batchable:
+                results.append([TEMServer.STATUS_ERROR, "Function: {} can not be batched".format(cmd)])
+            else:
+                results.append(list(self._call(cmd, args, fresh = self._header().get('fresh', False))))
+        return results
+
+    # END BATCH________________________________________
+    # ---------------------- STATE ----------------------
+
+    #Fields of GetState and the command (with arguments) used to read them
+    _state_fields = OrderedDict([
+        ('stage_position', ('GetStagePosition', ())),
+        ('stage_status', ('GetStageStatus', ())),
+        ('function_mode', ('GetFunctionMode', ())),
+        ('mag', ('GetMagValue', ())),
+        ('spot_size', ('GetSpotSize', ())),
+        ('alpha', ('GetAlpha', ())),
+        ('cl3', ('GetCL3', ())),
+        ('il1', ('GetIL1', ())),
+        ('il3', ('GetIL3', ())),
+        ('olf', ('GetOLf', ())),
+        ('olc', ('GetOLc', ())),
+        ('ils', ('GetILs', ())),
+        ('pla', ('GetPLA', ())),
+        ('beam_blank', ('GetBeamBlank', ())),
+        ('aperture_sizes', None),
+    ])
+    _apertures = OrderedDict([('CLA', 1), ('OLA', 2), ('HCA', 3), ('SAA', 4), ('ENTA', 5), ('EDS', 6)])
+
+    def GetState(self, fields = None):
+        """
+        Read the microscope state in one pass. fields selects a subset of
+        _state_fields, default all. Fields that fail are left out and the
+        error message is returned in 'errors'.
+        """
+        if fields is None:
+            fields = list(TEMServer._state_fields)
+        unknown = [f for f in fields if f not in TEMServer._state_fields]
+        if unknown:
+            raise ValueError("Unknown state fields: {}".format(unknown))
+
+        fresh = self._header().get('fresh', False)
+        state = {'timestamp': time.time(), 'errors': {}}
+        for field in fields:
+            if field == 'aperture_sizes':
+                calls = [(name, 'GetAperatureSize', (index,)) for name, index in TEMServer._apertures.items()]
+            else:
+                cmd, args = TEMServer._state_fields[field]
+                calls = [(None, cmd, args)]
+
+            values = {}
+            for name, cmd, args in calls:
+                rc, res = self._call(cmd, args, fresh = fresh)
+                if rc == TEMServer.STATUS_OK:
+                    values[name] = res
+                else:
+                    state['errors'][field if name is None else "{}.{}".format(field, name)] = res
+            if None in values:
+                state[field] = values[None]
+            elif values:
+                state[field] = values
+        return state
+
+    # END STATE________________________________________
+
+    def _call(self, cmd, args, fresh = False):
+        """
+        Look up and call a command, returns (status, result). Cached
+        readouts are served from the read cache unless fresh is set.
+        """
+        if cmd in TEMServer._coalescable:
+            #Set by any path, a coalesced write must not be skipped
+            with self._setpoint_lock:
+                self._applied.pop(cmd, None)
+        if self._has_function(cmd):
+            # if the function in found we try to call it
+            try:
+                if cmd in TEMServer._lock_free:
+                    res = getattr(self, cmd)(*args)
+                elif self._cache is not None and cmd in TEMServer._cache_ttl_s:
+                    res = self._cached_call(cmd, args, fresh)
+                else:
+                    with self._locks[self._lane(cmd)]:
+                        res = getattr(self, cmd)(*args)
+                    if cmd in TEMServer._telemetry_triggers:
+                        #Sampling does not wait for the stage lane, a sample
+                        #read before the change is published before the reply
+                        with self._sample_lock:
+                            pass
+                    if self._cache is not None and cmd in TEMServer._cache_invalidates:
+                        self._cache.invalidate(TEMServer._cache_invalidates[cmd])
+                rc = TEMServer.STATUS_OK
+            except Exception as e:
                 rc = TEMServer.STATUS_ERROR
-                res = "Function: {} not implemented".format(cmd)
+                res = "Exception occurred when calling: {}. Error message: {}".format(cmd, e)
+        else:
+            #Otherwise we return an error
+            rc = TEMServer.STATUS_ERROR
+            res = "Function: {} not implemented".format(cmd)
+        return rc, res
+
+    def _cached_call(self, cmd, args, fresh):
+        key = (cmd, tuple(args))
+        if fresh:
+            self._cache.bypass()
+        else:
+            hit, res = self._cache.get(key)
+            if hit:
+                return res
+        generation = self._cache.generation
+        with self._locks[self._lane(cmd)]:
+            res = getattr(self, cmd)(*args)
+        self._cache.put(key, res, generation)
+        return res
+
+    def _coalesce(self, req):
+        """
+        Fold a setpoint into the pending request for the same command if
+        there is one, that request takes over the newer arguments and
+        answers req too. Otherwise req becomes the pending request.
+        Returns True if req was folded.
+        """
+        with self._setpoint_lock:
+            pending = self._setpoints.get(req.cmd)
+            if pending is None:
+                req.waiters = []
+                self._setpoints[req.cmd] = req
+                return False
+            pending.args = req.args
+            pending.waiters.append(req)
+            self._setpoint_stats['coalesced'] += 1
+        return True
 
-            rc = json.dumps(rc).encode(TEMServer.encoding)
-            res = json.dumps(res).encode(TEMServer.encoding)
-            
-            # Reply to the client
-            print("{} - REP: {}, {}".format(self._now(), rc, res))
-            self.socket.send_multipart([rc, res])
+    def _apply_setpoint(self, req):
+        """
+        Apply the newest value of a coalesced setpoint, skipped if it equals
+        the value applied last. Returns (status, applied value).
+        """
+        with self._setpoint_lock:
+            #Setpoints arriving from now on start a new pending request
+            del self._setpoints[req.cmd]
+            args = list(req.args)
+            skip = self._applied.get(req.cmd) == args
+            if skip:
+                self._setpoint_stats['skipped'] += 1
+        if skip:
+            rc = TEMServer.STATUS_OK
+        else:
+            rc, res = self._call(req.cmd, args)
+            if rc != TEMServer.STATUS_OK:
+                return rc, res
+            with self._setpoint_lock:
+                self._applied[req.cmd] = args
+                self._setpoint_stats['applied'] += 1
+        return rc, args[0] if len(args) == 1 else args
 
+    def _header(self):
+        """
+        Header of the request that is being executed by this thread
+        """
+        return getattr(self._local, 'header', {})
 
-            if cmd == 'exit_server':
+    def _lane(self, cmd):
+        return TEMServer._lanes.get(cmd, 'general')
+
+    def _lane_worker(self, lane):
+        """
+        Execute the commands queued for one lane and push the replies
+        back to the main loop
+        """
+        out = self.context.socket(zmq.PUSH)
+        out.connect("inproc://replies")
+        q = self._queues[lane]
+        while True:
+            req = q.get()[2]
+            if req is None:
                 break
+            req.lap('queue')
+            self._clients.dequeued(req.client, req.timing['queue'])
+            self._local.header = req.header
+            t_start = time.time()
+            if req.waiters is not None:
+                rc, res = self._apply_setpoint(req)
+            else:
+                rc, res = self._call(req.cmd, req.args, fresh = req.header.get('fresh', False))
+            t_end = time.time()
+            req.lap('call')
+            self._push_reply(out, req, rc, res, t_start, t_end)
+            for waiter in req.waiters or ():
+                waiter.lap('queue')
+                self._push_reply(out, waiter, rc, res, t_start, t_end)
+            if lane in self._workers_in_use:
+                with self._workers_lock:
+                    self._workers_in_use[lane] -= 1
+        out.close()
+
+    def _claim_worker(self, lane):
+        """
+        Reserve a worker of a worker pool lane for a new request, False if
+        all are taken. Other lanes queue without limit here.
+        """
+        if lane not in self._workers_in_use:
+            return True
+        with self._workers_lock:
+            if self._workers_in_use[lane] >= self._lane_workers[lane]:
+                return False
+            self._workers_in_use[lane] += 1
+            return True
+
+    def _push_reply(self, out, req, rc, res, t_start, t_end):
+        reply = self._encode_reply(req.codec, req.cmd, rc, res)
+        if req.trace is not None:
+            req.trace['start'] = t_start
+            req.trace['end'] = t_end
+            log.info("TRACE id=%s cmd=%s client=%s recv=%.6f start=%.6f end=%.6f", req.header['trace']['id'],
+                     req.cmd, req.client, req.trace['recv'], req.trace['start'], req.trace['end'])
+            reply.append(json.dumps(req.trace).encode(TEMServer.encoding))
+        req.lap('encode')
+        self._stats.record(req.cmd, req.timing, error = rc != TEMServer.STATUS_OK)
+        #Internal prefix for the main loop: command and when the send phase started
+        prefix = [req.cmd.encode(TEMServer.encoding), struct.pack('<d', time.perf_counter())]
+        out.send_multipart(prefix + req.envelope + reply)
+
+    def _log_message(self, kind, cmd, *fields):
+        """
+        Reads and queries are logged at DEBUG and sampled, everything
+        else at INFO. Errors are always logged as warnings, BUSY replies
+        sampled since they come in bursts.
+        """
+        if kind == "REP" and fields[0] == TEMServer.STATUS_BUSY:
+            log.warning("%s cmd=%s status=%s result=%s", kind, cmd, *fields, extra={'sample_key': ('BUSY', cmd)})
+        elif kind == "REP" and fields[0] != TEMServer.STATUS_OK:
+            log.warning("%s cmd=%s status=%s result=%s", kind, cmd, *fields)
+        elif cmd is not None and (cmd.startswith('Get') or cmd in TEMServer._quiet):
+            if log.isEnabledFor(logging.DEBUG):
+                msg = "%s cmd=%s args=%s" if kind == "REQ" else "%s cmd=%s status=%s result=%s"
+                log.debug(msg, kind, cmd, *fields, extra={'sample_key': (kind, cmd)})
+        elif kind == "REQ":
+            log.info("%s cmd=%s args=%s", kind, cmd, *fields)
+        else:
+            log.info("%s cmd=%s status=%s result=%s", kind, cmd, *fields)
+
+    def _encode_reply(self, codec, cmd, rc, res):
+        self._log_message("REP", cmd, rc, res)
+        return codec.encode_reply(cmd, rc, res)
+
+    def _start_workers(self):
+        for lane in self._queues:
+            for i in range(self._lane_workers.get(lane, 1)):
+                t = threading.Thread(target=self._lane_worker, args=(lane,), daemon=True,
+                                     name="lane-{}".format(lane))
+                t.start()
+                self._workers.append(t)
+
+    def _stop_workers(self):
+        for lane, q in self._queues.items():
+            for i in range(self._lane_workers.get(lane, 1)):
+                q.put((len(TEMServer._priorities) + 1, next(self._queue_seq), None))
+        #A worker could be stuck in a long PyJEM call, don't wait forever
+        for t in self._workers:
+            t.join(timeout=1)
+
+    def _handle_request(self, frames, t_ready = None):
+        """
+        Split off the routing envelope and queue the command on its lane.
+        t_ready is the perf_counter() time the socket was seen readable.
+        """
+        t0 = time.perf_counter()
+        recv_s = 0.0 if t_ready is None else t0 - t_ready
+        t_recv = time.time()
+        try:
+            i = frames.index(b'')
+        except ValueError:
+            log.error("message without envelope dropped frames=%d", len(frames))
+            return
+        envelope, msgs = frames[:i+1], frames[i+1:]
+
+        #A well behaved client sends the command, the arguments and optionally
+        #a header, reply with an error to let the caller debug
+        json_codec = self._codecs['json']
+        if len(msgs) not in (2, 3):
+            log.error("malformed request frames=%d", len(msgs))
+            self._reply_error(envelope, json_codec, "Expected 2 or 3 messages got {}".format(len(msgs)))
+            return
+
+        try:
+            header = json_codec.decode(msgs[2]) if len(msgs) == 3 else {}
+            cmd = msgs[0].decode(TEMServer.encoding)
+        except Exception as e:
+            log.error("malformed request error=%s", e)
+            self._reply_error(envelope, json_codec, "Could not decode request: {}".format(e))
+            return
+        if not isinstance(header, dict):
+            self._reply_error(envelope, json_codec, "Header must be an object, got: {}".format(header))
+            return
+        codec_name = header.get('codec', 'json')
+        codec = self._codecs.get(codec_name) if isinstance(codec_name, str) else None
+        if codec is None:
+            self._reply_error(envelope, json_codec, "Unknown codec: {}".format(codec_name))
+            return
+        try:
+            args = codec.decode(msgs[1])
+        except Exception as e:
+            log.error("malformed arguments cmd=%s error=%s", cmd, e)
+            self._reply_error(envelope, codec, "Could not decode arguments: {}".format(e))
+            return
+        self._log_message("REQ", cmd, args)
+        if cmd == 'exit_server':
+            #Reply directly, the main loop exits after this
+            rc, res = self._call(cmd, args)
+            self.socket.send_multipart(envelope + self._encode_reply(codec, cmd, rc, res))
+        else:
+            timing = {'recv': recv_s, 'decode': time.perf_counter() - t0}
+            req = _Request(envelope, cmd, args, codec, header, timing)
+            if 'trace' in header:
+                req.trace = {'recv': t_recv, 'lane': self._lane(cmd)}
+            if header.get('coalesce') and cmd in TEMServer._coalescable and self._coalesce(req):
+                return cmd
+            priority = self._priority(cmd, args, header)
+            lane = self._lane(cmd)
+            q = self._queues[lane]
+            busy = None
+            if priority != TEMServer.PRIORITY_SAFETY and self._max_queue and q.qsize() >= self._max_queue:
+                busy = "{} requests queued for {}".format(q.qsize(), lane)
+            elif not self._claim_worker(lane):
+                busy = "All {} {} workers are busy".format(self._lane_workers[lane], lane)
+            if busy is not None:
+                #Tell the client right away instead of letting it time out
+                if req.waiters is not None:
+                    with self._setpoint_lock:
+                        del self._setpoints[cmd]
+                self._clients.rejected(req.client)
+                self.socket.send_multipart(envelope + self._encode_reply(codec, cmd, TEMServer.STATUS_BUSY, busy))
+            else:
+                self._clients.queued(req.client)
+                q.put((priority, next(self._queue_seq), req))
+        return cmd
+
+    def _reply_error(self, envelope, codec, msg):
+        """
+        Answer a request that could not be queued
+        """
+        self.socket.send_multipart(envelope + self._encode_reply(codec, None, TEMServer.STATUS_ERROR, msg))
+
+    def _priority(self, cmd, args, header):
+        """
+        StopStage and blanking the beam are safety commands, everything
+        else runs at the priority asked for in the header, default normal
+        """
+        if cmd in TEMServer._safety or (cmd == 'SetBeamBlank' and args and args[0]):
+            return TEMServer.PRIORITY_SAFETY
+        return TEMServer._priorities.get(header.get('priority'), TEMServer._priorities['normal'])
+
+    def _send_reply(self, frames):
+        """
+        Send a reply pushed by a lane worker and record the send phase
+        """
+        cmd, t_push = frames[0].decode(TEMServer.encoding), frames[1]
+        self.socket.send_multipart(frames[2:])
+        dt = time.perf_counter() - struct.unpack('<d', t_push)[0]
+        self._stats.record_phase(cmd, 'send', dt)
+        #Publish the new state after the reply so that the client sees it
+        #after the command returned
+        if cmd in TEMServer._telemetry_triggers:
+            self._telemetry_trigger.set()
+
+    def _run(self):
+        self._start_telemetry()
+        self._start_trajectory()
+        self._start_stats_dump()
+        self._start_workers()
+        poller = zmq.Poller()
+        poller.register(self.socket, zmq.POLLIN)
+        poller.register(self._replies, zmq.POLLIN)
+        while True:
+            events = dict(poller.poll())
+            #The recv phase runs from here, when the request is known to be
+            #waiting, until it is decoded, including sending a reply first
+            t_ready = time.perf_counter()
+            if self._replies in events:
+                # Reply to the client
+                self._send_reply(self._replies.recv_multipart())
+
+            if self.socket in events:
+                frames = self.socket.recv_multipart()
+                if self._handle_request(frames, t_ready) == 'exit_server':
+                    break
+
+        self._stop_workers()
+        self._stop_telemetry()
+        self._stop_trajectory()
+        self._stop_stats_dump()
 
 
 if __name__ == "__main__":
@@ -193,14 +1662,55 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--dummy',
                     action='store_true')
+    parser.add_argument('--dummy-store', default='memory', choices=['memory', 'redis'],
+                    help='Where the dummy keeps its state, redis shares it between processes')
+    parser.add_argument('--dummy-time-scale', type=float, default=1.0,
+                    help='Run the dummy stage this many times faster than real time')
+    parser.add_argument('-p', '--port', type=int, default=3535)
+    parser.add_argument('-t', '--telemetry-port', type=int, default=None,
+                    help='Publish stage telemetry on this port')
+    parser.add_argument('--telemetry-rate', type=float, default=20.0,
+                    help='Telemetry sample rate in Hz')
+    parser.add_argument('--cache-ttl', type=float, default=None,
+                    help='TTL in seconds for cached optics readouts, 0 disables the cache')
+    parser.add_argument('--cache-size', type=int, default=64,
+                    help='Max number of entries in the read cache')
+    parser.add_argument('-l', '--log-level', default='INFO',
+                    choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'],
+                    help='DEBUG also logs Get* commands')
+    parser.add_argument('--log-file', default=None,
+                    help='Also log to this file, rotated at 10 MB')
+    parser.add_argument('--log-sample', type=float, default=1.0,
+                    help='Log each polling command at most once per this many seconds, 0 logs all')
+    parser.add_argument('--trajectory-rate', type=float, default=50.0,
+                    help='Hz at which the tilt angle is recorded while the stage moves, 0 disables')
+    parser.add_argument('--trajectory-capacity', type=int, default=100000,
+                    help='Max number of trajectory samples kept, the oldest are overwritten')
+    parser.add_argument('--max-queue', type=int, default=64,
+                    help='Requests waiting per lane before new ones get a BUSY reply, 0 for no limit')
+    parser.add_argument('--wait-workers', type=int, default=16,
+                    help='Wait* commands that can run at the same time, more get a BUSY reply')
+    parser.add_argument('--stats-file', default=None,
+                    help='Append latency statistics as JSON lines to this file')
+    parser.add_argument('--stats-interval', type=float, default=60.0,
+                    help='Seconds between statistics dumps')
     args = parser.parse_args()
+    listener = _setup_logging(args.log_level, args.log_file, args.log_sample)
     if args.dummy:
-        from simple_tem.dummy.PyJEM import TEM3
+        from simple_tem.dummy.PyJEM import TEM3, PyJEM_DummyConf, ScaledClock
+        PyJEM_DummyConf.store = args.dummy_store
+        if args.dummy_time_scale != 1.0:
+            PyJEM_DummyConf.clock = ScaledClock(args.dummy_time_scale)
     else:
         from PyJEM import TEM3
 
 
-    s = TEMServer(3535)
+    s = TEMServer(args.port, telemetry_port=args.telemetry_port, telemetry_rate=args.telemetry_rate,
+                  cache_ttl=args.cache_ttl, cache_size=args.cache_size,
+                  stats_file=args.stats_file, stats_interval=args.stats_interval,
+                  trajectory_rate=args.trajectory_rate, trajectory_capacity=args.trajectory_capacity,
+                  max_queue=args.max_queue, wait_workers=args.wait_workers)
     s._run()
+    listener.stop()
 
 
@@ -11,4 +11,20 @@ def client():
         time.sleep(0.1)
 
     c.SetBeamBlank(0)
-    return c
\ No newline at end of file
+    return c
+
+@pytest.fixture
+def telemetry_client(client):
+    """
+    Client subscribed to the telemetry stream, requires the server to be
+    started with --telemetry-port 3536
+    """
+    client.subscribe(3536)
+    t0 = time.perf_counter()
+    while client.telemetry is None:
+        if time.perf_counter() - t0 > 2:
+            client.unsubscribe()
+            pytest.skip("No telemetry from server, start it with -t 3536")
+        time.sleep(0.05)
+    yield client
+    client.unsubscribe()
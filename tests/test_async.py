@@ -0,0 +1,78 @@
+import asyncio
+import pytest
+import time
+from simple_tem import AsyncTEMClient
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+async def _with_client(fn):
+    async with AsyncTEMClient('localhost', verbose=False) as c:
+        return await fn(c)
+
+
+def test_async_commands(client):
+    async def fn(c):
+        assert await c.ping()
+        assert await c.GetMagValue() == [15000, 'X', 'X15k']
+        assert await c.GetTiltXAngle() == pytest.approx(0)
+        assert not await c.is_rotating
+        await c.SetBeamBlank(1)
+        assert await c.GetBeamBlank() == 1
+        await c.SetBeamBlank(0)
+    run(_with_client(fn))
+
+def test_async_concurrent_requests(client):
+    async def fn(c):
+        res = await asyncio.gather(c.GetSpotSize(), c.GetAlpha(), c.GetILs(), c.GetPLA())
+        assert res == [3, 4, [21000,22000], [25000,26000]]
+        assert c.connection_stats['max_in_flight'] == 4
+    run(_with_client(fn))
+
+def test_async_error(client):
+    async def fn(c):
+        with pytest.raises(RuntimeError):
+            await c.UnknownFunction()
+    run(_with_client(fn))
+
+def test_async_batch(client):
+    async def fn(c):
+        async with c.batch() as b:
+            b.GetSpotSize()
+            b.GetAlpha()
+        return b.results
+    assert run(_with_client(fn)) == [3, 4]
+
+def test_async_timeout_does_not_block_other_requests():
+    async def fn():
+        #Nothing listens on this port
+        async with AsyncTEMClient('localhost', 3599, verbose=False) as c:
+            t0 = time.perf_counter()
+            with pytest.raises(TimeoutError):
+                await c._send_message("ping", timeout_ms=100)
+            assert time.perf_counter()-t0 < 1
+            assert c.connection_stats['in_flight'] == 0
+            assert not await c.ping(timeout_ms=50)
+    run(fn())
+
+def test_async_cancel(client):
+    async def fn(c):
+        task = asyncio.ensure_future(c.WaitForRotationStart(0.5))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert c.connection_stats['cancelled'] == 1
+        #replies to later requests are still matched correctly
+        assert await c.GetAlpha() == 4
+    run(_with_client(fn))
+
+def test_async_operation(client):
+    async def fn(c):
+        op = await c.StartTiltXAngle(2)
+        assert not await op.done()
+        assert await op.wait(10)
+        assert (await op.position)[3] == pytest.approx(2)
+        assert op.state == 'done'
+    run(_with_client(fn))
@@ -0,0 +1,173 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from simple_tem import TEMClient, AsyncTEMClient
+from simple_tem.coalesce import SingleFlight
+
+
+def _run_threads(n, target):
+    results = [None]*n
+    def worker(i):
+        try:
+            results[i] = target()
+        except Exception as e:
+            results[i] = e
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def test_single_flight_shares_call():
+    flights = SingleFlight()
+    calls = []
+    def fn():
+        calls.append(1)
+        time.sleep(0.2)
+        return [1, 2]
+    results = _run_threads(8, lambda: flights.call('a', fn))
+    assert calls == [1]
+    assert results == [[1, 2]]*8
+    #Every caller has its own copy
+    results[0].append(3)
+    assert results[1] == [1, 2]
+    assert flights.stats == {'requests': 1, 'coalesced': 7, 'window_hits': 0}
+
+def test_single_flight_shares_error():
+    flights = SingleFlight()
+    def fn():
+        time.sleep(0.2)
+        raise TimeoutError("no reply")
+    results = _run_threads(4, lambda: flights.call('a', fn))
+    assert all(isinstance(r, TimeoutError) for r in results)
+    with pytest.raises(TimeoutError):
+        flights.call('a', fn)
+
+def test_single_flight_window():
+    flights = SingleFlight(window_s=0.2)
+    assert flights.call('a', lambda: 1) == 1
+    assert flights.call('a', lambda: 2) == 1
+    assert flights.call('b', lambda: 3) == 3
+    flights.clear()
+    assert flights.call('a', lambda: 4) == 4
+    time.sleep(0.25)
+    assert flights.call('a', lambda: 5) == 5
+    assert flights.stats == {'requests': 4, 'coalesced': 0, 'window_hits': 1}
+
+def test_single_flight_forgets_expired_results():
+    flights = SingleFlight(window_s=0.05)
+    for i in range(100):
+        flights.call(('GetStagePosition', i), lambda: i)
+    time.sleep(0.1)
+    flights.call('a', lambda: 1)
+    assert list(flights._recent) == ['a']
+
+def test_shared_client_coalesces_reads(client):
+    c = TEMClient('localhost', verbose=False, coalesce_window_s=0)
+    c.ping()
+    #Stage reads queue behind the blocking SetTXRel (~1s) in the dummy
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.2)
+    try:
+        results = _run_threads(8, c.GetStagePosition)
+    finally:
+        mover.join()
+    assert all(r == results[0] for r in results)
+    #ping and one GetStagePosition
+    assert c.coalesce_stats['requests'] == 2
+    assert c.coalesce_stats['coalesced'] == 7
+    c.close()
+
+def test_write_discards_window(client):
+    c = TEMClient('localhost', verbose=False, coalesce_window_s=10)
+    assert c.GetBeamBlank() == 0
+    client.SetBeamBlank(1)
+    assert c.GetBeamBlank() == 0 #from the window
+    with c.fresh_reads():
+        assert c.GetBeamBlank() == 1
+    c.SetBeamBlank(0)
+    assert c.GetBeamBlank() == 0
+    assert c.coalesce_stats == {'requests': 2, 'coalesced': 0, 'window_hits': 1}
+    c.close()
+
+def test_client_shared_between_threads(client):
+    c = TEMClient('localhost', verbose=False)
+    def worker():
+        for i in range(50):
+            assert c.GetMagValue() == [15000, 'X', 'X15k']
+            assert len(c.GetStagePosition()) == 5
+        return True
+    assert _run_threads(8, worker) == [True]*8
+    assert c.connection_stats['requests'] == 8*2*50 + 1
+    c.close()
+
+def test_server_applies_newest_setpoint(client):
+    #Setf1OverRateTxNum queues behind the blocking SetTXRel on the stage lane
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.2)
+
+    async def set_speeds():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            with c.coalesce_setpoints():
+                applied = await asyncio.gather(*[c.Setf1OverRateTxNum(v) for v in (1, 2, 3)])
+                #Equal to the applied value, skipped
+                again = await c.Setf1OverRateTxNum(3)
+            return applied, again, await c.server_stats()
+    try:
+        applied, again, stats = asyncio.run(set_speeds())
+    finally:
+        mover.join()
+    assert applied == [3, 3, 3]
+    assert again == 3
+    assert client.Getf1OverRateTxNum() == 3
+    assert stats['setpoints']['coalesced'] >= 2
+    assert stats['setpoints']['skipped'] >= 1
+
+def test_relative_moves_are_not_coalesced(client):
+    async def move():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            with c.coalesce_setpoints():
+                await asyncio.gather(c.SetTXRel(1), c.SetTXRel(1))
+    asyncio.run(move())
+    assert client.GetTiltXAngle() == pytest.approx(2, abs=0.1)
+
+def test_setpoint_writer(client):
+    applied = []
+    with client.setpoint_writer(on_applied=lambda cmd, value, error: applied.append(value)) as w:
+        for value in range(100):
+            w.set('SetILFocus', value)
+        w.set('SetILs', 21000, 22000)
+        assert w.flush(5)
+        assert w.applied == {'SetILFocus': 99, 'SetILs': [21000, 22000]}
+        stats = w.stats
+        assert stats['set'] == 101
+        assert stats['sent'] + stats['replaced'] == 101
+        assert applied[-1] in (99, [21000, 22000])
+        with pytest.raises(ValueError):
+            w.set('SetTXRel', 1)
+
+def test_async_setpoint_writer(client):
+    applied = []
+
+    async def write():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            async with c.setpoint_writer(on_applied=lambda cmd, value, error: applied.append(value)) as w:
+                for value in range(100):
+                    w.set('SetILFocus', value)
+                w.set('SetILs', 21000, 22000)
+                assert await w.flush(5)
+                with pytest.raises(ValueError):
+                    w.set('SetTXRel', 1)
+            return w
+
+    w = asyncio.run(write())
+    assert w.applied == {'SetILFocus': 99, 'SetILs': [21000, 22000]}
+    stats = w.stats
+    assert stats['set'] == 101
+    assert stats['sent'] + stats['replaced'] == 101
+    assert applied[-1] in (99, [21000, 22000])
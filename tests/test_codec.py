@@ -0,0 +1,62 @@
+import pytest
+from simple_tem import TEMClient
+from simple_tem.codec import JsonCodec, StructCodec, available_codecs, select_codec, msgpack
+
+codecs = ['json', 'struct'] + (['msgpack'] if msgpack is not None else [])
+
+
+@pytest.mark.parametrize("name", codecs)
+@pytest.mark.parametrize("cmd, value", [
+    ('GetStagePosition', [1.1, 1.2, 1.3, 1.4, 1.5]),
+    ('GetStageStatus', [0, 0, 0, 1, 0]),
+    ('GetCL3', 0xFF00),
+    ('GetILs', [21000, 22000]),
+    ('GetMagValue', [15000, 'X', 'X15k']),
+    ('SetILs', None),
+])
+def test_reply_round_trip(name, cmd, value):
+    codec = available_codecs()[name]
+    assert codec.decode_reply(cmd, codec.encode_reply(cmd, 'OK', value)) == ('OK', value)
+
+@pytest.mark.parametrize("name", codecs)
+def test_error_round_trip(name):
+    codec = available_codecs()[name]
+    frames = codec.encode_reply('GetStagePosition', 'ERROR', 'Something went wrong')
+    assert codec.decode_reply('GetStagePosition', frames) == ('ERROR', 'Something went wrong')
+
+def test_unexpected_value_falls_back_to_generic_encoding():
+    codec = StructCodec()
+    frames = codec.encode_reply('GetStagePosition', 'OK', [1, 2])
+    assert codec.decode_reply('GetStagePosition', frames) == ('OK', [1, 2])
+
+def test_fixed_layout_is_compact():
+    json_frames = JsonCodec().encode_reply('GetStageStatus', 'OK', [0, 0, 0, 1, 0])
+    struct_frames = StructCodec().encode_reply('GetStageStatus', 'OK', [0, 0, 0, 1, 0])
+    assert struct_frames[1][:1] == b's'
+    assert len(struct_frames[0]) < len(json_frames[0])
+
+def test_select_codec():
+    assert select_codec(None).name == 'json'
+    assert select_codec(['json']).name == 'json'
+    assert select_codec(['struct', 'json']).name == 'struct'
+
+
+@pytest.mark.parametrize("name", codecs)
+def test_commands_with_codec(client, name):
+    c = TEMClient('localhost', verbose=False, codec=name)
+    assert c.GetStagePosition() == pytest.approx([1.1, 1.2, 1.3, 0, 1.5])
+    assert c.GetStageStatus() == [0,0,0,0,0]
+    assert c.GetMagValue() == [15000, 'X', 'X15k']
+    assert c.GetILs() == [21000,22000]
+    assert c.GetAperatureSize(1) == 3
+    assert c.SetILs(24000, 25000) is None
+    with pytest.raises(RuntimeError):
+        c.UnknownFunction()
+    c.close()
+
+def test_codec_is_negotiated(client):
+    c = TEMClient('localhost', verbose=False)
+    assert c.codec is None
+    c.ping()
+    assert c.codec == next(iter(available_codecs()))
+    c.close()
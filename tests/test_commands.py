@@ -1,6 +1,5 @@
 import pytest
 import time
-from simple_tem import TEMClient
 
 
 def test_ping_returns_true(client):
@@ -79,4 +78,89 @@ def test_GetAperatureSize(client):
 # ---------------------- GENERAL ----------------------
 def test_UnknownFunctionRaisesException(client):
     with pytest.raises(Exception):
-        client.UnknownFunction()
\ No newline at end of file
+        client.UnknownFunction()
+
+# ---------------------- BATCH ----------------------
+
+def test_batch_returns_results_in_order(client):
+    with client.batch() as b:
+        b.GetMagValue()
+        b.GetFunctionMode()
+        b.GetSpotSize()
+        b.GetILs()
+    assert b.results == [[15000, 'X', 'X15k'], [4, 'DIFF'], 3, [21000,22000]]
+    assert b.errors == []
+
+def test_batch_keeps_per_command_errors(client):
+    with client.batch() as b:
+        b.GetAlpha()
+        b.UnknownFunction()
+        b.GetAperatureSize(1)
+    assert b.results[0] == 4
+    assert isinstance(b.results[1], RuntimeError)
+    assert b.results[2] == 3
+    assert [i for i, e in b.errors] == [1]
+
+def test_batch_with_arguments(client):
+    with client.batch() as b:
+        b.SetBeamBlank(1)
+        b.GetBeamBlank()
+    assert b.results == [None, 1]
+    client.SetBeamBlank(0)
+
+def test_empty_batch(client):
+    with client.batch() as b:
+        pass
+    assert b.results == []
+
+# ---------------------- CACHE ----------------------
+
+def test_cached_readout(client):
+    before = client.cache_stats()
+    assert client.GetAlpha() == 4
+    assert client.GetAlpha() == 4
+    stats = client.cache_stats()
+    assert stats['hits'] > before['hits']
+
+def test_fresh_read_bypasses_cache(client):
+    client.GetSpotSize()
+    before = client.cache_stats()
+    with client.fresh_reads():
+        assert client.GetSpotSize() == 3
+    stats = client.cache_stats()
+    assert stats['bypassed'] == before['bypassed'] + 1
+    assert stats['hits'] == before['hits']
+
+def test_write_invalidates_cache(client):
+    client.GetILs()
+    before = client.cache_stats()
+    client.SetILs(24000, 25000)
+    assert client.cache_stats()['invalidated'] == before['invalidated'] + 1
+
+# ---------------------- STATE ----------------------
+
+def test_state(client):
+    s = client.state()
+    assert s.stage_position == pytest.approx([1.1, 1.2, 1.3, 0, 1.5])
+    assert s.stage_status == [0,0,0,0,0]
+    assert s.function_mode == [4, 'DIFF']
+    assert s.mag == [15000, 'X', 'X15k']
+    assert s.spot_size == 3
+    assert s.alpha == 4
+    assert s.cl3 == 0xFF00
+    assert s.ils == [21000,22000]
+    assert s.pla == [25000,26000]
+    assert s.beam_blank == 0
+    assert s.aperture_sizes == {'CLA': 3, 'OLA': 3, 'HCA': 3, 'SAA': 3, 'ENTA': 3, 'EDS': 3}
+    assert s.errors == {}
+    assert abs(s.timestamp - time.time()) < 5
+
+def test_state_field_selection(client):
+    s = client.state(['stage_position', 'beam_blank'])
+    assert s.tilt_x == pytest.approx(0)
+    assert s.beam_blank == 0
+    assert s.mag is None
+
+def test_state_unknown_field(client):
+    with pytest.raises(RuntimeError):
+        client.state(['not_a_field'])
@@ -0,0 +1,136 @@
+import asyncio
+import pytest
+import threading
+import time
+from simple_tem import TEMClient, AsyncTEMClient, ServerBusyError
+
+
+def test_blocking_stage_call_does_not_block_other_lanes(client):
+    #SetTXRel blocks in the dummy until the rotation is done (~1s)
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.1)
+    other = TEMClient('localhost', verbose=False)
+    t0 = time.perf_counter()
+    assert other.GetBeamBlank() == 0
+    assert other.GetMagValue() == [15000, 'X', 'X15k']
+    dt = time.perf_counter()-t0
+    other.StopStage()
+    mover.join()
+    other.close()
+    assert dt < 0.3
+
+def test_ping_answered_during_blocking_move(client):
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.1)
+    #GetState waits for the stage lane, it must not hold up the ping
+    reader = TEMClient('localhost', verbose=False)
+    state = threading.Thread(target=reader.state)
+    state.start()
+    time.sleep(0.1)
+    other = TEMClient('localhost', verbose=False)
+    try:
+        t0 = time.perf_counter()
+        assert other.ping()
+        assert other.server_stats()['queued']['compound'] <= 1
+        dt = time.perf_counter() - t0
+    finally:
+        other.StopStage()
+        mover.join()
+        state.join()
+        reader.close()
+        other.close()
+    assert dt < 0.3
+
+def test_stop_stage_interrupts_blocking_move(client):
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.3)
+    other = TEMClient('localhost', verbose=False)
+    other.StopStage()
+    mover.join()
+    assert other.GetTiltXAngle() < 9
+    other.close()
+
+def _blocked_stage_lane(client, angle = 10):
+    mover = threading.Thread(target=client.SetTXRel, args=(angle,))
+    mover.start()
+    time.sleep(0.1)
+    return mover
+
+def test_full_lane_replies_busy(client):
+    mover = _blocked_stage_lane(client)
+
+    async def flood():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            t0 = time.perf_counter()
+            res = await asyncio.gather(*[c.GetStagePosition() for i in range(100)], return_exceptions=True)
+            return res, time.perf_counter() - t0, await c.GetMagValue()
+
+    other = TEMClient('localhost', verbose=False)
+    try:
+        res, dt, mag = asyncio.run(flood())
+    finally:
+        other.StopStage()
+        mover.join()
+    busy = [r for r in res if isinstance(r, ServerBusyError)]
+    assert len(busy) == 100 - 64
+    assert all(isinstance(r, list) for r in res if not isinstance(r, ServerBusyError))
+    assert mag == [15000, 'X', 'X15k']
+    other.close()
+
+def test_high_priority_jumps_queue(client):
+    mover = _blocked_stage_lane(client, 5)
+    done = []
+
+    async def call(c, name):
+        await c.GetStagePosition()
+        done.append(name)
+
+    async def fn():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            with c.priority('low'):
+                low = [asyncio.ensure_future(call(c, 'low')) for i in range(3)]
+            await asyncio.sleep(0.05)
+            with c.priority('high'):
+                high = asyncio.ensure_future(call(c, 'high'))
+            await asyncio.gather(high, *low)
+
+    asyncio.run(fn())
+    mover.join()
+    assert done == ['high', 'low', 'low', 'low']
+
+def test_per_client_stats(client):
+    c = TEMClient('localhost', verbose=False, client_name='stats-test')
+    c.GetBeamBlank()
+    with pytest.raises(ValueError):
+        with c.priority('urgent'):
+            pass
+    clients = c.server_stats()['clients']
+    assert clients['stats-test']['requests'] >= 2
+    assert clients['stats-test']['rejected'] == 0
+    assert clients['stats-test']['queued'] <= 1 # stats itself
+    assert 'p99_ms' in clients['stats-test']['queue']
+    c.close()
+
+def test_waits_beyond_the_workers_reply_busy(client):
+    size = client.server_stats()['workers']['wait']['size']
+
+    async def wait_all():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            t0 = time.perf_counter()
+            #Never reached, every wait runs into its timeout
+            res = await asyncio.gather(*[c.WaitForAngle(45, 0.01, 0.5) for i in range(size + 2)],
+                                       return_exceptions=True)
+            return res, time.perf_counter() - t0
+
+    res, dt = asyncio.run(wait_all())
+    assert sum(isinstance(r, ServerBusyError) for r in res) == 2
+    assert res.count(False) == size
+    #The waits ran in parallel
+    assert dt < 1.5
+    assert client.server_stats()['workers']['wait']['busy'] == 0
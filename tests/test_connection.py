@@ -0,0 +1,241 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+import zmq
+from simple_tem import TEMClient, AsyncTEMClient, ServerBusyError
+
+
+def test_connection_is_reused(client):
+    before = client.connection_stats
+    for i in range(5):
+        client.GetStagePosition()
+    stats = client.connection_stats
+    assert stats['connects'] == before['connects']
+    assert stats['reused'] - before['reused'] == 5
+
+def test_timeout_reopens_socket():
+    #Nothing listens on this port so every request times out. The second
+    #request would fail with a state error if the stuck socket was reused
+    c = TEMClient('localhost', 3599, verbose=False)
+    with pytest.raises(TimeoutError):
+        c._send_message("ping", timeout_ms=50)
+    with pytest.raises(TimeoutError):
+        c._send_message("ping", timeout_ms=50)
+    assert c.connection_stats['timeouts'] == 2
+    c.close()
+
+def test_single_open_connection(client):
+    client.ping()
+    assert client.connection_stats['open_connections'] == 1
+
+def _stub_server(answer):
+    """
+    REP socket on a random port answering JSON requests with
+    answer(cmd, n_frames) -> [status, value], None stops serving.
+    Yields the port and the list of frame counts it received.
+    """
+    context = zmq.Context()
+    s = context.socket(zmq.REP)
+    s.setsockopt(zmq.LINGER, 0)
+    port = s.bind_to_random_port('tcp://127.0.0.1')
+    received = []
+    stop = threading.Event()
+
+    def serve():
+        while not stop.is_set():
+            if not s.poll(20):
+                continue
+            frames = s.recv_multipart()
+            received.append(len(frames))
+            reply = answer(frames[0].decode(), len(frames))
+            if reply is None:
+                return
+            s.send_multipart([json.dumps(v).encode() for v in reply])
+
+    t = threading.Thread(target=serve, daemon=True)
+    t.start()
+    yield port, received
+    stop.set()
+    t.join()
+    s.close()
+    context.term()
+
+@pytest.fixture
+def legacy_server():
+    """
+    A server from before the handshake: JSON only, "ping" and nothing
+    else, and it stops serving on any request that is not two frames
+    """
+    def answer(cmd, n_frames):
+        if n_frames != 2:
+            return None
+        if cmd == 'ping':
+            return ['OK', 'pong']
+        return ['ERROR', f"Function: {cmd} not implemented"]
+    yield from _stub_server(answer)
+
+@pytest.fixture
+def busy_once_server():
+    """
+    A server that answers the first request with BUSY
+    """
+    def answer(cmd, n_frames):
+        if cmd == 'capabilities' and not answered:
+            answered.append(cmd)
+            return ['BUSY', "64 requests queued for control"]
+        if cmd == 'capabilities':
+            return ['OK', {'version': 'stub', 'codecs': ['json']}]
+        return ['OK', 'pong']
+    answered = []
+    yield from _stub_server(answer)
+
+def test_legacy_server_only_gets_two_frames(legacy_server):
+    port, received = legacy_server
+    c = TEMClient('127.0.0.1', port, verbose=False)
+    try:
+        assert c.ping()
+        with c.priority('high'), c.fresh_reads():
+            assert c.ping()
+        assert c.codec == 'json'
+    finally:
+        c.close()
+    assert received == [2, 2, 2]
+
+def test_binary_codec_refused_by_legacy_server(legacy_server):
+    port, received = legacy_server
+    c = TEMClient('127.0.0.1', port, verbose=False, codec='struct')
+    try:
+        with pytest.raises(RuntimeError, match='only understands json'):
+            c.GetMagValue()
+    finally:
+        c.close()
+    assert received == [2]
+
+def test_async_legacy_server_only_gets_two_frames(legacy_server):
+    port, received = legacy_server
+
+    async def run():
+        async with AsyncTEMClient('127.0.0.1', port, verbose=False) as c:
+            with c.priority('low'):
+                return await c.ping()
+
+    assert asyncio.run(run())
+    assert received == [2, 2]
+
+def test_busy_handshake_is_retried(busy_once_server):
+    port, received = busy_once_server
+    c = TEMClient('127.0.0.1', port, verbose=False)
+    try:
+        with pytest.raises(ServerBusyError):
+            c.ping()
+        assert not c._legacy_server
+        assert c.ping()
+        assert not c._legacy_server
+    finally:
+        c.close()
+    #BUSY capabilities, capabilities, ping with the header
+    assert received == [2, 2, 3]
+
+def test_async_busy_handshake_is_retried(busy_once_server):
+    port, received = busy_once_server
+
+    async def run():
+        async with AsyncTEMClient('127.0.0.1', port, verbose=False) as c:
+            with pytest.raises(ServerBusyError):
+                await c.ping()
+            return await c.ping(), c._legacy_server
+
+    assert asyncio.run(run()) == (True, False)
+    assert received == [2, 2, 3]
+
+def test_header_sent_after_handshake(client):
+    c = TEMClient('localhost', verbose=False, codec='json', client_name='header-test')
+    try:
+        assert c._request_header() is None
+        assert c.ping()
+        assert c._request_header() == {'client': 'header-test'}
+        assert 'header-test' in c.server_stats()['clients']
+    finally:
+        c.close()
+
+def test_heartbeat(client):
+    changes = []
+    hb = client.start_heartbeat(interval_s=0.05, on_change=changes.append)
+    assert hb.wait_for(alive=True, timeout=2)
+    assert client.is_alive
+    health = client.health
+    assert health.failures == 0 and health.rtt_s > 0
+    assert [h.alive for h in changes] == [True]
+    client.stop_heartbeat()
+    assert client.health is None
+
+def test_heartbeat_alive_before_first_ping(client):
+    #Until the first ping finished is_alive pings instead of reporting down
+    client.start_heartbeat(interval_s=10)
+    assert client.is_alive
+    client.stop_heartbeat()
+
+def test_heartbeat_reports_server_down_from_start():
+    c = TEMClient('localhost', 3599, verbose=False)
+    c._ping_timeout = 50
+    changes = []
+    hb = c.start_heartbeat(interval_s=0.05, on_change=changes.append)
+    assert hb.wait_for(alive=False, timeout=2)
+    c.stop_heartbeat()
+    assert [h.alive for h in changes] == [False]
+    c.close()
+
+def test_heartbeat_to_legacy_server(legacy_server):
+    port, received = legacy_server
+    c = TEMClient('127.0.0.1', port, verbose=False)
+    try:
+        assert c.ping()
+        hb = c.start_heartbeat(interval_s=0.02)
+        assert hb.wait_for(alive=True, timeout=2)
+        time.sleep(0.1)
+        assert c.health.failures == 0
+        c.stop_heartbeat()
+    finally:
+        c.close()
+    assert len(received) > 3 and set(received) == {2}
+
+def test_heartbeat_backs_off_when_down():
+    c = TEMClient('localhost', 3599, verbose=False)
+    c._ping_timeout = 50
+    hb = c.start_heartbeat(interval_s=0.05, max_interval_s=0.2)
+    assert hb.wait_for(alive=False, timeout=2)
+    t0 = time.perf_counter()
+    assert not c.is_alive
+    assert time.perf_counter() - t0 < 0.01
+    time.sleep(0.5)
+    #0.05 0.1 0.2 0.2... plus the ping timeouts, far fewer than at a fixed interval
+    assert 2 <= c.health.failures <= 5
+    c.close()
+
+@pytest.mark.parametrize('frames', [
+    [b'ping', b'{not json'],
+    [b'ping', b'[]', b'{not json'],
+    [b'\xff\xfe', b'[]'],
+    [b'ping', b'\xc1', b'{"codec": "msgpack"}'],
+    [b'ping'],
+    [b'ping', b'[]', b'[1, 2]'],
+    [b'ping', b'[]', b'{"codec": ["json"]}'],
+    [b'ping', b'[]', b'{"codec": "xml"}'],
+])
+def test_malformed_request_gets_error_reply(client, frames):
+    context = zmq.Context()
+    s = context.socket(zmq.REQ)
+    s.setsockopt(zmq.LINGER, 0)
+    s.setsockopt(zmq.RCVTIMEO, 2000)
+    s.connect('tcp://localhost:3535')
+    try:
+        s.send_multipart(frames)
+        assert s.recv_multipart()[0] in (b'"ERROR"', b'ERROR')
+    finally:
+        s.close()
+        context.term()
+    #The server keeps serving
+    assert client.ping()
@@ -0,0 +1,143 @@
+import pytest
+import socket
+import threading
+
+from simple_tem.dummy import PyJEM
+
+
+def test_import_does_not_connect(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("network connection at import")
+    monkeypatch.setattr(socket.socket, 'connect', fail)
+    import importlib
+    importlib.reload(PyJEM)
+
+def test_memory_store_is_default():
+    assert isinstance(PyJEM.get_store(), PyJEM.MemoryStore)
+    assert PyJEM.get_store() is PyJEM.get_store()
+
+def test_memory_store_defaults():
+    store = PyJEM.new_store()
+    assert store.get('f1OverRateTxNum') == 0
+    store.setdefault('f1OverRateTxNum', 5)
+    assert store.get('f1OverRateTxNum') == 0
+
+def test_memory_store_concurrent_incr():
+    store = PyJEM.MemoryStore()
+    store.set('x', 0)
+
+    def worker():
+        for i in range(1000):
+            store.incr('x', 1)
+
+    threads = [threading.Thread(target=worker) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert store.get('x') == 8000
+
+def test_stage_uses_store():
+    stage = PyJEM.TEM3.Stage3()
+    stage.Setf1OverRateTxNum(3)
+    assert stage.Getf1OverRateTxNum() == 3
+    stage.Setf1OverRateTxNum(0)
+
+@pytest.fixture
+def stage():
+    return PyJEM.Stage3(PyJEM.VirtualClock(), PyJEM.new_store())
+
+def test_rotation_follows_clock(stage):
+    stage.SetTiltXAngle(10) # 10 deg/s
+    assert stage.GetStatus()[3] == 1
+    stage.clock.advance(0.5)
+    assert stage.GetPos()[3] == pytest.approx(5)
+    stage.clock.advance(0.6)
+    assert stage.GetPos()[3] == 10
+    assert stage.GetStatus()[3] == 0
+
+def test_negative_rotation(stage):
+    stage.SetTiltXAngle(-4)
+    stage.clock.advance(0.1)
+    assert stage.GetPos()[3] == pytest.approx(-1)
+
+def test_stop(stage):
+    stage.SetTiltXAngle(10)
+    stage.clock.advance(0.3)
+    stage.Stop()
+    stage.clock.advance(1)
+    assert stage.GetPos()[3] == pytest.approx(3)
+    assert stage.GetStatus()[3] == 0
+
+def test_new_move_replaces_current(stage):
+    stage.SetTiltXAngle(10)
+    stage.clock.advance(0.5)
+    stage.SetTiltXAngle(0)
+    stage.clock.advance(0.2)
+    assert stage.GetPos()[3] == pytest.approx(3)
+    stage.clock.advance(1)
+    assert stage.GetPos()[3] == 0
+
+def test_speed_change_during_move(stage):
+    stage.SetTiltXAngle(10)
+    stage.clock.advance(0.5)
+    stage.Setf1OverRateTxNum(2) # 1 deg/s
+    stage.clock.advance(1)
+    assert stage.GetPos()[3] == pytest.approx(6)
+    assert stage.GetStatus()[3] == 1
+
+@pytest.mark.parametrize('val', [6, -1, 1.5, '2'])
+def test_invalid_speed_is_not_stored(stage, val):
+    stage.Setf1OverRateTxNum(2)
+    with pytest.raises(ValueError):
+        stage.Setf1OverRateTxNum(val)
+    assert stage.Getf1OverRateTxNum() == 2
+    stage.SetTiltXAngle(1)
+    stage.clock.advance(0.5)
+    assert stage.GetPos()[3] == pytest.approx(0.5)
+
+def test_relative_move_blocks_on_virtual_time(stage):
+    t0 = stage.clock.now()
+    stage.SetTXRel(20)
+    assert stage.GetPos()[3] == 20
+    assert stage.clock.now() - t0 == pytest.approx(2, abs=0.02)
+
+def test_tilt_series_on_virtual_time(stage):
+    stage.Setf1OverRateTxNum(5) # 0.1 deg/s
+    for angle in range(-60, 61, 10):
+        stage.SetTiltXAngle(angle)
+        while stage.GetStatus()[3]:
+            stage.clock.advance(0.5)
+        assert stage.GetPos()[3] == angle
+
+@pytest.fixture
+def redis_store():
+    redis = pytest.importorskip('redis')
+    store = PyJEM.RedisStore(PyJEM.PyJEM_DummyConf.redis_host, PyJEM.PyJEM_DummyConf.redis_port)
+    try:
+        store.store.ping()
+    except redis.exceptions.ConnectionError:
+        pytest.skip("no redis server on {}:{}".format(PyJEM.PyJEM_DummyConf.redis_host,
+                                                    PyJEM.PyJEM_DummyConf.redis_port))
+    keys = ['test_dummy_a', 'test_dummy_b']
+    yield store
+    store.store.delete(*keys)
+
+def test_redis_store(redis_store):
+    redis_store.set('test_dummy_a', 1)
+    redis_store.setdefault('test_dummy_a', 5)
+    assert redis_store.get('test_dummy_a') == 1
+    assert redis_store.incr('test_dummy_a', 2) == 3
+    assert redis_store.incr('test_dummy_a', 0.5) == pytest.approx(3.5)
+    redis_store.set_many({'test_dummy_a': 1.5, 'test_dummy_b': -2})
+    assert redis_store.get_many(['test_dummy_a', 'test_dummy_b']) == [1.5, -2]
+
+def test_speed_change_does_not_cancel_blocking_move(stage):
+    t0 = stage.clock.now()
+    move_id = stage._move(10)
+    stage.clock.advance(0.5)
+    stage.Setf1OverRateTxNum(1) # 2 deg/s for the remaining 5 deg
+    stage._wait_for_move(move_id)
+    assert stage.GetPos()[3] == 10
+    assert stage.clock.now() - t0 == pytest.approx(3, abs=0.02)
+    stage.Setf1OverRateTxNum(0)
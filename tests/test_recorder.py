@@ -0,0 +1,112 @@
+import asyncio
+import os
+import subprocess
+import sys
+
+import pytest
+from simple_tem import TEMClient, AsyncTEMClient
+from simple_tem.recorder import read_session
+from simple_tem.replay import replay, compare
+
+
+def _record_session(path):
+    c = TEMClient('localhost', verbose=False)
+    c.start_recording(path)
+    c.GetStagePosition()
+    c.SetBeamBlank(0)
+    with pytest.raises(RuntimeError):
+        c.UnknownFunction()
+    c.GetMagValue()
+    c.close()
+
+def test_record_session(tmp_path):
+    path = tmp_path / 'session.log'
+    _record_session(path)
+    records = list(read_session(path))
+    assert [r.cmd for r in records] == ['capabilities', 'GetStagePosition', 'SetBeamBlank',
+                                        'UnknownFunction', 'GetMagValue']
+    assert [r.status for r in records] == ['OK', 'OK', 'OK', 'ERROR', 'OK']
+    assert records[2].args == [0]
+    assert records[4].reply == [15000, 'X', 'X15k']
+    assert all(r.latency_s > 0 and r.timeout_ms == 5000 for r in records)
+    assert all(a.t_send <= b.t_send for a, b in zip(records, records[1:]))
+    assert len({r.stream for r in records}) == 1
+
+def test_append_and_truncated_record(tmp_path):
+    path = tmp_path / 'session.log'
+    _record_session(path)
+    _record_session(path)
+    assert len(list(read_session(path))) == 10
+    with open(path, 'ab') as f:
+        f.write(b'\x00'*10)
+    assert len(list(read_session(path))) == 10
+
+def test_not_a_session_log(tmp_path):
+    path = tmp_path / 'other.log'
+    path.write_bytes(b'something else')
+    with pytest.raises(ValueError):
+        list(read_session(path))
+
+class _BrokenRecorder:
+    def __init__(self):
+        self.closed = False
+
+    def record(self, *args):
+        raise OSError("No space left on device")
+
+    def close(self):
+        self.closed = True
+
+def test_recorder_error_does_not_fail_the_command():
+    c = TEMClient('localhost', verbose=False)
+    c.ping()
+    recorder = c._recorder = _BrokenRecorder()
+    assert c.GetMagValue() == [15000, 'X', 'X15k']
+    #Recording stopped after the first error
+    assert c._recorder is None
+    assert recorder.closed
+    assert c.GetMagValue() == [15000, 'X', 'X15k']
+    c.close()
+
+def test_async_recorder_error_does_not_fail_the_command():
+    async def run():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            c._recorder = _BrokenRecorder()
+            return await c.GetMagValue(), c._recorder
+    assert asyncio.run(run()) == ([15000, 'X', 'X15k'], None)
+
+def test_async_streams(tmp_path):
+    path = tmp_path / 'session.log'
+    async def run():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            c.start_recording(path)
+            await asyncio.gather(c.GetStagePosition(), c.GetMagValue(), c.GetBeamBlank())
+    asyncio.run(run())
+    records = list(read_session(path))
+    assert sorted(r.cmd for r in records) == ['GetBeamBlank', 'GetMagValue', 'GetStagePosition']
+    assert sorted(r.stream for r in records) == [0, 1, 2]
+
+@pytest.mark.parametrize('speed', [None, 10.0])
+def test_replay(tmp_path, speed):
+    path = tmp_path / 'session.log'
+    _record_session(path)
+    results, duration = asyncio.run(replay(read_session(path), speed=speed, concurrency=2))
+    assert sorted(r.cmd for r, _, _ in results) == ['GetMagValue', 'GetStagePosition',
+                                                    'SetBeamBlank', 'UnknownFunction']
+    report = compare(results)
+    assert report['all']['recorded']['count'] == report['all']['replay']['count'] == 4
+    assert report['all']['status_changed'] == 0
+    assert report['UnknownFunction']['replay']['count'] == 1
+
+def test_replay_cli(tmp_path):
+    path = tmp_path / 'session.log'
+    _record_session(path)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    out = subprocess.run([sys.executable, '-m', 'simple_tem.replay', str(path), '--max-speed',
+                          '-o', str(tmp_path / 'replay.json')],
+                         cwd=root, capture_output=True, text=True, timeout=30)
+    assert out.returncode == 0, out.stderr
+    assert 'GetStagePosition' in out.stdout
+    assert (tmp_path / 'replay.json').exists()
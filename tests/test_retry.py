@@ -0,0 +1,121 @@
+import asyncio
+import pytest
+import threading
+import time
+from simple_tem import TEMClient, AsyncTEMClient, RetryPolicy
+from simple_tem.retry import is_safe
+from simple_tem.stats import LatencyStats
+
+
+def test_safe_commands():
+    assert is_safe('GetStagePosition')
+    assert is_safe('ping')
+    assert is_safe('version')
+    assert not is_safe('SetTiltXAngle')
+    assert not is_safe('StartTXRel')
+    assert not is_safe('StopStage')
+
+def test_adaptive_timeout():
+    policy = RetryPolicy(timeout_factor=4, min_timeout_ms=10, min_samples=5)
+    latency = LatencyStats()
+    assert policy.timeout_ms(latency, 'GetMagValue', 5000) == 5000
+    for i in range(10):
+        latency.record('GetMagValue', {'total': 0.01})
+    assert policy.timeout_ms(latency, 'GetMagValue', 5000) == pytest.approx(40, abs=1)
+    assert policy.timeout_ms(latency, 'GetMagValue', 5000, attempt=1) == pytest.approx(80, abs=2)
+    assert policy.timeout_ms(latency, 'GetMagValue', 30) == 30
+    assert RetryPolicy(adaptive_timeouts=False).timeout_ms(latency, 'GetMagValue', 5000) == 5000
+
+def test_backoff():
+    policy = RetryPolicy(backoff_s=0.01, max_backoff_s=0.03)
+    assert [policy.backoff(i) for i in range(4)] == [0.01, 0.02, 0.03, 0.03]
+
+def test_only_safe_commands_are_retried():
+    #Nothing listens on this port
+    c = TEMClient('localhost', 3599, verbose=False, codec='json',
+                  retry_policy=RetryPolicy(retries=2, backoff_s=0.001))
+    #As if the handshake was done, only the commands time out
+    c._negotiated = True
+    assert not c.ping(timeout_ms=50)
+    assert c.retry_stats['retries'] == 2
+    assert c.connection_stats['timeouts'] == 3
+    with pytest.raises(TimeoutError):
+        c._send_message("SetTiltXAngle", 0, timeout_ms=50)
+    assert c.retry_stats['retries'] == 2
+    assert c.connection_stats['timeouts'] == 4
+    c.close()
+
+def test_timeout_follows_latency(client):
+    policy = RetryPolicy(min_samples=10)
+    c = TEMClient('localhost', verbose=False, retry_policy=policy)
+    for i in range(20):
+        c.GetStagePosition()
+    assert policy.timeout_ms(c._latency, 'GetStagePosition', 5000) == policy.min_timeout_ms
+    c.close()
+
+def _slow_stage_reads(client):
+    #Stage reads queue behind the blocking SetTXRel (~1s) in the dummy
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.2)
+    return mover
+
+def test_read_queued_behind_move_is_sent_once_more(client):
+    policy = RetryPolicy(min_samples=10)
+    c = TEMClient('localhost', verbose=False, retry_policy=policy)
+    for i in range(20):
+        c.GetStagePosition()
+    mover = _slow_stage_reads(client)
+    try:
+        pos = c.GetStagePosition()
+    finally:
+        mover.join()
+    assert len(pos) == 5
+    #The server answered the ping so the read waited with the full timeout
+    assert c.retry_stats == {'retries': 0, 'busy_retries': 0, 'lane_busy_retries': 1}
+    c.close()
+
+def test_async_read_queued_behind_move_is_sent_once_more(client):
+    async def run():
+        policy = RetryPolicy(min_samples=10)
+        async with AsyncTEMClient('localhost', verbose=False, retry_policy=policy) as c:
+            for i in range(20):
+                await c.GetStagePosition()
+            mover = _slow_stage_reads(client)
+            try:
+                pos = await c.GetStagePosition()
+            finally:
+                mover.join()
+            return pos, c.retry_stats
+    pos, stats = asyncio.run(run())
+    assert len(pos) == 5
+    assert stats == {'retries': 0, 'busy_retries': 0, 'lane_busy_retries': 1}
+
+def test_hedged_request(client):
+    client.ping()
+    mover = _slow_stage_reads(client)
+    c = TEMClient('localhost', verbose=False)
+    c.ping()
+    try:
+        pos = c._request(c._codec, 'GetStagePosition', (), 5000, hedge_after_ms=50)
+    finally:
+        mover.join()
+    assert len(pos) == 5
+    assert c.connection_stats['hedged'] == 1
+    #The connection left waiting was replaced
+    assert c.GetStagePosition() == client.GetStagePosition()
+    c.close()
+
+def test_async_hedged_request(client):
+    async def run():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            mover = _slow_stage_reads(client)
+            try:
+                pos = await c._request(c._codec, 'GetStagePosition', (), 5000, hedge_after_ms=50)
+            finally:
+                mover.join()
+            return pos, c.connection_stats, await c.GetStagePosition()
+    pos, stats, pos2 = asyncio.run(run())
+    assert len(pos) == 5
+    assert stats['hedged'] == 1
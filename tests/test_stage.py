@@ -1,5 +1,7 @@
 
 import pytest
+import threading
+from simple_tem import TEMClient
 import time
 
 # --------------------- STAGE ---------------------
@@ -66,4 +68,205 @@ def test_StopStage(client):
     client.StopStage()
     time.sleep(0.5)
     assert client.GetStageStatus()[3] == 0
-    assert client.GetStagePosition()[3] < 10
\ No newline at end of file
+    assert client.GetStagePosition()[3] < 10
+
+def test_WaitForStageIdle(client):
+    client.SetTiltXAngle(3)
+    assert client.WaitForRotationStart(2)
+    assert client.WaitForStageIdle(10)
+    assert client.GetStageStatus()[3] == 0
+    assert client.GetTiltXAngle() == pytest.approx(3)
+
+def test_WaitForAngle(client):
+    client.SetTiltXAngle(4)
+    assert client.WaitForAngle(4, 0.01, 10)
+    assert client.WaitForStageIdle(10)
+
+def test_WaitForRotationStart_timeout(client):
+    t0 = time.perf_counter()
+    assert not client.WaitForRotationStart(0.2)
+    assert time.perf_counter()-t0 < 1
+
+def test_wait_until_rotate_starts_raises(client):
+    with pytest.raises(TimeoutError):
+        client.wait_until_rotate_starts(0.2)
+
+def test_trajectory(client):
+    since = client.trajectory().next
+    client.SetTiltXAngle(5)
+    assert client.WaitForRotationStart(2)
+    assert client.WaitForStageIdle(10)
+    time.sleep(0.1)
+    traj = client.trajectory(since)
+    assert len(traj) > 10 # 0.5s at 50 Hz
+    assert list(traj.t) == sorted(traj.t)
+    assert traj.angle[0] == pytest.approx(0, abs=0.3)
+    assert traj.angle[-1] == pytest.approx(5)
+    assert traj.moving[0] == 0 and traj.moving[-1] == 0
+    assert not traj.overrun
+    assert len(client.trajectory(traj.next)) == 0
+
+def test_trajectory_during_blocking_move(client):
+    since = client.trajectory().next
+    #SetTXRel holds the stage lane until the rotation is done (~1s)
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.5)
+    other = TEMClient('localhost', verbose=False)
+    try:
+        assert other.WaitForRotationStart(0.2)
+        traj = other.trajectory(since)
+    finally:
+        mover.join()
+        other.close()
+    assert len(traj) > 10 # 0.5s at 50 Hz
+    assert traj.moving[-1] == 1
+    assert 0 < traj.angle[-1] < 10
+
+def test_trajectory_codecs():
+    for codec in ('json', 'msgpack'):
+        c = TEMClient('localhost', verbose=False, codec=codec)
+        traj = c.trajectory()
+        assert len(traj.t) == len(traj.angle) == len(traj.moving)
+        c.close()
+
+def test_sequence(client):
+    seq_id = client.RunSequence([
+        ['SetBeamBlank', 1],
+        ['SetTiltXAngle', 2],
+        ['WaitForRotationStart', 2],
+        ['WaitForStageIdle', 10],
+        ['SetBeamBlank', 0],
+        ['Dwell', 0.1],
+    ])
+    status = client.WaitForSequence(10)
+    assert status['id'] == seq_id
+    assert status['state'] == 'done'
+    assert status['step'] == status['n_steps'] == 6
+    assert [entry[2] for entry in status['log']] == ['SetBeamBlank', 'SetTiltXAngle', 'WaitForRotationStart',
+                                                    'WaitForStageIdle', 'SetBeamBlank', 'Dwell']
+    assert all(entry[4] == 'OK' for entry in status['log'])
+    dwell = status['log'][-1]
+    assert dwell[1] - dwell[0] == pytest.approx(0.1, abs=0.05)
+    assert client.GetTiltXAngle() == pytest.approx(2)
+    assert client.GetBeamBlank() == 0
+
+def test_sequence_aborted_by_StopStage(client):
+    client.RunSequence([['SetTiltXAngle', 30], ['WaitForAngle', 30, 0.1, 10], ['SetBeamBlank', 1]])
+    assert client.WaitForRotationStart(2)
+    assert client.GetSequenceStatus()['state'] == 'running'
+    client.StopStage()
+    status = client.WaitForSequence(2)
+    assert status['state'] == 'aborted'
+    assert status['step'] == 1
+    assert client.GetBeamBlank() == 0
+
+def test_sequence_rejects_unknown_step(client):
+    with pytest.raises(RuntimeError):
+        client.RunSequence([['exit_server']])
+
+@pytest.mark.parametrize('steps', [
+    [['Dwell']],
+    [['SetTiltXAngle', 1, 2]],
+    [['WaitForAngle', 'ten']],
+    [['SetBeamBlank', True]],
+    [[['Dwell'], 1]],
+    [[]],
+])
+def test_sequence_rejects_malformed_step(client, steps):
+    with pytest.raises(RuntimeError):
+        client.RunSequence([['SetBeamBlank', 0]] + steps)
+    client.RunSequence([['Dwell', 0.01]])
+    assert client.WaitForSequence(2)['state'] == 'done'
+
+def test_sequence_error_does_not_block_the_next(client):
+    #Event.wait() overflows on this, an exception inside the sequence thread
+    client.RunSequence([['Dwell', 1e300]])
+    status = client.WaitForSequence(2)
+    assert status['state'] == 'error'
+    assert 'Exception in step 0' in status['error']
+    client.RunSequence([['Dwell', 0.01]])
+    assert client.WaitForSequence(2)['state'] == 'done'
+
+def test_sequence_timeout(client):
+    client.RunSequence([['WaitForRotationStart', 0.1], ['SetBeamBlank', 1]])
+    status = client.WaitForSequence(2)
+    assert status['state'] == 'timeout'
+    assert len(status['log']) == 1
+
+def test_operation(client):
+    op = client.StartTiltXAngle(3)
+    assert not op.done()
+    assert op.wait(10)
+    assert op.state == 'done'
+    assert op.position[3] == pytest.approx(3)
+    assert client.GetStageStatus()[3] == 0
+
+def test_operation_relative_move_returns_at_once(client):
+    t0 = time.perf_counter()
+    op = client.StartTXRel(5)
+    assert time.perf_counter() - t0 < 0.2
+    assert op.wait(10)
+    assert op.state == 'done'
+    assert op.position[3] == pytest.approx(5)
+
+def test_operation_cancel(client):
+    op = client.StartTiltXAngle(20)
+    time.sleep(0.2)
+    assert op.cancel()
+    assert op.wait(2)
+    assert op.state == 'cancelled'
+    assert op.position[3] < 10
+    assert not op.cancel()
+
+def test_operation_replaced(client):
+    first = client.StartTiltXAngle(20)
+    time.sleep(0.1)
+    second = client.StartTiltXAngle(0)
+    assert first.wait(1)
+    assert first.state == 'replaced'
+    assert second.wait(10)
+    assert second.state == 'done'
+
+def test_operation_starts_during_blocking_move(client):
+    mover = threading.Thread(target=client.SetTXRel, args=(10,))
+    mover.start()
+    time.sleep(0.2)
+    other = TEMClient('localhost', verbose=False)
+    try:
+        t0 = time.perf_counter()
+        first = other.StartTXRel(2)
+        second = other.StartTXRel(3)
+        assert time.perf_counter() - t0 < 0.2
+        #Waiting behind the move, replaced before it began
+        assert first.wait(1)
+        assert first.state == 'replaced'
+        assert first.position is None
+        assert second.refresh()['state'] == 'running'
+        assert second.wait(10)
+        assert second.state == 'done'
+        assert second.status['target'] == pytest.approx(13)
+        assert second.position[3] == pytest.approx(13)
+    finally:
+        mover.join()
+        other.close()
+
+def test_operation_relative_then_absolute(client):
+    first = client.StartTXRel(2)
+    time.sleep(0.1)
+    second = client.StartTiltXAngle(-1)
+    #The blocking relative move finishes before the next one begins
+    assert first.wait(1)
+    assert first.state == 'done'
+    assert first.position[3] == pytest.approx(2)
+    assert second.wait(10)
+    assert second.state == 'done'
+
+def test_operation_wait_timeout(client):
+    op = client.StartTiltXAngle(10)
+    assert not op.wait(0.1)
+    assert op.wait(10)
+
+def test_operation_unknown(client):
+    with pytest.raises(RuntimeError):
+        client._send_message("GetOperation", 123456789)
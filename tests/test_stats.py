@@ -0,0 +1,56 @@
+import json
+import pytest
+from simple_tem.stats import Histogram, LatencyStats
+
+
+def test_histogram_percentiles():
+    h = Histogram()
+    for i in range(1, 101):
+        h.add(i*1e-3)
+    assert h.count == 100
+    assert h.max == pytest.approx(0.1)
+    assert h.percentile(50) == pytest.approx(50e-3, rel=0.06)
+    assert h.percentile(99) == pytest.approx(99e-3, rel=0.06)
+    assert h.percentile(100) == pytest.approx(0.1)
+
+def test_empty_histogram():
+    assert Histogram().summary()['p99_ms'] == 0
+
+def test_latency_stats_counts_errors():
+    s = LatencyStats()
+    s.record('GetAlpha', {'total': 1e-3})
+    s.record('GetAlpha', {'total': 2e-3}, error=True)
+    summary = s.summary()['commands']['GetAlpha']
+    assert summary['count'] == 2
+    assert summary['errors'] == 1
+    assert summary['phases']['total']['count'] == 2
+
+
+def test_server_stats(client):
+    client.GetAlpha()
+    stats = client.server_stats()
+    alpha = stats['commands']['GetAlpha']
+    assert alpha['count'] >= 1
+    for phase in ('recv', 'decode', 'queue', 'call', 'encode', 'send'):
+        assert phase in alpha['phases']
+    assert 'cache' in stats
+
+def test_server_stats_counts_errors(client):
+    before = client.server_stats()['commands'].get('UnknownFunction', {'errors': 0})['errors']
+    with pytest.raises(RuntimeError):
+        client.UnknownFunction()
+    assert client.server_stats()['commands']['UnknownFunction']['errors'] == before + 1
+
+def test_client_stats(client):
+    client.GetSpotSize()
+    stats = client.client_stats()['commands']['GetSpotSize']
+    assert stats['count'] >= 1
+    assert stats['phases']['total']['max_ms'] > 0
+
+def test_client_stats_dump(client, tmp_path):
+    path = tmp_path/'client_stats.jsonl'
+    client.start_stats_dump(path, interval_s=60)
+    client.GetAlpha()
+    client.stop_stats_dump()
+    lines = path.read_text().splitlines()
+    assert 'GetAlpha' in json.loads(lines[-1])['commands']
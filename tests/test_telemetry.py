@@ -0,0 +1,32 @@
+import pytest
+import time
+
+
+def test_telemetry_state(telemetry_client):
+    state = telemetry_client.telemetry
+    assert state['position'] == pytest.approx([1.1, 1.2, 1.3, 0, 1.5])
+    assert state['status'] == [0,0,0,0,0]
+    assert state['beam_blank'] == 0
+
+def test_is_rotating_answered_locally(telemetry_client):
+    before = telemetry_client.connection_stats['requests']
+    for i in range(10):
+        assert not telemetry_client.is_rotating
+        assert telemetry_client.GetTiltXAngle() == pytest.approx(0)
+    assert telemetry_client.connection_stats['requests'] == before
+
+def test_telemetry_follows_rotation(telemetry_client):
+    c = telemetry_client
+    c.SetTiltXAngle(5)
+    c.wait_until_rotate_starts()
+    while c.is_rotating:
+        time.sleep(0.01)
+    assert c.GetTiltXAngle() == pytest.approx(5)
+
+def test_telemetry_beam_blank(telemetry_client):
+    telemetry_client.SetBeamBlank(1)
+    #The sample kicked by the command can arrive before the reply and is then
+    #dropped, the next one comes with the keepalive at the latest
+    assert telemetry_client._telemetry.wait_for(lambda state: state['beam_blank'] == 1, 2)
+    assert telemetry_client.telemetry['beam_blank'] == 1
+    telemetry_client.SetBeamBlank(0)
@@ -0,0 +1,48 @@
+import asyncio
+import json
+import pytest
+from simple_tem import TEMClient, AsyncTEMClient
+
+
+def test_trace_export(client, tmp_path):
+    tracer = client.start_trace()
+    client.GetStagePosition()
+    client.SetBeamBlank(0)
+    with pytest.raises(RuntimeError):
+        client._send_message("NotACommand")
+    assert client.stop_trace(tmp_path/'trace.json') is tracer
+    client.GetMagValue()
+    assert len(tracer) == 3
+
+    #Same host, the clocks agree to within the round trip
+    assert abs(tracer.clock_offset) <= tracer.rtt + 1e-3
+
+    trace = json.loads((tmp_path/'trace.json').read_text())
+    spans = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+    assert [e['name'] for e in spans if e['cat'] == 'client'] == ['GetStagePosition', 'SetBeamBlank', 'NotACommand']
+    client_span, queue_span, call_span = [e for e in spans if e['args']['trace_id'] == spans[0]['args']['trace_id']]
+    assert queue_span['name'] == 'GetStagePosition queue'
+    assert call_span['ts'] >= queue_span['ts']
+    #Server spans fall inside the client span, allowing for the clock offset error
+    slack = tracer.rtt*1e6
+    assert client_span['ts'] - slack <= queue_span['ts']
+    assert call_span['ts'] + call_span['dur'] <= client_span['ts'] + client_span['dur'] + slack
+    assert spans[-1]['args']['error']
+
+def test_no_trace_frame_when_disabled(client):
+    c = TEMClient('localhost', verbose=False)
+    c.ping()
+    frames = c._encode_request(c._codec, 'ping', ())
+    assert b'trace' not in b''.join(frames)
+    c.close()
+
+def test_async_trace(client):
+    async def fn():
+        async with AsyncTEMClient('localhost', verbose=False) as c:
+            await c.ping()
+            tracer = c.start_trace()
+            await asyncio.gather(c.GetSpotSize(), c.GetAlpha())
+            return c.stop_trace()
+    tracer = asyncio.run(fn())
+    assert len(tracer) == 2
+    assert tracer.clock_offset is not None
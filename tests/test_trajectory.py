@@ -0,0 +1,62 @@
+import array
+import base64
+import pytest
+
+from simple_tem import Trajectory
+from simple_tem.trajectory import interpolate_angles
+
+np = pytest.importorskip('numpy')
+
+
+def make_trajectory(t, angle):
+    moving = [1.0]*len(t)
+    moving[0] = moving[-1] = 0.0
+    return Trajectory(array.array('d', t), array.array('d', angle), array.array('d', moving))
+
+def test_from_reply():
+    data = array.array('d', [1.0, 10.0, 0.0, 2.0, 11.0, 1.0])
+    reply = {'columns': ['t', 'angle', 'moving'], 'n': 2, 'next': 2.0, 'overrun': False,
+             'data': base64.b64encode(data.tobytes()).decode()}
+    traj = Trajectory.from_reply(reply)
+    assert list(traj.t) == [1.0, 2.0]
+    assert list(traj.angle) == [10.0, 11.0]
+    assert list(traj.moving) == [0.0, 1.0]
+    assert Trajectory.from_reply(dict(reply, data=data.tobytes())) == traj
+
+def test_extend():
+    traj = make_trajectory([1, 2], [0, 1])
+    traj.extend(Trajectory(array.array('d', [3]), array.array('d', [2]), array.array('d', [0]), 3.0))
+    assert len(traj) == 3
+    assert traj.next == 3.0
+
+def test_interpolate():
+    traj = make_trajectory([0, 1, 2, 3], [0, 10, 20, 20])
+    frames = interpolate_angles([0.5, 1.25, 2.5], traj)
+    assert frames.angle == pytest.approx([5, 12.5, 20])
+    assert frames.speed == pytest.approx([10, 10, 0])
+    assert list(frames.extrapolated) == [False, False, False]
+    assert list(frames.stalled) == [False, False, True]
+
+def test_interpolate_outside():
+    traj = make_trajectory([1, 2, 3], [0, 10, 20])
+    frames = interpolate_angles([0, 1, 3, 4], traj)
+    assert frames.angle == pytest.approx([0, 0, 20, 20])
+    assert list(frames.extrapolated) == [True, False, False, True]
+    assert frames.speed[0] == 0 and frames.speed[-1] == 0
+
+def test_interpolate_single_sample():
+    frames = interpolate_angles([0, 1], make_trajectory([1], [5]))
+    assert frames.angle == pytest.approx([5, 5])
+    assert list(frames.extrapolated) == [True, False]
+
+def test_interpolate_empty():
+    with pytest.raises(ValueError):
+        interpolate_angles([0], Trajectory())
+
+def test_interpolate_many_frames():
+    t = np.linspace(0, 60, 3001)
+    traj = make_trajectory(t, t*2)
+    ts = np.random.default_rng(1).uniform(0, 60, 100000)
+    frames = interpolate_angles(ts, traj)
+    assert frames.angle == pytest.approx(ts*2)
+    assert not frames.extrapolated.any()